@@ -2,6 +2,9 @@ SELECT 'CREATE DATABASE paste_server' WHERE NOT EXISTS (SELECT FROM pg_database
 
 \c paste_server
 
+-- This is the base schema. Keys, indexes and later changes are applied on top of it
+-- by the numbered migrations in src/migrations/, see src/utils/migrate.py.
+
 CREATE TABLE IF NOT EXISTS Users (
   Username TEXT,
   Password TEXT,
@@ -13,14 +13,15 @@ from django import setup as django_setup
 from django.conf import settings as django_settings
 from django.template import Context, Engine
 
-from utils.paste import Paste
+from utils.cache import TTLCache
+from utils.codec import content_response
+from utils.paste import Paste, PasteMetadata
 from utils.token import Token
-from utils.utils import Visibility, is_mobile
+from utils.utils import Visibility, decode_cursor, encode_cursor, is_mobile
 
 if TYPE_CHECKING:
   from typing import Any, Union
 
-  import asyncpg
   from django.template import Template
 
   from utils.pg import PGUtils
@@ -51,7 +52,10 @@ with open("config.toml") as f:
   PUBLIC_PASTE_LINES_SHOWN = config["paste"]["public"]["lines_shown"]
   PUBLIC_PASTE_CHARS_SHOWN = config["paste"]["public"]["characters_shown"]
   PASTE_SIDEBAR_NUM_SHOW = config["paste"]["show_number"]
+  PROFILE_PAGE_SIZE = config["paste"].get("profile_page_size", 50)
   PUBLIC_PASTE_NAME_LENGTH = config["paste"]["public"]["name_max_length"]
+  SIDEBAR_CACHE_SIZE = config["paste"]["public"].get("cache_size", 10000)
+  SIDEBAR_CACHE_TTL = config["paste"]["public"].get("cache_ttl", 3600)
   sub_grand_context["public_url"] = config["srv"]["publicurl"]
 
 # Load all of the templates in the static folder.
@@ -79,6 +83,8 @@ for root, dirs, files in os.walk("templates/supporting"):
       sup_templates[filepath.removeprefix("templates/supporting").removeprefix("/")] = tmpl
 
 def reload_files():
+  # Cached sidebars were rendered with the old templates.
+  sidebar_cache.clear()
   for root, dirs, files in os.walk("templates"):
     if "supporting" in root: continue
     for file in files:
@@ -94,8 +100,49 @@ def reload_files():
         tmpl = engine.from_string(f.read())
         sup_templates[filepath.removeprefix("templates/supporting").removeprefix("/")] = tmpl
 
-latest_pastes_cache: list[Paste] = [] # A list of public Pastes for the sidebar.
-latest_pastes_cache_age: int = 0
+# Bytes of content fetched for the sidebar previews, which only show the start of the first few lines.
+SIDEBAR_PREVIEW_BYTES = 2048
+# Stands in for a paste's relative date in cached sidebar HTML, which is filled in when it's shown.
+SIDEBAR_DATE_PLACEHOLDER = "\ue000date\ue000"
+
+class SidebarFragment:
+  "Rendered sidebar HTML for a list of pastes, with their relative dates left to fill in when it's shown."
+  version: int
+  count: int
+
+  def __init__(self, version: int, count: int, parts: list[tuple[str,int,str]]) -> None:
+    self.version = version
+    self.count = count
+    self._parts = parts # (HTML before the date, created time, HTML after the date) for each paste.
+
+  @classmethod
+  def render(cls, version: int, count: int, pastes: list[PasteMetadata], creators: dict[Union[int,None],User]) -> SidebarFragment:
+    parts: list[tuple[str,int,str]] = []
+    for paste in pastes:
+      html = sup_templates["paste/public.html"].render(Context({
+        "name":paste.title if len(paste.title) < PUBLIC_PASTE_NAME_LENGTH  else f"{paste.title[:PUBLIC_PASTE_NAME_LENGTH ]}…",
+        "id": paste.id,
+        "date": SIDEBAR_DATE_PLACEHOLDER,
+        "size":humanize.naturalsize(paste.size,gnu=True),
+        "content": process_paste_content(paste.preview),
+        "syntax": paste.syntax,
+        "author": creators[paste.creator].name
+      }))
+      before, _, after = html.partition(SIDEBAR_DATE_PLACEHOLDER)
+      parts.append((before, paste.created, after))
+    return cls(version, count, parts)
+
+  def __str__(self) -> str:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return "\n\n".join(
+      before + humanize.naturaltime(now-datetime.datetime.fromtimestamp(created,datetime.timezone.utc)) + after
+      for before, created, after
+      in self._parts
+    )
+
+# Rendered sidebars, rebuilt when PGUtils.paste_version says the pastes in them changed. The key is None for
+# the public pastes, or a user id for that user's own pastes. The TTL only catches changes made by other processes.
+sidebar_cache = TTLCache(max_size=SIDEBAR_CACHE_SIZE, ttl=SIDEBAR_CACHE_TTL)
 
 def get_first_x_lines(input: str, x: int) -> str:
   l: list[str] = input.split("\n")
@@ -108,55 +155,33 @@ def process_paste_content(input: str) -> str:
   trimmed_lines = get_first_x_lines(input, PUBLIC_PASTE_LINES_SHOWN)
   return trimmed_lines[:PUBLIC_PASTE_CHARS_SHOWN]
 
-async def refresh_sidebar_pastes(conn: asyncpg.Connection, count: int = 8):
-  global latest_pastes_cache_age, latest_pastes_cache
-  latest_pastes_cache = [Paste.from_record(record) for record in await conn.fetch("SELECT * FROM Pastes WHERE Visibility = 1 ORDER BY Created DESC LIMIT $1",count)]
-  latest_pastes_cache_age = int(datetime.datetime.now(datetime.timezone.utc).timestamp()) + 30
-
 async def prepare_sidebar(request: web.Request, count: int = 8) -> str:
-  global latest_pastes_cache_age, latest_pastes_cache
   app: web.Application = request.app
-  pool: asyncpg.Pool = app.pool
-  # Maybe mobile fix
-  async with pool.acquire() as conn:
-    current_time = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-    if current_time > latest_pastes_cache_age + 30:
-      latest_pastes_cache = [Paste.from_record(record) for record in await conn.fetch("SELECT * FROM Pastes WHERE Visibility = 1 ORDER BY Created DESC LIMIT $1",count)]
-      latest_pastes_cache_age = current_time + 30
-    public_pastes: list[str] = [
-      sup_templates["paste/public.html"].render(Context({
-        "name":paste.title if len(paste.title) < PUBLIC_PASTE_NAME_LENGTH  else f"{paste.title[:PUBLIC_PASTE_NAME_LENGTH ]}…",
-        "id": paste.id,
-        "date":humanize.naturaltime(datetime.datetime.now(datetime.timezone.utc)-datetime.datetime.fromtimestamp(paste.created,datetime.timezone.utc)),
-        "size":humanize.naturalsize(len(paste.data),gnu=True),
-        "content": process_paste_content(paste.text_content),
-        "syntax": paste.syntax,
-        "author": (await paste.get_creator(app.pg)).name
-      }))
-      for paste 
-      in latest_pastes_cache
-    ]
-    public_out = "\n\n".join(public_pastes)
-    token = await request.app.pg.handle_auth(request,strict_password=True,no_exist_ok=True)
-    if type(token) is Token:
-      records = await conn.fetch("SELECT * FROM Pastes WHERE Creator = $1 ORDER BY Created DESC LIMIT $2;",token.owner.id,count)
-      pastes: list[Paste] = [Paste.from_record(record) for record in records]
-      self_pastes: list[str] = [
-        sup_templates["paste/public.html"].render(Context({
-          "name":paste.title if len(paste.title) < PUBLIC_PASTE_NAME_LENGTH  else f"{paste.title[:PUBLIC_PASTE_NAME_LENGTH ]}…",
-          "id": paste.id,
-          "date":humanize.naturaltime(datetime.datetime.now(datetime.timezone.utc)-datetime.datetime.fromtimestamp(paste.created,datetime.timezone.utc)),
-          "size":humanize.naturalsize(len(paste.data),gnu=True),
-          "content": process_paste_content(paste.text_content),
-          "syntax": paste.syntax,
-          "author": (await paste.get_creator(app.pg)).name
-        }))
-        for paste 
-        in pastes
-      ]
-      self_out = "\n\n".join(self_pastes)
-      return sup_templates["paste/sidebar.html"].render(Context({"public_pastes": public_out, "self_pastes": self_out}))
-    return sup_templates["paste/sidebar.html"].render(Context({"public_pastes": public_out, "self_pastes": False}))
+  pg: PGUtils = app.pg
+
+  # Read the versions before querying, so a change made while rendering leaves the fragment out of date rather than wrong.
+  # The pastes are read from the primary, a replica may not have the change the version was bumped for yet, and the
+  # fragment would be cached as current without it. Rebuilds only happen after a change, so this is little load.
+  public_version = pg.public_paste_version
+  public: Union[SidebarFragment,None] = sidebar_cache.get(None)
+  if public is None or public.version != public_version or public.count != count:
+    pastes,_ = await pg.get_pastes_page(public_only=True, limit=count, preview=SIDEBAR_PREVIEW_BYTES, primary=True)
+    creators = await pg.get_request_users(request, [paste.creator for paste in pastes])
+    public = SidebarFragment.render(public_version, count, pastes, creators)
+    sidebar_cache.set(None, public)
+  public_out = str(public)
+
+  token = await pg.handle_auth(request,strict_password=True,no_exist_ok=True)
+  if type(token) is Token:
+    user_id = token.owner.id
+    self_version = pg.paste_version(user_id)
+    own: Union[SidebarFragment,None] = sidebar_cache.get(user_id)
+    if own is None or own.version != self_version or own.count != count:
+      pastes,_ = await pg.get_pastes_page(creator=user_id, limit=count, preview=SIDEBAR_PREVIEW_BYTES, primary=True)
+      own = SidebarFragment.render(self_version, count, pastes, {user_id: token.owner})
+      sidebar_cache.set(user_id, own)
+    return sup_templates["paste/sidebar.html"].render(Context({"public_pastes": public_out, "self_pastes": str(own)}))
+  return sup_templates["paste/sidebar.html"].render(Context({"public_pastes": public_out, "self_pastes": False}))
 
 async def prepare_account_area(request: web.Request) -> str:
   pg: PGUtils = request.app.pg
@@ -277,18 +302,18 @@ async def get_user(request: web.Request) -> web.Response:
     return web.Response(body=rendered,content_type="text/html")
 
   token = await pg.handle_auth(request,strict_password=True,no_exist_ok=True)
-  authorized = type(token) is Token
+  authorized = type(token) is Token and token.owner.id == user.id
+
+  try:
+    cursor = decode_cursor(request.query["cursor"]) if request.query.get("cursor") else None
+  except ValueError:
+    return web.Response(status=400,body="invalid cursor")
 
-  pastes: list[Paste] = await pg.get_pastes_from_creator(creator=user.id)
-  if not authorized:
-    pastes = list(filter(lambda paste: paste.visibility == 1, pastes))
-  pastes = sorted(pastes, key=lambda paste: -paste.created)
+  pastes, next_cursor = await pg.get_pastes_page(creator=user.id, public_only=not authorized, folder="", limit=PROFILE_PAGE_SIZE, cursor=cursor)
 
-  folders: set[dict] = set()
-  for paste in pastes.copy():
-    if paste.folder:
-      folders.add(paste.folder)
-      pastes.remove(paste)
+  folders: set[str] = set()
+  if cursor is None:
+    folders = {folder for folder in await pg.get_user_folders(user, public_only=not authorized) if folder}
 
   def suffix(x):
     if len(str(x)) > 1 and str(x)[-2] == "1":
@@ -321,7 +346,7 @@ async def get_user(request: web.Request) -> web.Response:
       "title": paste.title,
       "real_time": ftime("%b {S}, %Y",datetime.datetime.fromtimestamp(paste.created, datetime.timezone.utc)),
       "relative_time":humanize.naturaltime(datetime.datetime.now(datetime.timezone.utc)-datetime.datetime.fromtimestamp(paste.created,datetime.timezone.utc)),
-      "size":humanize.naturalsize(len(paste.data),gnu=True),
+      "size":humanize.naturalsize(paste.size,gnu=True),
       "id": paste.id,
       "Syntax": paste.syntax.title(),
       "visibility_icon": visibility_icon[paste.visibility],
@@ -339,6 +364,7 @@ async def get_user(request: web.Request) -> web.Response:
   ctx_dict = {
     "folders": folders,
     "pastes": template_pastes,
+    "next_cursor": next_cursor and encode_cursor(*next_cursor),
     "user": c_user,
     "navbar": navbar,
     "footer": sup_templates["footer.html"].source,
@@ -374,13 +400,14 @@ async def get_user(request: web.Request) -> web.Response:
     return web.Response(body=rendered,content_type="text/html")
 
   token = await pg.handle_auth(request,strict_password=True,no_exist_ok=True)
-  authorized = type(token) is Token
+  authorized = type(token) is Token and token.owner.id == user.id
+
+  try:
+    cursor = decode_cursor(request.query["cursor"]) if request.query.get("cursor") else None
+  except ValueError:
+    return web.Response(status=400,body="invalid cursor")
 
-  pastes: list[Paste] = await pg.get_pastes_from_creator(creator=user.id)
-  if not authorized:
-    pastes = list(filter(lambda paste: paste.visibility == 1, pastes))
-  pastes = sorted(pastes, key=lambda paste: -paste.created)
-  pastes = list(filter(lambda paste: paste.folder == folder, pastes))
+  pastes, next_cursor = await pg.get_pastes_page(creator=user.id, public_only=not authorized, folder=folder, limit=PROFILE_PAGE_SIZE, cursor=cursor)
 
   def suffix(x):
     if len(str(x)) > 1 and str(x)[-2] == "1":
@@ -413,7 +440,7 @@ async def get_user(request: web.Request) -> web.Response:
       "title": paste.title,
       "real_time": ftime("%b {S}, %Y",datetime.datetime.fromtimestamp(paste.created, datetime.timezone.utc)),
       "relative_time":humanize.naturaltime(datetime.datetime.now(datetime.timezone.utc)-datetime.datetime.fromtimestamp(paste.created,datetime.timezone.utc)),
-      "size":humanize.naturalsize(len(paste.data),gnu=True),
+      "size":humanize.naturalsize(paste.size,gnu=True),
       "id": paste.id,
       "Syntax": paste.syntax.title(),
       "visibility_icon": visibility_icon[paste.visibility],
@@ -431,6 +458,7 @@ async def get_user(request: web.Request) -> web.Response:
   ctx_dict = {
     "folder_name": folder,
     "pastes": template_pastes,
+    "next_cursor": next_cursor and encode_cursor(*next_cursor),
     "user": c_user,
     "navbar": navbar,
     "footer": sup_templates["footer.html"].source,
@@ -529,23 +557,22 @@ async def get_dl_paste(request: web.Request) -> web.Response:
   app: web.Application = request.app
   pg: PGUtils = app.pg
 
-  paste: Paste = await pg.get_pastes_from_search(id=pasteID)
-
-  if paste:
-    paste = paste[0]
-    if paste.visibility == Visibility.PRIVATE.value:
-      token = await pg.handle_auth(request,no_exist_ok=True)
-      if not (token and token.creator == paste.creator and token.permissions.view_private):
-        return web.Response(status=404,body="404: not found")
-  else:
+  paste = await pg.get_paste_metadata(pasteID)
+  if not paste:
     return web.Response(status=404,body="404: not found")
+  if paste.visibility == Visibility.PRIVATE.value:
+    token = await pg.handle_auth(request,no_exist_ok=True)
+    if not (token and token.owner.id == paste.creator and token.permissions.view_private):
+      return web.Response(status=404,body="404: not found")
 
-  resp: web.StreamResponse = web.StreamResponse()
-  resp.headers["Content-Type"] = "text/plain"
-  resp.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{pasteID}.txt"
-  await resp.prepare(request)
-  await resp.write(paste.data)
-  return resp
+  content = await pg.get_paste_content(paste.content_hash)
+  if not content:
+    return web.Response(status=404,body="404: not found")
+  pg.count_read(paste.content_hash)
+  codec,chunks,path = content
+  return await content_response(request, codec, chunks, size=paste.size, path=path, headers={
+    "Content-Disposition": f"attachment; filename*=UTF-8''{pasteID}.txt"
+  })
 
 @routes.get("/raw/{tail:\w+$}")
 async def get_raw_paste(request: web.Request) -> web.Response:
@@ -556,20 +583,20 @@ async def get_raw_paste(request: web.Request) -> web.Response:
   app: web.Application = request.app
   pg: PGUtils = app.pg
 
-  paste: Paste = await pg.get_pastes_from_search(id=pasteID)
+  paste = await pg.get_paste_metadata(pasteID)
+  if not paste:
+    return web.Response(status=404)
+  if paste.visibility == Visibility.PRIVATE.value:
+    token = await pg.handle_auth(request,no_exist_ok=True)
+    if not (token and token.owner.id == paste.creator and token.permissions.view_private):
+      return web.Response(status=404)
 
-  if paste:
-    paste = paste[0]
-    if paste.visibility == Visibility.PRIVATE.value:
-      token = await pg.handle_auth(request,no_exist_ok=True)
-      if token and token.creator == paste.creator and token.permissions.view_private:
-        return web.Response(body=paste.text_content,content_type="text/plain")
-      else:
-        return web.Response(status=404)
-    else:
-      return web.Response(body=paste.text_content,content_type="text/plain")
-  else:
+  content = await pg.get_paste_content(paste.content_hash)
+  if not content:
     return web.Response(status=404)
+  pg.count_view(paste)
+  codec,chunks,path = content
+  return await content_response(request, codec, chunks, size=paste.size, path=path)
 
 @routes.get("/edit/{tail:\w+$}")
 async def get_paste(request: web.Request) -> web.Response:
@@ -588,7 +615,7 @@ async def get_paste(request: web.Request) -> web.Response:
   if paste:
     token = await pg.handle_auth(request,no_exist_ok=True)
     paste = paste[0]
-    p_owner: User = await paste.get_creator(pg)
+    p_owner: User = await paste.get_creator(pg,request)
     if p_owner != token.owner:
       text_content = False
     else:
@@ -682,7 +709,7 @@ async def get_paste(request: web.Request) -> web.Response:
   if paste:
     token = await pg.handle_auth(request,no_exist_ok=True)
     paste = paste[0]
-    p_owner: User = await paste.get_creator(pg)
+    p_owner: User = await paste.get_creator(pg,request)
     if paste.visibility == Visibility.PRIVATE.value:
       if type(token) is Token and token.owner == p_owner and token.permissions.view_private:
         text_content = paste.text_content
@@ -719,6 +746,7 @@ async def get_paste(request: web.Request) -> web.Response:
     return t.strftime(format).replace('{S}', suffix(t.day))
 
   if text_content:
+    pg.count_view(paste)
     _ctx_dict["paste"] = {
       **grand_context(request), 
       "text":text_content,
@@ -731,9 +759,10 @@ async def get_paste(request: web.Request) -> web.Response:
       "syntax": paste.syntax,
       "linerange": range(text_content.count("\n")+1),
       "tags": paste.tags and paste.tags.split(",") or False,
-      "folder": paste.folder
+      "folder": paste.folder,
+      "views": humanize.intcomma(paste.views)
     }
-    p_owner: User = await paste.get_creator(pg)
+    p_owner: User = await paste.get_creator(pg,request)
     _ctx_dict["user"] = {
       "name": p_owner.name
     }
@@ -1,4 +1,5 @@
 import datetime
+import ipaddress
 import re
 import tomllib
 from typing import TYPE_CHECKING
@@ -6,6 +7,8 @@ from typing import TYPE_CHECKING
 import puremagic
 from aiohttp import web
 
+from utils.export import (ImportTooLargeError, PasteImportError, datadump_response, ndjson_export_response,
+                          ndjson_import_batches, stage_import)
 from utils.pg import PGUtils
 from utils.ratelimit import limiter
 from utils.token import Token
@@ -15,6 +18,7 @@ from utils.utils import (ahash, gravatar, is_hash, join_url_path,
 
 if TYPE_CHECKING:
   import aiohttp
+  import asyncpg
 
 routes = web.RouteTableDef()
 
@@ -29,6 +33,7 @@ with open("config.toml") as f:
   PUBLIC_URL = config["srv"]["publicurl"]
   USERNAME_MIN_LENGTH = config["user"]["name_min"]
   USERNAME_MAX_LENGTH = config["user"]["name_max"]
+  STATS_NETWORKS = [ipaddress.ip_network(network) for network in config["log"].get("stats_networks", ["127.0.0.1/32", "::1/128"])]
 
 EMAIL_REGEX = re.compile(r"(?:[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*|\"(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21\x23-\x5b\x5d-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])*\")@(?:(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?|\[(?:(?:(2(5[0-5]|[0-4][0-9])|1[0-9][0-9]|[1-9]?[0-9]))\.){3}(?:(2(5[0-5]|[0-4][0-9])|1[0-9][0-9]|[1-9]?[0-9])|[a-z0-9-]*[a-z0-9]:(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21-\x5a\x53-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])+)\])")
 
@@ -63,6 +68,7 @@ async def api_login(request: web.Request) -> web.Response:
   async with app.pool.acquire() as conn:
     # Set user remember_me
     await conn.execute("UPDATE Users SET RememberMe=$2 WHERE Id=$1;",user_token.owner.id,remember_me)
+    pg.invalidate_user_tokens(user_token.owner.id)
     if data.get("secure",False):
       record = await conn.fetchrow("SELECT SecureToken FROM Users WHERE Id=$1;",user_token.owner.id)
       token = record["securetoken"]
@@ -133,7 +139,7 @@ async def api_internal_user_exists(request: web.Request) -> web.Response:
   if "name" not in data:
     return web.Response(status=400,body="name parameter is missing")
   async with app.pool.acquire() as conn:
-    exists = (await conn.fetchrow("SELECT EXISTS ( SELECT 1 FROM Users WHERE Username ILIKE $1 );",data["name"]))["exists"]
+    exists = (await conn.fetchrow("SELECT EXISTS ( SELECT 1 FROM Users WHERE lower(Username) = lower($1) );",data["name"]))["exists"]
     if exists:
       return web.Response(status=200,body="true")
     else:
@@ -277,6 +283,7 @@ async def api_internal_user_setavatar(request: web.Request) -> web.Response:
         UPDATE SET 
           Refresh = 0;
     """, token.owner.id)
+    pg.invalidate_user_tokens(token.owner.id)
     return web.Response(status=200)
   
 @routes.post("/api/internal/user/refreshtoken/")
@@ -398,10 +405,9 @@ async def api_internal_user_edit(request: web.Request) -> web.Response:
   return response
 
 @routes.get("/api/internal/user/data/")
-async def api_internal_user_data(request: web.Request) -> web.Response:
+async def api_internal_user_data(request: web.Request) -> web.StreamResponse:
   """
-  Gets all of a user's data and collects it into a single json package.
-  Zips it up, and returns the file.
+  Gets all of a user's pastes and streams them back as a zip, built on the fly.
 
   Authorization required (User's hashed password)
   """
@@ -412,8 +418,56 @@ async def api_internal_user_data(request: web.Request) -> web.Response:
   if type(token) is web.Response:
     return token
 
-  path = await pg.create_datadump(token.owner)
-  return web.FileResponse(path, headers={"Content-Disposition": "attachment;filename=pastes.zip"})
+  return await datadump_response(request, pg, token.owner)
+
+@routes.get("/api/internal/user/export.ndjson")
+async def api_internal_user_export(request: web.Request) -> web.StreamResponse:
+  """
+  Streams all of a user's pastes with their metadata as NDJSON, one paste per line, for backups and moving accounts.
+
+  Authorization required (User's hashed password)
+  """
+  app: web.Application = request.app
+  pg: PGUtils = app.pg
+
+  token = await pg.handle_auth(request,strict_password=True, secure=True)
+  if type(token) is web.Response:
+    return token
+
+  return await ndjson_export_response(request, pg, token.owner)
+
+@routes.post("/api/internal/user/import.ndjson")
+async def api_internal_user_import(request: web.Request) -> web.Response:
+  """
+  Imports pastes into a user's account from NDJSON, as written by `/api/internal/user/export.ndjson`.
+  Either every paste is imported, or none are.
+
+  Authorization required (User's hashed password)
+
+  Return 200 with `imported`, the number of pastes, and `renamed`, the new ids of pastes whose id was already taken.
+  Return 400 naming the first line that couldn't be imported.
+  Return 413 if it is over [paste.import] max_size bytes or max_lines lines.
+  """
+  app: web.Application = request.app
+  pg: PGUtils = app.pg
+
+  token = await pg.handle_auth(request,strict_password=True, secure=True)
+  if type(token) is web.Response:
+    return token
+
+  try:
+    body = await stage_import(request.content)
+  except ImportTooLargeError as e:
+    return web.Response(status=413,text=str(e))
+  try:
+    with body:
+      ids = await pg.import_pastes(ndjson_import_batches(body), token)
+  except PasteImportError as e:
+    return web.Response(status=400,text=str(e))
+  return web.json_response({
+    "imported": len(ids),
+    "renamed": {old: new for old,new in ids if old and old != new},
+  })
 
 @routes.delete("/api/internal/user/delete")
 async def api_internal_user_delete(request: web.Request) -> web.Response:
@@ -423,7 +477,7 @@ async def api_internal_user_delete(request: web.Request) -> web.Response:
   Requires Authentication header.
   `delete-pastes` header determines if all pastes should be deleted. Default to `true`.
 
-  Return 200 if account was deleted, and a data dump.
+  Return 200 once the account is deleted. Its pastes are deleted in the background.
   """
   app: web.Application = request.app
   pg: PGUtils = app.pg
@@ -436,6 +490,53 @@ async def api_internal_user_delete(request: web.Request) -> web.Response:
   await pg.delete_user(token.owner, delete_pastes=delete_pastes)
   return web.Response()
 
+@routes.delete("/api/internal/user/pastes/")
+async def api_internal_user_pastes_delete(request: web.Request) -> web.Response:
+  """
+  Deletes all of a user's pastes, or only those in the folder in the `folder` header, in the background.
+  Only pastes that exist now are deleted, ones created while the job runs are kept.
+
+  Authorization required (User's hashed password)
+
+  Return 202 with the deletion job, whose progress is at /api/internal/user/pastes/deletion/.
+  """
+  app: web.Application = request.app
+  pg: PGUtils = app.pg
+
+  token = await pg.handle_auth(request,strict_password=True, secure=True)
+  if type(token) is web.Response:
+    return token
+
+  job = await pg.queue_paste_deletion(token.owner, folder=request.headers.get("folder"))
+  return web.json_response(deletion_job_json(job), status=202)
+
+@routes.get("/api/internal/user/pastes/deletion/")
+async def api_internal_user_pastes_deletion(request: web.Request) -> web.Response:
+  """
+  Gets the progress of a user's bulk paste deletions, newest first.
+
+  Authorization required (User's hashed password)
+  """
+  app: web.Application = request.app
+  pg: PGUtils = app.pg
+
+  token = await pg.handle_auth(request,strict_password=True)
+  if type(token) is web.Response:
+    return token
+
+  jobs = await pg.get_deletion_jobs(token.owner)
+  return web.json_response([deletion_job_json(job) for job in jobs])
+
+def deletion_job_json(job: "asyncpg.Record") -> dict:
+  return {
+    "id": job["id"],
+    "folder": job["folder"],
+    "total": job["total"],
+    "deleted": job["deleted"],
+    "created": job["created"],
+    "finished": job["finished"],
+  }
+
 @routes.post("/api/internal/token/create/")
 async def api_internal_token_create(request: web.Request) -> web.Response:
   """
@@ -549,5 +650,25 @@ async def api_internal_token_get(request: web.Request) -> web.Response:
   token = await pg.get_token(user_token.owner, token_name)
   return web.Response(body=token.json, content_type="application/json")
 
+@routes.get("/api/internal/stats/")
+async def api_internal_stats(request: web.Request) -> web.Response:
+  """
+  Connection pool and cache statistics, as JSON, for monitoring. The same as the periodic stats log.
+
+  Only served to addresses in [log] stats_networks.
+
+  Return 403 to anyone else.
+  """
+  app: web.Application = request.app
+  pg: PGUtils = app.pg
+
+  try:
+    remote = ipaddress.ip_address(request.remote)
+  except ValueError:
+    return web.Response(status=403)
+  if not any(remote in network for network in STATS_NETWORKS):
+    return web.Response(status=403)
+  return web.json_response(pg.stats)
+
 def setup() -> web.RouteTableDef:
   return routes
\ No newline at end of file
@@ -1,18 +1,24 @@
 from __future__ import annotations
 
+import codecs
 import json
 import logging
 import math
-import re
+import time
+import tomllib
 from typing import TYPE_CHECKING
 
 import aiohttp
+import asyncpg
 from aiohttp import web
 
+from utils.codec import content_response, decompress_stream
 from utils.paste import Paste
-from utils.utils import Visibility
+from utils.utils import Visibility, decode_cursor, encode_cursor
 
 if TYPE_CHECKING:
+  from typing import Any, AsyncIterator, Union
+
   from utils.pg import PGUtils
   from utils.token import Token
   from utils.user import User
@@ -20,8 +26,33 @@ if TYPE_CHECKING:
 routes = web.RouteTableDef()
 LOG = logging.getLogger(__name__)
 
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  batch_config = config["paste"].get("batch", {})
+  BATCH_MAX_ITEMS = batch_config.get("max_items", 1000)
+  BATCH_MAX_ITEM_SIZE = batch_config.get("max_item_size", 1048576)
+  BATCH_MAX_SIZE = batch_config.get("max_size", 16777216)
+  BATCH_MAX_IDS = batch_config.get("max_ids", 250)
+
 VALID_SYNTAX_LANGUAGES = ["abap","actionscript-3","ada","apache","apex","apl","applescript","ara","asm","astro","awk","ballerina","bash","bat","batch","be","berry","bibtex","bicep","blade","c","c#","cadence","cdc","clarity","clj","clojure","cmake","cmd","cobol","codeql","coffee","console","cpp","crystal","cs","csharp","css","cue","d","dart","dax","diff","docker","dream-maker","elixir","elm","erb","erl","erlang","f#","fish","fs","fsharp","fsl","gherkin","git-commit","git-rebase","glsl","gnuplot","go","graphql","groovy","hack","haml","handlebars","haskell","hbs","hcl","hlsl","hs","html","http","imba","ini","jade","java","javascript","jinja-html","jison","js","json","json5","jsonc","jsonnet","jssm","jsx","julia","kotlin","latex","less","liquid","lisp","logo","lua","make","makefile","markdown","marko","matlab","md","mdx","mermaid","nginx","nim","nix","objc","objective-c","objective-cpp","ocaml","pascal","perl","perl6","php","plsql","postcss","powerquery","powershell","prisma","prolog","properties","proto","ps","ps1","pug","puppet","purescript","py","python","ql","r","raku","razor","rb","rel","riscv","rs","rst","ruby","rust","sas","sass","scala","scheme","scss","sh","shader","shaderlab","shell","shellscript","smalltalk","solidity","sparql","sql","ssh-config","stata","styl","stylus","svelte","swift","system-verilog","tasl","tcl","tex","toml","ts","tsx","turtle","twig","typescript","v","vb","verilog","vhdl","vim","viml","vimscript","vue","vue-html","wasm","wenyan","wgsl","xml","xsl","yaml","yml","zenscript","zsh","文言"]
 
+# Longest a paste can be kept for with `expires`, about 10 years.
+MAX_EXPIRES = 10 * 365 * 86400
+
+def parse_expires(value: Any) -> Union[int,None]:
+  """Turn an `expires` field, the number of seconds a paste is kept for, into the time it expires. It must be a
+  whole number (a string of digits, from a query string) up to MAX_EXPIRES. Raises ValueError if it isn't valid."""
+  if value is None or value == "":
+    return None
+  if type(value) is str and value.isascii() and value.isdigit():
+    value = int(value)
+  # Not isinstance, bool is an int too.
+  if type(value) is not int:
+    raise ValueError("expires must be a whole number of seconds")
+  if not 0 < value <= MAX_EXPIRES:
+    raise ValueError(f"expires must be between 1 and {MAX_EXPIRES}")
+  return int(time.time()) + value
+
 # Get JSON of paste
 @routes.get("/api/paste/get/{tail:.*}")
 async def apiPasteGet(request: web.Request) -> web.Response:
@@ -43,13 +74,15 @@ async def apiPasteGet(request: web.Request) -> web.Response:
       else:
         return web.Response(status=401)
     token: Token = await pg.verify_token(auth)
-    if token and token.creator == paste.creator and token.permissions.view_private:
+    if token and token.owner.id == paste.creator and token.permissions.view_private:
+      pg.count_view(paste)
       return web.Response(text=paste.json,content_type="application/json")
     else:
       return web.Response(status=401)
   else:
-    user: User = await paste.get_creator(pg)
+    user: User = await paste.get_creator(pg,request)
     paste.creator = user.name
+    pg.count_view(paste)
     return web.Response(text=paste.json,content_type="application/json")
 
 # Get raw paste data
@@ -59,19 +92,101 @@ async def api_paste_raw_get(request: web.Request) -> web.Response:
   app: web.Application = request.app
   pg: PGUtils = app.pg
 
-  paste: Paste = await pg.get_pastes_from_search(id=pasteID)
-
+  paste = await pg.get_paste_metadata(pasteID)
   if not paste:
     return web.Response(status=404)
-  paste = paste[0]
   if paste.visibility == Visibility.PRIVATE.value:
     token = await pg.handle_auth(request,no_exist_ok=True)
-    if token and token.creator == paste.creator and token.permissions.view_private:
-      return web.Response(text=paste.text_content,content_type="text/plain")
-    else:
+    if not (token and token.owner.id == paste.creator and token.permissions.view_private):
       return web.Response(status=401)
-  else:
-    return web.Response(text=paste.text_content,content_type="text/plain")
+
+  content = await pg.get_paste_content(paste.content_hash)
+  if not content:
+    return web.Response(status=404)
+  pg.count_view(paste)
+  codec,chunks,path = content
+  return await content_response(request, codec, chunks, size=paste.size, path=path)
+
+async def write_json_content(response: web.StreamResponse, item: dict, codec: int, chunks: AsyncIterator[bytes]) -> None:
+  """Write `item` as a JSON object with the content in `chunks` added as its `content`, escaping the content a chunk
+  at a time as it is read, so a paste is never held whole."""
+  await response.write(json.dumps(item).encode()[:-1] + b', "content": "')
+  decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+  async for data in decompress_stream(chunks, codec):
+    if text := decoder.decode(data):
+      await response.write(json.dumps(text)[1:-1].encode())
+  if text := decoder.decode(b"", final=True):
+    await response.write(json.dumps(text)[1:-1].encode())
+  await response.write(b'"}')
+
+async def paste_batch_response(request: web.Request, *, raw: bool) -> web.StreamResponse:
+  """Look up every paste id in the JSON array body at once, and stream back a result for each, in the same order.
+  Private pastes are only returned to their owner with the `View private pastes` intent, like `/api/paste/get/`.
+  Only the pastes' metadata is fetched up front, each content is streamed from storage as its turn comes."""
+  app: web.Application = request.app
+  pg: PGUtils = app.pg
+
+  try:
+    ids = await request.json()
+  except ValueError:
+    return web.Response(status=400,text="invalid json")
+  if type(ids) is not list or not ids or not all(type(id) is str for id in ids):
+    return web.Response(status=400,text="expected a list of paste ids")
+  if len(ids) > BATCH_MAX_IDS:
+    return web.Response(status=413,text=f"too many ids, the limit is {BATCH_MAX_IDS}")
+
+  pastes = await pg.get_pastes_metadata(ids)
+  token = False
+  if any(paste.visibility == Visibility.PRIVATE.value for paste in pastes.values()):
+    token = await pg.handle_auth(request,no_exist_ok=True)
+  creators = {} if raw else await pg.get_request_users(request,{paste.creator for paste in pastes.values()})
+
+  ndjson = request.query.get("format") == "ndjson" or "application/x-ndjson" in request.headers.get("Accept","")
+  response = web.StreamResponse()
+  response.content_type = "application/x-ndjson" if ndjson else "application/json"
+  response.charset = "utf-8"
+  await response.prepare(request)
+  if not ndjson:
+    await response.write(b"[")
+  for i,id in enumerate(ids):
+    if i and not ndjson:
+      await response.write(b",")
+    paste = pastes.get(id)
+    content = None
+    if not paste:
+      item = {"id":id,"error":"not found"}
+    elif paste.visibility == Visibility.PRIVATE.value and not (token and token.owner.id == paste.creator and token.permissions.view_private):
+      item = {"id":id,"error":"unauthorized"}
+    elif not (content := await pg.get_paste_content(paste.content_hash)):
+      # Deleted since its metadata was fetched.
+      item = {"id":id,"error":"not found"}
+    elif raw:
+      item = {"id":id}
+    else:
+      item = paste.as_dict
+      item["creator"] = creators[paste.creator].name
+    if content:
+      pg.count_read(paste.content_hash)
+      codec,chunks,_ = content
+      await write_json_content(response, item, codec, chunks)
+    else:
+      await response.write(json.dumps(item).encode())
+    if ndjson:
+      await response.write(b"\n")
+  if not ndjson:
+    await response.write(b"]")
+  await response.write_eof()
+  return response
+
+# Get JSON of many pastes
+@routes.post("/api/paste/get/batch/")
+async def api_paste_get_batch(request: web.Request) -> web.StreamResponse:
+  return await paste_batch_response(request,raw=False)
+
+# Get raw data of many pastes
+@routes.post("/api/paste/raw/get/batch/")
+async def api_paste_raw_get_batch(request: web.Request) -> web.StreamResponse:
+  return await paste_batch_response(request,raw=True)
 
 @routes.get("/api/paste/search/")
 async def api_paste_search(request: web.Request) -> web.Response:
@@ -88,55 +203,85 @@ async def api_paste_search(request: web.Request) -> web.Response:
       int(query.get("limit","50")),
       250
     )
-    offset=int(query.get("offset","0"))
+    cursor=decode_cursor(query["cursor"]) if query.get("cursor") else None
   except ValueError:
     return web.Response(status=400)
+  if limit < 1:
+    return web.Response(status=400)
 
   if query.get("title"):title=query.get("title")
   if query.get("creator"):creator=query.get("creator")
+  regex = query.get("regex","false").lower() == "true"
 
   token = await pg.handle_auth(request,no_exist_ok=True)
   if type(token) is web.Response:
     return token
 
-  if title: regex: re.Pattern = re.compile(title.lower())
-
-  async def search(paste: Paste,limit=limit,offset=offset) -> bool:
-    user = await pg.get_user(id=paste.creator)
-    if not token:
-      if title and creator:
-        return regex.findall(paste.title.lower()) and user.name.lower() == creator.lower() and paste.visibility == Visibility.PUBLIC.value
-      elif title:
-        return regex.findall(paste.title.lower()) and paste.visibility == Visibility.PUBLIC.value
-      elif creator:
-        return user.name.lower() == creator.lower() and paste.visibility == Visibility.PUBLIC.value
-    else:
-      tokenCreator = token.owner
-      if user == tokenCreator and token.permissions.view_private:
-        if title and creator:
-          return regex.findall(paste.title.lower()) and user.name.lower() == creator.lower()
-        elif title:
-          return regex.findall(paste.title.lower())
-        elif creator:
-          return user.name.lower() == creator.lower()
-      else:
-        if title and creator:
-          return regex.findall(paste.title.lower()) and user.name.lower() == creator.lower() and paste.visibility == Visibility.PUBLIC.value
-        elif title:
-          return regex.findall(paste.title.lower()) and paste.visibility == Visibility.PUBLIC.value
-        elif creator:
-          return user.name.lower() == creator.lower() and paste.visibility == Visibility.PUBLIC.value
-    return False
-
-  pastes = await pg.get_pastes_from_function(search)
+  try:
+    results,next_cursor = await pg.search_pastes(
+      title=title,
+      regex=regex,
+      creator=creator,
+      token=token or None,
+      limit=limit,
+      cursor=cursor
+    )
+  except asyncpg.InvalidRegularExpressionError:
+    return web.Response(status=400,text="invalid title regex")
+
   # Convert list to json document
   j = []
-  for paste in pastes:
+  for paste,creator_name in results:
+    j.append({
+      "id":paste.id,
+      "creator":creator_name,
+      "visibility":paste.visibility,
+      "title":paste.title,
+    })
+  headers = {"X-Next-Cursor": encode_cursor(*next_cursor)} if next_cursor else None
+  return web.Response(text=json.dumps(j),content_type="application/json",headers=headers)
+
+@routes.get("/api/paste/search/content/")
+async def api_paste_search_content(request: web.Request) -> web.Response:
+  query = request.query
+
+  app: web.Application = request.app
+  pg: PGUtils = app.pg
+
+  text = query.get("q","").strip()
+  if not text:
+    return web.Response(status=400,text="missing q")
+
+  try:
+    limit=min(
+      int(query.get("limit","50")),
+      250
+    )
+    offset=int(query.get("offset","0"))
+  except ValueError:
+    return web.Response(status=400)
+  if limit < 1 or offset < 0:
+    return web.Response(status=400)
+
+  token = await pg.handle_auth(request,no_exist_ok=True)
+  if type(token) is web.Response:
+    return token
+
+  results = await pg.search_paste_contents(
+    text,
+    token=token or None,
+    limit=limit,
+    offset=offset*limit
+  )
+
+  j = []
+  for paste,creator_name,snippet in results:
     j.append({
       "id":paste.id,
-      "creator":paste.creator,
+      "creator":creator_name,
       "visibility":paste.visibility,
       "title":paste.title,
+      "snippet":snippet,
     })
   return web.Response(text=json.dumps(j),content_type="application/json")
 
@@ -159,6 +304,11 @@ async def api_paste_create(request: web.Request) -> web.Response:
     LOG.exception(e)
     return web.Response(status=400,text="invalid visibility")
 
+  try:
+    expires = parse_expires(data.get("expires"))
+  except (TypeError, ValueError):
+    return web.Response(status=400,text="invalid expires")
+
   syntax: str = data.get("syntax","plaintext")
   if syntax not in VALID_SYNTAX_LANGUAGES:
     syntax = "plaintext"
@@ -171,7 +321,8 @@ async def api_paste_create(request: web.Request) -> web.Response:
     title=data.get("title"),
     syntax=syntax,
     tags=data.get("tags",""),
-    folder=data.get("folder","")
+    folder=data.get("folder",""),
+    expires=expires
   )
 
   new_paste,reason = await pg.create_new_paste(paste,token)
@@ -181,6 +332,74 @@ async def api_paste_create(request: web.Request) -> web.Response:
 
   return web.Response(status=200,text=new_paste.id)
 
+@routes.post("/api/paste/create/batch/")
+async def api_paste_create_batch(request: web.Request) -> web.Response:
+  app: web.Application = request.app
+  pg: PGUtils = app.pg
+
+  token = await pg.handle_auth(request)
+  if type(token) is web.Response:
+    return token
+
+  # The body is read with a cap, rather than trusting Content-Length, which chunked uploads don't have.
+  if (request.content_length or 0) > BATCH_MAX_SIZE:
+    return web.Response(status=413,text="batch too large")
+  body = bytearray()
+  async for data in request.content.iter_chunked(65536):
+    body += data
+    if len(body) > BATCH_MAX_SIZE:
+      return web.Response(status=413,text="batch too large")
+
+  # Either a JSON array of pastes, or NDJSON with one paste per line.
+  try:
+    if request.content_type == "application/x-ndjson":
+      items = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+      items = json.loads(body)
+  except ValueError:
+    return web.Response(status=400,text="invalid json")
+  if type(items) is not list or not items:
+    return web.Response(status=400,text="expected a list of pastes")
+  if len(items) > BATCH_MAX_ITEMS:
+    return web.Response(status=413,text=f"too many pastes, the limit is {BATCH_MAX_ITEMS}")
+
+  pastes: list[Paste] = []
+  for i,data in enumerate(items):
+    if type(data) is not dict or (not data.get("title")) or (not data.get("content")):
+      return web.Response(status=400,text=f"paste {i}: missing body element")
+    try:
+      visibility = int(data.get("visibility"))
+    except (TypeError, ValueError):
+      return web.Response(status=400,text=f"paste {i}: invalid visibility")
+    try:
+      expires = parse_expires(data.get("expires"))
+    except (TypeError, ValueError):
+      return web.Response(status=400,text=f"paste {i}: invalid expires")
+    content = str(data["content"]).encode()
+    if len(content) > BATCH_MAX_ITEM_SIZE:
+      return web.Response(status=413,text=f"paste {i}: paste too large")
+    syntax = data.get("syntax","plaintext")
+    if syntax not in VALID_SYNTAX_LANGUAGES:
+      syntax = "plaintext"
+    pastes.append(Paste(
+      id="",
+      creator=token.owner.id,
+      data=content,
+      visibility=visibility,
+      title=str(data["title"]),
+      syntax=syntax,
+      tags=str(data.get("tags","")),
+      folder=str(data.get("folder","")),
+      expires=expires
+    ))
+
+  ids,reason = await pg.create_new_pastes(pastes,token)
+
+  if ids is False:
+    return web.Response(text=reason,status=400)
+
+  return web.Response(status=200,text=json.dumps(ids),content_type="application/json")
+
 @routes.post("/api/paste/create_query/")
 async def api_paste_create(request: web.Request) -> web.Response:
   app: web.Application = request.app
@@ -197,7 +416,6 @@ async def api_paste_create(request: web.Request) -> web.Response:
   if type(token) is web.Response:
     return token
   
-  data: dict = await request.text()
   if not query.get("title"):
     return web.Response(status=400,text="missing title")
 
@@ -205,6 +423,11 @@ async def api_paste_create(request: web.Request) -> web.Response:
     int(query.get("visibility"))
   except (TypeError, ValueError):
     return web.Response(status=400,text="invalid visibility")
+
+  try:
+    expires = parse_expires(query.get("expires"))
+  except ValueError:
+    return web.Response(status=400,text="invalid expires")
   
   syntax = query.get("syntax", "plaintext")
   if syntax not in VALID_SYNTAX_LANGUAGES:
@@ -212,15 +435,17 @@ async def api_paste_create(request: web.Request) -> web.Response:
   paste = Paste(
     id="",
     creator=token.owner.id,
-    data=data,
+    data=b"",
     visibility=int(query.get("visibility")),
     title=query.get("title"),
     syntax=syntax,
     tags=query.get("tags",""),
-    folder=query.get("folder","")
+    folder=query.get("folder",""),
+    expires=expires
   )
 
-  new_paste,reason = await pg.create_new_paste(paste,token)
+  # The body is the content, which is streamed in rather than read into memory all at once.
+  new_paste,reason = await pg.create_new_paste_from_stream(paste,token,request.content)
 
   if not new_paste:
     return web.Response(text=reason,status=400)
@@ -239,28 +464,31 @@ async def api_paste_edit(request: web.Request) -> web.Response:
   data: dict = await request.json()
   if not data.get("id",""):
     return web.Response(status=400,body="missing paste id")
-
-  paste = await pg.get_pastes_from_search(id=data.get("id"))
-  if not paste:
-    return web.Response(status=404,body="paste not found")
-  paste: Paste = paste[0]
-  if paste.creator != token.owner.id or not token.permissions.edit_paste:
+  if not token.permissions.edit_paste:
     return web.Response(status=401,body="invalid token")
 
-  paste.title = data.get("title",paste.title)
-  paste.data = (data.get("content",paste.data)).encode()
-  paste.tags = data.get("tags",paste.tags)
-  paste.syntax = data.get("syntax",paste.syntax)
-  paste.folder = data.get("folder",paste.folder)
-
+  visibility = None
   try:
-    paste.visibility = int(data.get("visibility",paste.visibility))
-  except ValueError:
+    visibility = int(data["visibility"]) if "visibility" in data else None
+  except (TypeError, ValueError):
     pass
 
-  out = await pg.edit_paste(paste,token)
+  # Fields that aren't passed are left as they are. Ownership is checked as part of the edit.
+  out = await pg.edit_paste(
+    data["id"],
+    token,
+    title=data.get("title"),
+    content=data.get("content"),
+    visibility=visibility,
+    syntax=data.get("syntax"),
+    tags=data.get("tags"),
+    folder=data.get("folder")
+  )
   if not out:
-    return web.Response(status=400)
+    # Only on failure, tell a missing paste apart from someone else's.
+    if not await pg.get_paste_metadata(data["id"]):
+      return web.Response(status=404,body="paste not found")
+    return web.Response(status=401,body="invalid token")
   return web.Response(status=200,text=out.id)
 
 @routes.post("/api/paste/delete/")
@@ -282,17 +510,14 @@ async def api_paste_delete(request: web.Request) -> web.Response:
 
   pasteID = data["id"]
 
-  paste = (await pg.get_pastes_from_search(id=pasteID))
-  if not paste:
-    return web.Response(status=404,body="paste not found")
-  paste = paste[0]
-  
-  out = await pg.delete_paste(paste,token)
+  out = await pg.delete_paste(pasteID,token)
 
   if out:
     return web.Response(status=200)
-  else:
-    return web.Response(status=400)
+  # Only on failure, tell a missing paste apart from someone else's.
+  if not await pg.get_paste_metadata(pasteID):
+    return web.Response(status=404,body="paste not found")
+  return web.Response(status=400)
 
 def setup():
   return routes
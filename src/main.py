@@ -12,7 +12,10 @@ from aiohttp import web
 from aiohttp_remotes import setup, XForwardedStrict
 
 from utils.utils import get_routes
-from utils.pg import PGUtils
+from utils.migrate import migrate
+from utils.pg import PGUtils, init_connection, request_state_middleware
+from utils.pool import create_pool
+from utils.tasks import cancel_all, run_periodically
 from utils.logger import CustomWebLogger
 # Constant variables
 LOGFMT = "[%(filename)s][%(asctime)s][%(levelname)s] %(message)s"
@@ -44,7 +47,7 @@ coloredlogs.install(
 LOG = logging.getLogger(__name__)
 
 app: web.Application = web.Application(
-  middlewares=[web.normalize_path_middleware(append_slash=True,merge_slashes=True)],
+  middlewares=[web.normalize_path_middleware(append_slash=True,merge_slashes=True),request_state_middleware],
   logger = CustomWebLogger(LOG)
 )
 
@@ -59,6 +62,9 @@ for cog in [f.replace(".py","") for f in os.listdir("cogs") if os.path.isfile(os
 app.add_routes([web.static("/","static")])
 
 async def startup():
+  background_tasks: list[asyncio.Task] = []
+  replicas = []
+  pg = None
   try:
     await setup(
       app,
@@ -67,19 +73,67 @@ async def startup():
       )
     )
 
-    pool = await asyncpg.create_pool(
-      config["pg"]["url"],
-      password=config["pg"]["password"],
-      timeout=config["pg"]["timeout"]
-    )
+    # Migrate before the pool opens, its connections prepare statements against the current schema.
+    if config["pg"].get("migrate", True):
+      conn: asyncpg.Connection = await asyncpg.connect(
+        config["pg"]["url"],
+        password=config["pg"]["password"],
+        timeout=config["pg"]["timeout"]
+      )
+      try:
+        version = await migrate(conn)
+      finally:
+        await conn.close()
+      LOG.info(f"Database schema is at version {version}.")
+
+    pool = await create_pool(init=init_connection)
+    # Replicas open their connections lazily, so one being down doesn't stop the server starting.
+    replicas = [await create_pool(url=url, min_size=0, init=init_connection) for url in config["pg"].get("replicas", [])]
 
     session = aiohttp.ClientSession()
     
-    pg = PGUtils(pool)
+    pg = PGUtils(pool, replicas)
     app.pg = pg
     app.pool = pool
     app.cs = session
 
+    storage_config = config["paste"].get("storage", {})
+    if storage_config.get("recompress_interval", 86400):
+      async def recompress():
+        "Compress pastes stored before compression was enabled, a batch at a time."
+        after = b""
+        while (after := await pg.recompress_pastes(after=after)) is not None:
+          await asyncio.sleep(storage_config.get("recompress_batch_delay", 0.1))
+      background_tasks.append(run_periodically("recompress", recompress, storage_config.get("recompress_interval", 86400)))
+
+    background_tasks.append(run_periodically("views", pg.flush_views, config["paste"].get("views", {}).get("flush_interval", 10)))
+
+    background_tasks.append(run_periodically("expiry", pg.sweep_expired_pastes, config["paste"].get("expiry", {}).get("sweep_interval", 60)))
+
+    cold_config = config["paste"].get("cold_storage", {})
+    if cold_config.get("path"):
+      background_tasks.append(run_periodically("cold_storage", pg.run_cold_storage, cold_config.get("interval", 3600)))
+
+    background_tasks.append(run_periodically("partitions", pg.maintain_paste_partitions, config["paste"].get("partitions", {}).get("interval", 3600)))
+
+    deletion_config = config["paste"].get("deletion", {})
+    background_tasks.append(run_periodically("deletion", pg.run_deletion_jobs, deletion_config.get("interval", 5)))
+
+    if replicas:
+      background_tasks.append(run_periodically("check_replicas", pg.check_replicas, config["pg"].get("replica", {}).get("check_interval", 5)))
+
+    if config["log"].get("stats_interval", 3600):
+      async def log_stats():
+        stats = pg.stats
+        LOG.info(f"Connection pool: {stats['pool']}")
+        for i, replica in enumerate(stats["replicas"]):
+          LOG.info(f"Replica {i} connection pool: {replica}")
+        LOG.info(f"Token cache: {stats['token_cache']}")
+        # The longest wait logged is the longest of each interval.
+        for logged in [pool, *replicas]:
+          logged.reset_max_acquire_time()
+      background_tasks.append(run_periodically("stats", log_stats, config["log"].get("stats_interval", 3600)))
+
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(
@@ -95,10 +149,19 @@ async def startup():
   except asyncio.exceptions.TimeoutError:
     LOG.error("PostgresQL connection timeout. Check the connection arguments!")
   finally:
+    try: await cancel_all(background_tasks)
+    except: pass
     try: await site.stop() 
     except: pass
+    # Write the views counted since the last flush before the pool goes.
+    if pg is not None:
+      try: await pg.flush_views()
+      except: LOG.exception("Failed to write view counts")
     try: await pool.close()
     except: pass
+    for replica in replicas:
+      try: await replica.close()
+      except: pass
     try: await session.close()
     except: pass
 
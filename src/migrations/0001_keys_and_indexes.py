@@ -0,0 +1,49 @@
+# Primary keys on the id columns, and indexes for the hot lookups in utils/pg.py.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from utils.migrate import add_primary_key_online, create_index_concurrently
+
+if TYPE_CHECKING:
+  import asyncpg
+
+TRANSACTIONAL = False
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  await add_primary_key_online(conn, "Pastes", "id")
+  await add_primary_key_online(conn, "Users", "id")
+  await add_primary_key_online(conn, "APITokens", "id")
+
+  # Listings of a user's pastes, and the public sidebar, newest first.
+  await create_index_concurrently(conn, "pastes_creator_created_idx", "Pastes", "(Creator, Created)")
+  await create_index_concurrently(conn, "pastes_visibility_created_idx", "Pastes", "(Visibility, Created)")
+
+  await create_index_concurrently(conn, "apitokens_ident_idx", "APITokens", "(Ident)")
+  await create_index_concurrently(conn, "apitokens_creator_idx", "APITokens", "(Creator)")
+
+  # Usernames are unique regardless of case, and looked up with lower(Username) = lower($1).
+  await _check_duplicate_usernames(conn)
+  await create_index_concurrently(conn, "users_username_lower_idx", "Users", "(lower(Username))", unique=True)
+  await create_index_concurrently(conn, "users_email_lower_idx", "Users", "(lower(Email))")
+
+  # verify_token looks a user up by any of their session tokens.
+  await create_index_concurrently(conn, "users_password_idx", "Users", "(Password)")
+  await create_index_concurrently(conn, "users_securetoken_idx", "Users", "(SecureToken)")
+  await create_index_concurrently(conn, "users_insecuretoken_idx", "Users", "(InsecureToken)")
+
+async def _check_duplicate_usernames(conn: asyncpg.Connection) -> None:
+  """Fail with the accounts to fix if usernames differ only by case, which the unique index can't be built over.
+  A non-unique index in its place would never be replaced, so they have to be renamed or merged first."""
+  records = await conn.fetch("""
+    SELECT lower(Username) AS username, array_agg(id ORDER BY id) AS ids FROM Users
+    GROUP BY lower(Username) HAVING count(*) > 1
+    ORDER BY lower(Username) LIMIT 50;
+  """)
+  if records:
+    duplicates = "\n".join(f"  {record['username']}: user ids {', '.join(map(str, record['ids']))}" for record in records)
+    raise RuntimeError(
+      "Usernames must be unique regardless of case, but these accounts share one (up to 50 shown). Rename them, "
+      f"then restart the server or run `python -m utils.migrate`:\n{duplicates}"
+    )
@@ -0,0 +1,16 @@
+# Trigram index on paste titles, used by title substring and regex search.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from utils.migrate import create_index_concurrently
+
+if TYPE_CHECKING:
+  import asyncpg
+
+TRANSACTIONAL = False
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+  await create_index_concurrently(conn, "pastes_title_trgm_idx", "Pastes", "USING gin (Title gin_trgm_ops)")
@@ -0,0 +1,71 @@
+# Full text search over paste titles and contents.
+#
+# A GENERATED ALWAYS ... STORED column can't be added to an existing table without
+# rewriting it under an ACCESS EXCLUSIVE lock, so SearchVector is a plain column kept
+# up to date by a trigger, backfilled in batches, and then indexed concurrently.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from utils.migrate import create_index_concurrently
+
+if TYPE_CHECKING:
+  import asyncpg
+
+TRANSACTIONAL = False
+BACKFILL_BATCH_SIZE = 1000
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  # Decode paste contents for indexing. Contents that are not valid UTF-8 are indexed
+  # by title only, and very large contents are truncated so the tsvector fits in its 1MB limit.
+  await conn.execute("""
+    CREATE OR REPLACE FUNCTION paste_search_text(content BYTEA) RETURNS TEXT
+    LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE AS $$
+    BEGIN
+      RETURN left(convert_from(content, 'UTF8'), 262144);
+    EXCEPTION WHEN OTHERS THEN
+      RETURN '';
+    END $$;
+  """)
+  await conn.execute("""
+    CREATE OR REPLACE FUNCTION paste_search_vector(title TEXT, content BYTEA) RETURNS TSVECTOR
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+      SELECT
+        setweight(to_tsvector('english'::regconfig, coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english'::regconfig, paste_search_text(content)), 'B')
+    $$;
+  """)
+  await conn.execute("ALTER TABLE Pastes ADD COLUMN IF NOT EXISTS SearchVector TSVECTOR;")
+  await conn.execute("""
+    CREATE OR REPLACE FUNCTION pastes_search_vector_trigger() RETURNS TRIGGER
+    LANGUAGE plpgsql AS $$
+    BEGIN
+      NEW.SearchVector := paste_search_vector(NEW.Title, NEW.Content);
+      RETURN NEW;
+    END $$;
+  """)
+  async with conn.transaction():
+    await conn.execute("DROP TRIGGER IF EXISTS pastes_search_vector_update ON Pastes;")
+    await conn.execute("""
+      CREATE TRIGGER pastes_search_vector_update
+        BEFORE INSERT OR UPDATE OF Title, Content ON Pastes
+        FOR EACH ROW EXECUTE FUNCTION pastes_search_vector_trigger();
+    """)
+
+  # Backfill existing rows in small batches, walking the primary key.
+  last_id = ""
+  while True:
+    last_id = await conn.fetchval("""
+      WITH batch AS (
+        SELECT id FROM Pastes WHERE id > $1 ORDER BY id LIMIT $2
+      ), updated AS (
+        UPDATE Pastes p SET SearchVector = paste_search_vector(p.Title, p.Content)
+        FROM batch WHERE p.id = batch.id AND p.SearchVector IS NULL
+      )
+      SELECT max(id) FROM batch;
+    """, last_id, BACKFILL_BATCH_SIZE)
+    if last_id is None:
+      break
+
+  await create_index_concurrently(conn, "pastes_searchvector_idx", "Pastes", "USING gin (SearchVector)")
@@ -0,0 +1,20 @@
+# Extend the listing indexes with id, so keyset pagination on (Created, id) is a
+# single index range scan.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from utils.migrate import create_index_concurrently
+
+if TYPE_CHECKING:
+  import asyncpg
+
+TRANSACTIONAL = False
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  await create_index_concurrently(conn, "pastes_creator_created_id_idx", "Pastes", "(Creator, Created, id)")
+  await create_index_concurrently(conn, "pastes_visibility_created_id_idx", "Pastes", "(Visibility, Created, id)")
+  await create_index_concurrently(conn, "pastes_created_id_idx", "Pastes", "(Created, id)")
+  await conn.execute("DROP INDEX CONCURRENTLY IF EXISTS pastes_creator_created_idx;")
+  await conn.execute("DROP INDEX CONCURRENTLY IF EXISTS pastes_visibility_created_idx;")
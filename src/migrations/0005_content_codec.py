@@ -0,0 +1,26 @@
+# Per row storage codec for paste contents (see utils/codec.py), and the uncompressed size.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  import asyncpg
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  # Constant defaults don't rewrite the table, so these are quick even on a big table.
+  await conn.execute("ALTER TABLE Pastes ADD COLUMN IF NOT EXISTS Codec SMALLINT NOT NULL DEFAULT 0;")
+  await conn.execute("ALTER TABLE Pastes ADD COLUMN IF NOT EXISTS Size BIGINT;")
+
+  # Postgres can't read compressed contents, so for those the writer computes SearchVector
+  # from the uncompressed content itself, and the trigger leaves it alone.
+  await conn.execute("""
+    CREATE OR REPLACE FUNCTION pastes_search_vector_trigger() RETURNS TRIGGER
+    LANGUAGE plpgsql AS $$
+    BEGIN
+      IF NEW.Codec = 0 THEN
+        NEW.SearchVector := paste_search_vector(NEW.Title, NEW.Content);
+      END IF;
+      RETURN NEW;
+    END $$;
+  """)
@@ -0,0 +1,98 @@
+# Move paste contents into PasteBlobs, keyed by the SHA-256 of the uncompressed content and
+# reference counted, so identical pastes share one stored copy.
+#
+# Pastes are moved over in batches, each in its own transaction so the reference counts are
+# always right, and the migration can be stopped and resumed. Pastes created behind the walk are
+# moved over with the table locked, just before the old columns are dropped.
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+from typing import TYPE_CHECKING
+
+from utils.codec import CODEC_IDENTITY, decompress
+
+if TYPE_CHECKING:
+  import asyncpg
+
+TRANSACTIONAL = False
+BATCH_SIZE = 500
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  await conn.execute("""
+    CREATE TABLE IF NOT EXISTS PasteBlobs (
+      Hash BYTEA PRIMARY KEY, -- SHA-256 of the uncompressed content
+      Content BYTEA NOT NULL, -- Encoded with Codec, see utils/codec.py
+      Codec SMALLINT NOT NULL DEFAULT 0,
+      Size BIGINT NOT NULL, -- Uncompressed size in bytes
+      RefCount BIGINT NOT NULL,
+      ContentVector TSVECTOR -- Full text search vector of the content, Pastes.SearchVector adds the title to it
+    );
+  """)
+  await conn.execute("ALTER TABLE Pastes ADD COLUMN IF NOT EXISTS ContentHash BYTEA;")
+  await conn.execute("""
+    CREATE OR REPLACE FUNCTION paste_title_vector(title TEXT) RETURNS TSVECTOR
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+      SELECT setweight(to_tsvector('english'::regconfig, coalesce(title, '')), 'A')
+    $$;
+  """)
+  # From now on writers build SearchVector from the blob's ContentVector.
+  await conn.execute("DROP TRIGGER IF EXISTS pastes_search_vector_update ON Pastes;")
+  await conn.execute("DROP FUNCTION IF EXISTS pastes_search_vector_trigger();")
+
+  last_id = ""
+  while True:
+    records = await conn.fetch("""
+      SELECT id, Content, Codec FROM Pastes
+      WHERE id > $1 AND ContentHash IS NULL
+      ORDER BY id LIMIT $2;
+    """, last_id, BATCH_SIZE)
+    if not records:
+      break
+    last_id = records[-1]["id"]
+    async with conn.transaction():
+      await _move_batch(conn, records)
+
+  async with conn.transaction():
+    await conn.execute("SET LOCAL lock_timeout = '5s';")
+    # Pastes created during the walk with an id before where it had got to were passed over. With the table
+    # locked no more can be created, so once these are moved too every paste points at a blob, and the old
+    # columns can go without taking any content with them.
+    await conn.execute("LOCK TABLE Pastes IN ACCESS EXCLUSIVE MODE;")
+    while records := await conn.fetch("""
+      SELECT id, Content, Codec FROM Pastes WHERE ContentHash IS NULL ORDER BY id LIMIT $1;
+    """, BATCH_SIZE):
+      await _move_batch(conn, records)
+    await conn.execute("ALTER TABLE Pastes DROP COLUMN IF EXISTS Content;")
+    await conn.execute("ALTER TABLE Pastes DROP COLUMN IF EXISTS Codec;")
+
+async def _move_batch(conn: asyncpg.Connection, records: list[asyncpg.Record]) -> None:
+  "Move the contents of a batch of pastes into PasteBlobs. Must be called in a transaction."
+  loop = asyncio.get_running_loop()
+  rows = await loop.run_in_executor(None, _hash_batch, records)
+  await conn.executemany("""
+    INSERT INTO PasteBlobs (Hash, Content, Codec, Size, RefCount, ContentVector)
+    VALUES ($1, $2, $3, $4, 1, paste_search_vector(NULL, coalesce($5, $2)))
+    ON CONFLICT (Hash) DO UPDATE SET RefCount = PasteBlobs.RefCount + 1;
+  """, [(hash, content, codec, size, plain) for _, hash, content, codec, size, plain in rows])
+  await conn.executemany("""
+    UPDATE Pastes SET ContentHash = $2, Size = $3, Content = NULL
+    WHERE id = $1 AND ContentHash IS NULL;
+  """, [(id, hash, size) for id, hash, _, _, size, _ in rows])
+
+def _hash_batch(records: list[asyncpg.Record]) -> list[tuple]:
+  "Returns (id, hash, stored content, codec, size, uncompressed content if compressed) for each paste."
+  rows = []
+  for record in records:
+    content = record["content"] or b""
+    plain = decompress(content, record["codec"])
+    rows.append((
+      record["id"],
+      hashlib.sha256(plain).digest(),
+      content,
+      record["codec"],
+      len(plain),
+      plain if record["codec"] != CODEC_IDENTITY else None
+    ))
+  return rows
@@ -0,0 +1,21 @@
+# Large paste contents are stored split into PasteBlobChunks, so they can be written and read
+# back a chunk at a time. For those, PasteBlobs.Chunks is the number of chunks and
+# PasteBlobs.Content is empty. The chunks hold the blob's stored bytes, encoded with its Codec.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  import asyncpg
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  await conn.execute("ALTER TABLE PasteBlobs ADD COLUMN IF NOT EXISTS Chunks INT NOT NULL DEFAULT 0;")
+  await conn.execute("""
+    CREATE TABLE IF NOT EXISTS PasteBlobChunks (
+      Hash BYTEA NOT NULL REFERENCES PasteBlobs (Hash) ON DELETE CASCADE,
+      Seq INT NOT NULL,
+      Content BYTEA NOT NULL,
+      PRIMARY KEY (Hash, Seq)
+    );
+  """)
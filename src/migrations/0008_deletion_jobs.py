@@ -0,0 +1,27 @@
+# Deleting accounts, and a user's pastes in bulk, is done in the background a batch at a time.
+# DeletionJobs is the queue, so that jobs carry on after a restart. Deleted users are
+# tombstoned with Users.Deleted until their pastes are gone.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  import asyncpg
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  await conn.execute("ALTER TABLE Users ADD COLUMN IF NOT EXISTS Deleted BIGINT;")
+  await conn.execute("""
+    CREATE TABLE IF NOT EXISTS DeletionJobs (
+      id BIGSERIAL PRIMARY KEY,
+      Creator BIGINT NOT NULL, -- Whose pastes are deleted
+      Folder TEXT, -- Only the pastes in this folder, or all of them if NULL
+      DeleteUser BOOLEAN NOT NULL DEFAULT FALSE, -- Delete the tombstoned user once their pastes are gone
+      Total BIGINT NOT NULL DEFAULT 0, -- Pastes to delete when the job was queued
+      Deleted BIGINT NOT NULL DEFAULT 0, -- Pastes deleted so far
+      Created BIGINT NOT NULL,
+      Finished BIGINT
+    );
+  """)
+  await conn.execute("CREATE INDEX IF NOT EXISTS deletionjobs_unfinished_idx ON DeletionJobs (id) WHERE Finished IS NULL;")
+  await conn.execute("CREATE INDEX IF NOT EXISTS deletionjobs_creator_idx ON DeletionJobs (Creator);")
@@ -0,0 +1,12 @@
+# Per paste view counts. Views are counted in memory and added on in batches (see PGUtils.flush_views).
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  import asyncpg
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  # A constant default doesn't rewrite the table. Views isn't indexed, so the batched updates can be HOT updates.
+  await conn.execute("ALTER TABLE Pastes ADD COLUMN IF NOT EXISTS Views BIGINT NOT NULL DEFAULT 0;")
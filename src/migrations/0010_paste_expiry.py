@@ -0,0 +1,17 @@
+# Pastes can be given an expiry time, after which reads leave them out and a background
+# sweeper deletes them. The index only covers pastes that expire, so it stays small.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from utils.migrate import create_index_concurrently
+
+if TYPE_CHECKING:
+  import asyncpg
+
+TRANSACTIONAL = False
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  await conn.execute("ALTER TABLE Pastes ADD COLUMN IF NOT EXISTS Expires BIGINT;")
+  await create_index_concurrently(conn, "pastes_expires_idx", "Pastes", "(Expires) WHERE Expires IS NOT NULL")
@@ -0,0 +1,100 @@
+# Partition Pastes by month of creation, so vacuum, index maintenance and backups work on a month of pastes at a
+# time, listings newest first only read the newest partitions, and old months can be detached as a unit.
+# Needs Postgres 14 or later.
+#
+# The existing table isn't copied. It becomes the first partition, pastes_legacy, holding everything created before
+# the month after next, and new monthly partitions follow it (see utils/partitions.py). A validated CHECK
+# constraint proves its rows fit, so attaching it doesn't scan it, and the swap itself is catalog changes only.
+#
+# A partitioned table's unique keys have to include the partition key, so the primary key on id can't carry over.
+# PasteIds takes its place: it holds each paste's id, keeping them unique, and its Created, which tells queries by
+# id which partition to look in. Other servers still running older code must be stopped first, their inserts rely
+# on the primary key.
+
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING
+
+from utils.partitions import LEGACY_PARTITION, create_partitions, months_from
+
+if TYPE_CHECKING:
+  import asyncpg
+
+TRANSACTIONAL = False
+BATCH_SIZE = 5000
+# Partitions created by the migration, [paste.partitions] months_ahead takes over once the server is up.
+MONTHS_AHEAD = 3
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  await conn.execute("""
+    CREATE TABLE IF NOT EXISTS PasteIds (
+      id TEXT PRIMARY KEY,
+      Created BIGINT NOT NULL -- Same as the paste's, so its partition can be found
+    );
+  """)
+  if not await conn.fetchval("SELECT relkind = 'p' FROM pg_class WHERE oid = 'pastes'::regclass;"):
+    await _swap(conn)
+  await _create_indexes(conn)
+  await create_partitions(conn, until=months_from(int(time.time()), MONTHS_AHEAD))
+
+async def _swap(conn: asyncpg.Connection) -> None:
+  "Turn Pastes into the legacy partition of a new, partitioned, Pastes."
+  # Rows with no Created would have no partition to go in.
+  await conn.execute("UPDATE Pastes SET Created = coalesce(Modified, 0) WHERE Created IS NULL;")
+
+  # Fill PasteIds a batch at a time, carrying on from where an interrupted run got to.
+  started = int(time.time())
+  last = await conn.fetchval("SELECT max(id) FROM PasteIds;") or ""
+  while last is not None:
+    last = await conn.fetchval("""
+      WITH batch AS (SELECT id, Created FROM Pastes WHERE id > $1 ORDER BY id LIMIT $2),
+      inserted AS (INSERT INTO PasteIds (id, Created) SELECT id, Created FROM batch ON CONFLICT (id) DO NOTHING)
+      SELECT max(id) FROM batch;
+    """, last, BATCH_SIZE)
+
+  # The constraint's name holds the bound, so a re-run uses the one that was validated.
+  check = await conn.fetchval("""
+    SELECT conname FROM pg_constraint WHERE conrelid = 'pastes'::regclass AND conname LIKE 'pastes_created_before_%';
+  """)
+  if check is None:
+    # Far enough ahead that pastes created during the migration still fit.
+    bound = months_from(started, 2)
+    check = f"pastes_created_before_{bound}"
+    await conn.execute(f"ALTER TABLE Pastes ADD CONSTRAINT {check} CHECK (Created IS NOT NULL AND Created < {bound}) NOT VALID;")
+  bound = int(check.removeprefix("pastes_created_before_"))
+  await conn.execute(f"ALTER TABLE Pastes VALIDATE CONSTRAINT {check};")
+
+  indexes = await conn.fetch("""
+    SELECT c.relname FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+    WHERE x.indrelid = 'pastes'::regclass AND NOT x.indisunique;
+  """)
+  async with conn.transaction():
+    await conn.execute("SET LOCAL lock_timeout = '5s';")
+    # Proven by the check constraint, so this doesn't scan the table either.
+    await conn.execute("ALTER TABLE Pastes ALTER COLUMN Created SET NOT NULL;")
+    await conn.execute(f"ALTER TABLE Pastes RENAME TO {LEGACY_PARTITION};")
+    # Pastes' indexes keep their names, and are made up of these.
+    for record in indexes:
+      await conn.execute(f"ALTER INDEX {record['relname']} RENAME TO {LEGACY_PARTITION}_{record['relname'].removeprefix('pastes_')};")
+    await conn.execute(f"CREATE TABLE Pastes (LIKE {LEGACY_PARTITION} INCLUDING DEFAULTS) PARTITION BY RANGE (Created);")
+    await conn.execute(f"ALTER TABLE Pastes ATTACH PARTITION {LEGACY_PARTITION} FOR VALUES FROM (MINVALUE) TO ({bound});")
+    await conn.execute(f"ALTER TABLE {LEGACY_PARTITION} DROP CONSTRAINT {check};")
+    # Pastes created while PasteIds was being filled.
+    await conn.execute(f"""
+      INSERT INTO PasteIds (id, Created) SELECT id, Created FROM {LEGACY_PARTITION} WHERE Created >= $1
+      ON CONFLICT (id) DO NOTHING;
+    """, started)
+
+async def _create_indexes(conn: asyncpg.Connection) -> None:
+  """Give Pastes each of the legacy partition's indexes. The legacy partition's own index is attached rather than
+  built again, so this is quick. Its primary key stays its own, unique indexes can't be carried over."""
+  records = await conn.fetch("""
+    SELECT c.relname, pg_get_indexdef(x.indexrelid) AS definition FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+    WHERE x.indrelid = to_regclass($1) AND NOT x.indisunique
+      AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = x.indexrelid);
+  """, LEGACY_PARTITION)
+  for record in records:
+    name = "pastes_" + record["relname"].removeprefix(f"{LEGACY_PARTITION}_")
+    using = record["definition"].split(" USING ", 1)[1]
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON Pastes USING {using};")
@@ -0,0 +1,27 @@
+# Contents nobody has read in a while can be moved out of PasteBlobs into files (see utils/coldstore.py).
+# PasteBlobs.ColdPath points at a blob's file once it has been moved, and LastRead is when one of its pastes was
+# last read. Files of blobs that have gone wait in ColdBlobDeletions until the cold storage job removes them.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from utils.migrate import create_index_concurrently
+
+if TYPE_CHECKING:
+  import asyncpg
+
+TRANSACTIONAL = False
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  await conn.execute("ALTER TABLE PasteBlobs ADD COLUMN IF NOT EXISTS ColdPath TEXT;")
+  # now() is only evaluated once for the existing rows, so this doesn't rewrite the table.
+  await conn.execute("ALTER TABLE PasteBlobs ADD COLUMN IF NOT EXISTS LastRead BIGINT NOT NULL DEFAULT extract(epoch FROM now())::BIGINT;")
+  await conn.execute("""
+    CREATE TABLE IF NOT EXISTS ColdBlobDeletions (
+      Hash BYTEA PRIMARY KEY,
+      Path TEXT NOT NULL -- Relative to [paste.cold_storage] path
+    );
+  """)
+  # The blobs waiting to be moved, oldest read first. The size matches COLD_MIN_SIZE in utils/coldstore.py.
+  await create_index_concurrently(conn, "pasteblobs_lastread_idx", "PasteBlobs", "(LastRead) WHERE ColdPath IS NULL AND Size >= 4096")
@@ -0,0 +1,14 @@
+# Bulk paste deletions only delete the pastes that existed when they were asked for. DeletionJobs.CreatedBefore
+# holds that bound, or NULL for account deletions, which take everything since the user can't create any more.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  import asyncpg
+
+async def upgrade(conn: asyncpg.Connection) -> None:
+  await conn.execute("ALTER TABLE DeletionJobs ADD COLUMN IF NOT EXISTS CreatedBefore BIGINT;")
+  # Jobs queued before this was added are bounded by when they were queued.
+  await conn.execute("UPDATE DeletionJobs SET CreatedBefore = Created WHERE NOT DeleteUser AND Finished IS NULL AND CreatedBefore IS NULL;")
@@ -0,0 +1,97 @@
+# In-process caches.
+
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from typing import Any, Hashable
+
+class TTLCache:
+  """A least recently used cache whose entries also expire after a time to live.
+  Entries can be tagged, such as with the user they belong to, so that a whole group can be dropped at once.
+
+  To avoid caching a value that was invalidated while it was being looked up, read `generation`
+  before the lookup and pass it to `set`. The value is then only cached if nothing was invalidated in between."""
+  max_size: int
+  ttl: float
+  hits: int
+  misses: int
+  evictions: int # Entries dropped to make room, rather than expired or invalidated.
+  generation: int
+
+  def __init__(self, *, max_size: int, ttl: float) -> None:
+    self.max_size = max_size
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.generation = 0
+    self._entries: OrderedDict[Hashable,tuple[float,Any,Hashable]] = OrderedDict() # key: (expires, value, tag)
+    self._tags: dict[Hashable,set[Hashable]] = {}
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def get(self, key: Hashable, default: Any = None) -> Any:
+    entry = self._entries.get(key)
+    if entry is None or entry[0] < time.monotonic():
+      if entry is not None:
+        self._remove(key)
+      self.misses += 1
+      return default
+    self._entries.move_to_end(key)
+    self.hits += 1
+    return entry[1]
+
+  def set(self, key: Hashable, value: Any, *, ttl: float = None, tag: Hashable = None, generation: int = None) -> None:
+    if generation is not None and generation != self.generation:
+      return
+    if key in self._entries:
+      self._remove(key)
+    self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value, tag)
+    if tag is not None:
+      self._tags.setdefault(tag, set()).add(key)
+    while len(self._entries) > self.max_size:
+      self._remove(next(iter(self._entries)))
+      self.evictions += 1
+
+  def delete(self, key: Hashable) -> None:
+    self.generation += 1
+    if key in self._entries:
+      self._remove(key)
+
+  def delete_tag(self, tag: Hashable) -> None:
+    "Drop every entry tagged with `tag`."
+    self.generation += 1
+    for key in self._tags.pop(tag, ()):
+      self._entries.pop(key, None)
+
+  def clear(self) -> None:
+    self.generation += 1
+    self._entries.clear()
+    self._tags.clear()
+
+  @property
+  def stats(self) -> dict[str,Any]:
+    "A snapshot of the cache's counters. Reading it changes nothing."
+    lookups = self.hits + self.misses
+    return {
+      "size": len(self._entries),
+      "max_size": self.max_size,
+      "hits": self.hits,
+      "misses": self.misses,
+      "evictions": self.evictions,
+      "hit_rate": self.hits / lookups if lookups else 0.0,
+    }
+
+  def _remove(self, key: Hashable) -> None:
+    _, _, tag = self._entries.pop(key)
+    if tag is not None:
+      keys = self._tags.get(tag)
+      if keys is not None:
+        keys.discard(key)
+        if not keys:
+          del self._tags[tag]
@@ -0,0 +1,192 @@
+# Storage codecs for paste contents.
+#
+# Paste contents are stored compressed when that saves space. The codec is stored per blob in
+# PasteBlobs.Codec. Gzip is used so that stored bytes can be sent straight to clients with
+# `Content-Encoding: gzip`, without decompressing and recompressing them.
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import tempfile
+import tomllib
+import zlib
+from typing import TYPE_CHECKING
+
+from aiohttp import web
+
+from utils.utils import accepts_encoding
+
+if TYPE_CHECKING:
+  from typing import AsyncIterator, Mapping
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  storage_config = config["paste"].get("storage", {})
+  COMPRESS = storage_config.get("compress", True)
+  COMPRESS_MIN_SIZE = storage_config.get("compress_min_size", 1024)
+  COMPRESS_LEVEL = storage_config.get("compress_level", 6)
+  # Contents larger than this are stored and sent in chunks of this many (stored) bytes.
+  CHUNK_SIZE = storage_config.get("chunk_size", 1024 * 1024)
+  # Largest paste that can be uploaded as a stream, in bytes.
+  MAX_PASTE_SIZE = storage_config.get("max_size", 100 * 1024 * 1024)
+
+CODEC_IDENTITY = 0
+CODEC_GZIP = 1
+
+# HTTP Content-Encoding for each codec that browsers can decode themselves.
+CONTENT_ENCODINGS = {
+  CODEC_GZIP: "gzip",
+}
+
+# Compressing or decompressing more than this is done in an executor, to keep the event loop free.
+EXECUTOR_THRESHOLD = 64 * 1024
+
+def compress(data: bytes, codec: int) -> bytes:
+  if codec == CODEC_IDENTITY:
+    return data
+  if codec == CODEC_GZIP:
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+  raise ValueError(f"Unknown codec {codec}")
+
+def decompress(data: bytes, codec: int) -> bytes:
+  if codec == CODEC_IDENTITY:
+    return data
+  if codec == CODEC_GZIP:
+    return zlib.decompress(data, 31)
+  raise ValueError(f"Unknown codec {codec}")
+
+def decompress_prefix(data: bytes, codec: int, max_length: int) -> bytes:
+  "Decompress the start of a possibly truncated stored content, returning at most `max_length` bytes."
+  if codec == CODEC_IDENTITY:
+    return data[:max_length]
+  if codec == CODEC_GZIP:
+    return zlib.decompressobj(31).decompress(data, max_length)
+  raise ValueError(f"Unknown codec {codec}")
+
+def encode(data: bytes) -> tuple[int,bytes]:
+  "Pick the codec to store `data` with, and return it with the stored bytes."
+  if not COMPRESS or len(data) < COMPRESS_MIN_SIZE:
+    return CODEC_IDENTITY, data
+  compressed = compress(data, CODEC_GZIP)
+  # Not worth the CPU to decompress on every read if it barely shrank.
+  if len(compressed) > len(data) * 0.9:
+    return CODEC_IDENTITY, data
+  return CODEC_GZIP, compressed
+
+async def aencode(data: bytes) -> tuple[int,bytes]:
+  if len(data) < EXECUTOR_THRESHOLD:
+    return encode(data)
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, encode, data)
+
+async def adecompress(data: bytes, codec: int) -> bytes:
+  if codec == CODEC_IDENTITY or len(data) < EXECUTOR_THRESHOLD:
+    return decompress(data, codec)
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, decompress, data, codec)
+
+async def decompress_stream(chunks: AsyncIterator[bytes], codec: int) -> AsyncIterator[bytes]:
+  "Decompress stored content a chunk at a time."
+  if codec == CODEC_IDENTITY:
+    async for chunk in chunks:
+      yield chunk
+    return
+  if codec != CODEC_GZIP:
+    raise ValueError(f"Unknown codec {codec}")
+  decompressor = zlib.decompressobj(31)
+  loop = asyncio.get_running_loop()
+  async for chunk in chunks:
+    if len(chunk) < EXECUTOR_THRESHOLD:
+      yield decompressor.decompress(chunk)
+    else:
+      yield await loop.run_in_executor(None, decompressor.decompress, chunk)
+  yield decompressor.flush()
+
+class StreamEncoder:
+  """Hashes, measures and encodes content that arrives in pieces, such as a request body.
+  The stored bytes are spooled to a temporary file, so only about `CHUNK_SIZE` of the content is held in memory.
+  `prefix` keeps the first `prefix_length` bytes of the content as it is, for indexing it."""
+  codec: int
+  size: int # Of the content as it is.
+  stored_size: int # Of the content as stored.
+  prefix: bytearray
+
+  def __init__(self, *, prefix_length: int = 0) -> None:
+    # There is no telling whether compression pays off before the content has been seen. Anything
+    # streamed is large, so it is always compressed.
+    self.codec = CODEC_GZIP if COMPRESS else CODEC_IDENTITY
+    self.size = 0
+    self.stored_size = 0
+    self.prefix = bytearray()
+    self._prefix_length = prefix_length
+    self._hash = hashlib.sha256()
+    self._compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31) if self.codec == CODEC_GZIP else None
+    self._file = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE)
+
+  def _write(self, data: bytes) -> None:
+    self._hash.update(data)
+    self.size += len(data)
+    if len(self.prefix) < self._prefix_length:
+      self.prefix += data[:self._prefix_length-len(self.prefix)]
+    if self._compressor:
+      data = self._compressor.compress(data)
+    self._file.write(data)
+    self.stored_size += len(data)
+
+  async def write(self, data: bytes) -> None:
+    if len(data) < EXECUTOR_THRESHOLD:
+      return self._write(data)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, self._write, data)
+
+  def finish(self) -> bytes:
+    "Call once all of the content has been written. Returns its SHA-256 digest."
+    if self._compressor:
+      tail = self._compressor.flush()
+      self._file.write(tail)
+      self.stored_size += len(tail)
+      self._compressor = None
+    self._file.seek(0)
+    return self._hash.digest()
+
+  async def chunks(self) -> AsyncIterator[bytes]:
+    "The stored bytes in chunks of `CHUNK_SIZE`, after `finish()`."
+    loop = asyncio.get_running_loop()
+    while chunk := await loop.run_in_executor(None, self._file.read, CHUNK_SIZE):
+      yield chunk
+
+  def close(self) -> None:
+    self._file.close()
+
+async def content_response(request: web.Request, codec: int, chunks: AsyncIterator[bytes], *, size: int = None, content_type: str = "text/plain", headers: Mapping[str,str] = None, path: str = None) -> web.StreamResponse:
+  """Stream stored paste content to the client a chunk at a time. If the client can decode the codec itself, the
+  stored bytes are sent as they are with a matching Content-Encoding, otherwise they are decompressed on the way.
+  `size` is the uncompressed size, sent as the Content-Length when the content is sent uncompressed.
+  `path` is the content's file if it is in cold storage, which is sent with sendfile when it can be sent as it is."""
+  encoding = CONTENT_ENCODINGS.get(codec)
+  if path is not None and (codec == CODEC_IDENTITY or (encoding and accepts_encoding(request, encoding))):
+    response = web.FileResponse(path, headers={
+      **(headers or {}),
+      "Vary": "Accept-Encoding",
+      "Content-Type": f"{content_type}; charset=utf-8",
+    })
+    if encoding:
+      response.headers["Content-Encoding"] = encoding
+    return response
+
+  response = web.StreamResponse(headers={**(headers or {}), "Vary": "Accept-Encoding"})
+  response.content_type = content_type
+  response.charset = "utf-8"
+  if encoding and accepts_encoding(request, encoding):
+    response.headers["Content-Encoding"] = encoding
+  else:
+    chunks = decompress_stream(chunks, codec)
+    if size is not None:
+      response.content_length = size
+  await response.prepare(request)
+  async for chunk in chunks:
+    await response.write(chunk)
+  await response.write_eof()
+  return response
@@ -0,0 +1,91 @@
+# Cold storage for paste contents nobody has read in a while.
+#
+# A cold blob's stored bytes, encoded with its codec as they would be in the database, are moved out of PasteBlobs
+# into a file under [paste.cold_storage] path, named by the content hash, and PasteBlobs.ColdPath points at it.
+# Those files are sent to clients with sendfile (see `content_response` in utils/codec.py). Every server reads the
+# same files, so with more than one server the directory has to be shared storage.
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import os
+import tempfile
+import tomllib
+from typing import TYPE_CHECKING
+
+from utils.codec import CHUNK_SIZE, CODEC_GZIP
+
+if TYPE_CHECKING:
+  from typing import AsyncIterator
+
+with open("config.toml") as f:
+  cold_config = tomllib.loads(f.read())["paste"].get("cold_storage", {})
+  COLD_STORAGE_PATH = cold_config.get("path", "")
+  COLD_AFTER_DAYS = cold_config.get("after_days", 30)
+  COLD_BATCH_SIZE = cold_config.get("batch_size", 100)
+
+# Smaller contents stay in the database, a file would take more space than they do. Matches the index in migration 0012.
+COLD_MIN_SIZE = 4096
+# A blob's LastRead is only updated when it is at least this many seconds old, to save writes on popular pastes.
+LAST_READ_RESOLUTION = 3600
+
+def cold_path(content_hash: bytes, codec: int) -> str:
+  "Where a blob's file goes, relative to the cold storage directory. Gzipped ones end in .gz."
+  name = content_hash.hex()
+  return os.path.join(name[:2], name[2:4], name + (".gz" if codec == CODEC_GZIP else ""))
+
+def full_path(path: str) -> str:
+  return os.path.join(COLD_STORAGE_PATH, path)
+
+async def write_file(path: str, chunks: AsyncIterator[bytes]) -> None:
+  """Write a blob's stored bytes to its file a chunk at a time. It is written to a temporary file and renamed into
+  place once synced, so the file at `path` is always whole."""
+  loop = asyncio.get_running_loop()
+  target = full_path(path)
+  await loop.run_in_executor(None, lambda: os.makedirs(os.path.dirname(target), exist_ok=True))
+  fd, temp = await loop.run_in_executor(None, lambda: tempfile.mkstemp(dir=os.path.dirname(target), prefix=".tmp-"))
+  try:
+    with os.fdopen(fd, "wb") as f:
+      async for chunk in chunks:
+        await loop.run_in_executor(None, f.write, chunk)
+      await loop.run_in_executor(None, f.flush)
+      await loop.run_in_executor(None, os.fsync, f.fileno())
+    await loop.run_in_executor(None, os.replace, temp, target)
+  except BaseException:
+    with contextlib.suppress(FileNotFoundError):
+      os.unlink(temp)
+    raise
+
+async def read_chunks(path: str) -> AsyncIterator[bytes]:
+  "A blob's stored bytes from its file, in chunks of CHUNK_SIZE."
+  loop = asyncio.get_running_loop()
+  f = await loop.run_in_executor(None, open, full_path(path), "rb")
+  try:
+    while chunk := await loop.run_in_executor(None, f.read, CHUNK_SIZE):
+      yield chunk
+  finally:
+    f.close()
+
+async def read_file(path: str) -> bytes:
+  "All of a blob's stored bytes from its file."
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, _read, full_path(path), -1)
+
+async def read_prefix(path: str, length: int) -> bytes:
+  "The first `length` of a blob's stored bytes from its file."
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, _read, full_path(path), length)
+
+def _read(path: str, length: int) -> bytes:
+  with open(path, "rb") as f:
+    return f.read(length)
+
+async def remove_files(paths: list[str]) -> None:
+  "Remove blobs' files, ignoring ones that are already gone."
+  def remove():
+    for path in paths:
+      with contextlib.suppress(FileNotFoundError):
+        os.unlink(full_path(path))
+  loop = asyncio.get_running_loop()
+  await loop.run_in_executor(None, remove)
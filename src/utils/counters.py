@@ -0,0 +1,34 @@
+# In-process counters, written to the database in batches rather than on every increment.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from typing import Hashable
+
+class Counter:
+  "Increments gathered per key since they were last taken, to be written out together."
+  def __init__(self) -> None:
+    self._counts: dict[Hashable,int] = {}
+
+  def __len__(self) -> int:
+    return len(self._counts)
+
+  def add(self, key: Hashable, n: int = 1) -> int:
+    "Add `n` to the key's count, returning the count not yet taken."
+    count = self._counts[key] = self._counts.get(key, 0) + n
+    return count
+
+  def pending(self, key: Hashable) -> int:
+    return self._counts.get(key, 0)
+
+  def take(self) -> dict[Hashable,int]:
+    "Take all of the counts, starting again from nothing."
+    counts, self._counts = self._counts, {}
+    return counts
+
+  def restore(self, counts: dict[Hashable,int]) -> None:
+    "Put back counts that were taken but couldn't be written."
+    for key, n in counts.items():
+      self.add(key, n)
@@ -0,0 +1,222 @@
+# Exporting and importing a user's pastes, streamed a paste at a time rather than assembled first.
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import binascii
+import contextlib
+import json
+import tempfile
+import time
+import tomllib
+import zipfile
+from typing import TYPE_CHECKING
+
+from aiohttp import web
+
+from utils.codec import CHUNK_SIZE, EXECUTOR_THRESHOLD, MAX_PASTE_SIZE, decompress_stream
+from utils.paste import Paste
+from utils.utils import Visibility
+
+if TYPE_CHECKING:
+  from typing import IO, Any, AsyncIterator
+
+  import aiohttp
+
+  from utils.paste import PasteMetadata
+  from utils.pg import PGUtils
+  from utils.user import User
+
+with open("config.toml") as f:
+  import_config = tomllib.loads(f.read())["paste"].get("import", {})
+  IMPORT_MAX_SIZE = import_config.get("max_size", 1024 * 1024 * 1024)
+  IMPORT_MAX_LINES = import_config.get("max_lines", 100000)
+
+# Zip timestamps can't be before 1980.
+ZIP_EPOCH = 315532800
+# Imported pastes are inserted this many at a time, or fewer if their contents add up to IMPORT_BATCH_BYTES.
+IMPORT_BATCH_SIZE = 500
+IMPORT_BATCH_BYTES = 16 * 1024 * 1024
+# Longest NDJSON line accepted, enough for the largest paste once JSON escaped or base64 encoded.
+MAX_LINE_SIZE = MAX_PASTE_SIZE * 2
+# Fields of each NDJSON line, besides the content.
+EXPORT_FIELDS = ("id", "title", "visibility", "created", "modified", "syntax", "tags", "folder", "expires")
+
+class PasteImportError(ValueError):
+  "An NDJSON import line that can't be imported."
+
+class ImportTooLargeError(PasteImportError):
+  "An NDJSON import over [paste.import] max_size or max_lines."
+
+class _ZipOutput:
+  """Where zipfile writes an archive to, with the bytes taken out again by `take` and sent on.
+  It can't seek, so zipfile writes each entry's sizes after its data instead of going back for them."""
+  def __init__(self) -> None:
+    self._buffer = bytearray()
+
+  def write(self, data: bytes) -> int:
+    self._buffer += data
+    return len(data)
+
+  def flush(self) -> None:
+    pass
+
+  def take(self) -> bytes:
+    data = bytes(self._buffer)
+    self._buffer.clear()
+    return data
+
+async def datadump_response(request: web.Request, pg: PGUtils, user: User) -> web.StreamResponse:
+  """Stream a zip of all of the user's pastes, one `{title} ({id}).txt` file each. The zip is built as the pastes are
+  read from the database and sent as it is built, so only about a chunk of content is held at a time, and nothing
+  touches the disk."""
+  response = web.StreamResponse(headers={"Content-Disposition": "attachment;filename=pastes.zip"})
+  response.content_type = "application/zip"
+  await response.prepare(request)
+
+  loop = asyncio.get_running_loop()
+  output = _ZipOutput()
+  with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+    async with contextlib.aclosing(pg.iter_paste_contents(creator=user.id)) as pastes:
+      async for paste, codec, chunks in pastes:
+        # Titles can have slashes, which would put the file in a folder.
+        name = f"{paste.title} ({paste.id}).txt".replace("/", "_").replace("\\", "_")
+        info = zipfile.ZipInfo(name, time.gmtime(max(paste.modified or 0, ZIP_EPOCH))[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.file_size = paste.size or 0 # Only used to decide whether the entry needs zip64.
+        with archive.open(info, "w") as entry:
+          async for data in decompress_stream(chunks, codec):
+            if len(data) < EXECUTOR_THRESHOLD:
+              entry.write(data)
+            else:
+              await loop.run_in_executor(None, entry.write, data)
+            await response.write(output.take())
+        await response.write(output.take())
+  await response.write(output.take())
+  await response.write_eof()
+  return response
+
+async def ndjson_export_response(request: web.Request, pg: PGUtils, user: User) -> web.StreamResponse:
+  """Stream all of the user's pastes as NDJSON, one paste with its metadata per line, oldest first.
+  Content is in `content`, or `content_base64` if it isn't UTF-8. Only one paste is held at a time."""
+  response = web.StreamResponse(headers={"Content-Disposition": "attachment;filename=pastes.ndjson"})
+  response.content_type = "application/x-ndjson"
+  response.charset = "utf-8"
+  await response.prepare(request)
+
+  async with contextlib.aclosing(pg.iter_paste_contents(creator=user.id)) as pastes:
+    async for paste, codec, chunks in pastes:
+      data = b"".join([data async for data in decompress_stream(chunks, codec)])
+      await response.write(_export_line(paste, data))
+  await response.write_eof()
+  return response
+
+def _export_line(paste: PasteMetadata, data: bytes) -> bytes:
+  item: dict[str,Any] = {field: getattr(paste, field) for field in EXPORT_FIELDS}
+  try:
+    item["content"] = data.decode()
+  except UnicodeDecodeError:
+    item["content_base64"] = base64.b64encode(data).decode()
+  return json.dumps(item).encode() + b"\n"
+
+async def stage_import(stream: aiohttp.StreamReader) -> IO[bytes]:
+  """Copy an NDJSON import from `stream`, such as a request body, to a temporary file, and return it ready to read
+  with `ndjson_import_batches`. The import is then read from there, so a slow upload doesn't keep a database
+  connection and its transaction waiting. The caller closes the file.
+  Raises ImportTooLargeError once it is over [paste.import] max_size or max_lines."""
+  loop = asyncio.get_running_loop()
+  file = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE)
+  size = 0
+  lines = 0
+  try:
+    async for data in stream.iter_chunked(65536):
+      size += len(data)
+      lines += data.count(b"\n")
+      if size > IMPORT_MAX_SIZE:
+        raise ImportTooLargeError(f"import too large, the limit is {IMPORT_MAX_SIZE} bytes")
+      if lines > IMPORT_MAX_LINES:
+        raise ImportTooLargeError(f"too many lines, the limit is {IMPORT_MAX_LINES}")
+      if len(data) < EXECUTOR_THRESHOLD:
+        file.write(data)
+      else:
+        await loop.run_in_executor(None, file.write, data)
+    file.seek(0)
+  except BaseException:
+    file.close()
+    raise
+  return file
+
+async def ndjson_import_batches(file: IO[bytes]) -> AsyncIterator[list[Paste]]:
+  """Read pastes in the format `ndjson_export_response` writes from `file`, as staged by `stage_import`, in batches.
+  Raises PasteImportError on the first line that can't be imported."""
+  batch: list[Paste] = []
+  batch_bytes = 0
+  async for number, line in _ndjson_lines(file):
+    paste = _import_paste(number, line)
+    batch.append(paste)
+    batch_bytes += len(paste.data)
+    if len(batch) >= IMPORT_BATCH_SIZE or batch_bytes >= IMPORT_BATCH_BYTES:
+      yield batch
+      batch = []
+      batch_bytes = 0
+  if batch:
+    yield batch
+
+async def _ndjson_lines(file: IO[bytes]) -> AsyncIterator[tuple[int,bytes]]:
+  "The non empty lines of `file`, numbered from 1. Only one line is held at a time."
+  loop = asyncio.get_running_loop()
+  buffer = bytearray()
+  number = 0
+  while data := await loop.run_in_executor(None, file.read, 65536):
+    buffer += data
+    start = 0
+    while (end := buffer.find(b"\n", start)) != -1:
+      number += 1
+      if buffer[start:end].strip():
+        yield number, bytes(buffer[start:end])
+      start = end + 1
+    del buffer[:start]
+    if len(buffer) > MAX_LINE_SIZE:
+      raise PasteImportError(f"line {number+1}: line too long")
+  if buffer.strip():
+    yield number + 1, bytes(buffer)
+
+def _import_paste(number: int, line: bytes) -> Paste:
+  try:
+    item = json.loads(line)
+  except ValueError:
+    raise PasteImportError(f"line {number}: invalid json")
+  if type(item) is not dict or not item.get("title") or ("content" not in item and "content_base64" not in item):
+    raise PasteImportError(f"line {number}: missing title or content")
+  try:
+    if "content" in item:
+      data = str(item["content"]).encode()
+    else:
+      data = base64.b64decode(item["content_base64"], validate=True)
+    visibility = int(item.get("visibility", Visibility.UNLISTED.value))
+    created = int(item["created"]) if item.get("created") else None
+    modified = int(item["modified"]) if item.get("modified") else None
+    expires = int(item["expires"]) if item.get("expires") else None
+  except (TypeError, ValueError, binascii.Error):
+    raise PasteImportError(f"line {number}: invalid field")
+  if visibility not in (Visibility.PUBLIC.value, Visibility.UNLISTED.value, Visibility.PRIVATE.value):
+    raise PasteImportError(f"line {number}: invalid visibility")
+  # Stored as BIGINT, anything outside it would fail the whole import.
+  if not all(value is None or 0 <= value < 1 << 63 for value in (created, modified, expires)):
+    raise PasteImportError(f"line {number}: invalid field")
+  if len(data) > MAX_PASTE_SIZE:
+    raise PasteImportError(f"line {number}: paste too large")
+  return Paste(
+    id=str(item.get("id") or ""),
+    creator=None,
+    data=data,
+    visibility=visibility,
+    title=str(item["title"]),
+    created=created,
+    modified=modified,
+    syntax=str(item.get("syntax") or "plaintext"),
+    tags=str(item.get("tags") or ""),
+    folder=str(item.get("folder") or ""),
+    expires=expires
+  )
@@ -0,0 +1,166 @@
+# Versioned schema migrations for the paste server.
+#
+# Migrations live in `migrations/` as `NNNN_description.py` modules. Each module
+# defines `async def upgrade(conn)` and may set `TRANSACTIONAL = False` when it
+# needs to run statements that cannot run inside a transaction, such as
+# `CREATE INDEX CONCURRENTLY`. Non transactional migrations must be safe to re-run,
+# since a crash halfway through leaves them partially applied.
+#
+# Run from the `src/` directory with `python -m utils.migrate`, or let `main.py` run
+# them at startup.
+
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import logging
+import os
+import re
+import tomllib
+from typing import TYPE_CHECKING
+
+import asyncpg
+
+if TYPE_CHECKING:
+  from types import ModuleType
+
+LOG = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = "migrations"
+MIGRATION_FILE_REGEX = re.compile(r"^(\d{4})_(\w+)\.py$")
+# Arbitrary key for pg_advisory_lock, stops two servers migrating at the same time.
+MIGRATION_LOCK_KEY = 0x7061737465
+
+class Migration:
+  version: int
+  name: str
+  module: ModuleType
+
+  def __init__(self, *, version: int, name: str, module: ModuleType) -> None:
+    self.version = version
+    self.name = name
+    self.module = module
+
+  @property
+  def transactional(self) -> bool:
+    return getattr(self.module, "TRANSACTIONAL", True)
+
+  async def upgrade(self, conn: asyncpg.Connection) -> None:
+    await self.module.upgrade(conn)
+
+def load_migrations(path: str = MIGRATIONS_DIR) -> list[Migration]:
+  "Load every migration module in `path`, sorted by version."
+  migrations: list[Migration] = []
+  for file in sorted(os.listdir(path)):
+    match = MIGRATION_FILE_REGEX.match(file)
+    if not match:
+      continue
+    spec = importlib.util.spec_from_file_location(f"migrations.{file.removesuffix('.py')}", os.path.join(path, file))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    migrations.append(Migration(version=int(match.group(1)), name=match.group(2), module=module))
+  versions = [migration.version for migration in migrations]
+  if len(versions) != len(set(versions)):
+    raise RuntimeError("Duplicate migration version numbers in migrations/")
+  return migrations
+
+async def get_schema_version(conn: asyncpg.Connection) -> int:
+  await conn.execute("""
+    CREATE TABLE IF NOT EXISTS SchemaVersion (
+      Version INT PRIMARY KEY,
+      Name TEXT NOT NULL,
+      Applied BIGINT NOT NULL
+    );
+  """)
+  return await conn.fetchval("SELECT COALESCE(MAX(Version), 0) FROM SchemaVersion;")
+
+async def migrate(conn: asyncpg.Connection, *, target: int = None) -> int:
+  "Apply all pending migrations up to `target` (default: all of them), and return the new schema version."
+  migrations = load_migrations()
+  await conn.execute("SELECT pg_advisory_lock($1);", MIGRATION_LOCK_KEY)
+  try:
+    version = await get_schema_version(conn)
+    for migration in migrations:
+      if migration.version <= version:
+        continue
+      if target is not None and migration.version > target:
+        break
+      LOG.info(f"Applying migration {migration.version:04} ({migration.name})...")
+      if migration.transactional:
+        async with conn.transaction():
+          await migration.upgrade(conn)
+          await _record(conn, migration)
+      else:
+        await migration.upgrade(conn)
+        await _record(conn, migration)
+      version = migration.version
+    return version
+  finally:
+    await conn.execute("SELECT pg_advisory_unlock($1);", MIGRATION_LOCK_KEY)
+
+async def _record(conn: asyncpg.Connection, migration: Migration) -> None:
+  await conn.execute(
+    "INSERT INTO SchemaVersion (Version, Name, Applied) VALUES ($1, $2, EXTRACT(EPOCH FROM now())::BIGINT);",
+    migration.version,
+    migration.name
+  )
+
+# Helpers for writing online migrations. These only take locks that allow reads and
+# writes to continue, so they can be run against a live database.
+
+async def create_index_concurrently(conn: asyncpg.Connection, name: str, table: str, definition: str, *, unique: bool = False) -> None:
+  "Create an index without blocking writes. An invalid index left by an earlier failed build is dropped and rebuilt."
+  valid = await conn.fetchval("""
+    SELECT i.indisvalid FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE c.relname = lower($1);
+  """, name)
+  if valid:
+    return
+  if valid is False:
+    LOG.warning(f"Index {name} was left invalid by an earlier migration, rebuilding it.")
+    await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+  await conn.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY {name} ON {table} {definition};")
+
+async def add_primary_key_online(conn: asyncpg.Connection, table: str, column: str) -> None:
+  """Add a primary key to an existing table without holding a long ACCESS EXCLUSIVE lock.
+
+  The unique index is built concurrently, NOT NULL is proven by validating a NOT VALID
+  check constraint (which only takes a SHARE UPDATE EXCLUSIVE lock), and the final
+  `ADD PRIMARY KEY USING INDEX` is then a catalog-only change."""
+  pkey = f"{table}_pkey".lower()
+  check = f"{table}_{column}_not_null".lower()
+  exists = await conn.fetchval("SELECT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = $1);", pkey)
+  if exists:
+    return
+  await create_index_concurrently(conn, pkey, table, f"({column})", unique=True)
+  await conn.execute(f"""
+    DO $$ BEGIN
+      ALTER TABLE {table} ADD CONSTRAINT {check} CHECK ({column} IS NOT NULL) NOT VALID;
+    EXCEPTION WHEN duplicate_object THEN NULL;
+    END $$;
+  """)
+  await conn.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {check};")
+  async with conn.transaction():
+    await conn.execute("SET LOCAL lock_timeout = '5s';")
+    await conn.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL;")
+    await conn.execute(f"ALTER TABLE {table} ADD CONSTRAINT {pkey} PRIMARY KEY USING INDEX {pkey};")
+    await conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT {check};")
+
+async def main():
+  with open("config.toml") as f:
+    config = tomllib.loads(f.read())
+  conn: asyncpg.Connection = await asyncpg.connect(
+    config["pg"]["url"],
+    password=config["pg"]["password"],
+    timeout=config["pg"]["timeout"]
+  )
+  try:
+    version = await migrate(conn)
+    print(f"Database is at schema version {version}.")
+  finally:
+    await conn.close()
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  asyncio.run(main())
@@ -0,0 +1,104 @@
+# Pastes is partitioned by month of creation (see migration 0011). These find, create and detach its partitions,
+# for the migration and for PGUtils.maintain_paste_partitions.
+
+from __future__ import annotations
+
+import datetime
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from typing import Union
+
+  import asyncpg
+
+# The partition holding every paste created before Pastes was partitioned.
+LEGACY_PARTITION = "pastes_legacy"
+PARTITION_NAME_REGEX = r"^pastes_(legacy|[0-9]{4}_[0-9]{2})$"
+PARTITION_BOUND_REGEX = re.compile(r"FROM \((MINVALUE|-?\d+)\) TO \((MAXVALUE|-?\d+)\)")
+# Set as the table comment once an archived partition holds its own contents, see PGUtils.archive_paste_partition.
+ARCHIVED_COMMENT = "Archived pastes, detached from Pastes along with their contents."
+
+class Partition:
+  name: str
+  start: Union[int,None] # First Created it holds, or None if unbounded.
+  end: Union[int,None] # Created it holds up to, but not including, or None if unbounded.
+
+  def __init__(self, *, name: str, start: Union[int,None], end: Union[int,None]) -> None:
+    self.name = name
+    self.start = start
+    self.end = end
+
+def month_start(year: int, month: int) -> int:
+  "The unix time a month starts, in UTC. `month` may be past 12 or below 1, and carries into the year."
+  year += (month - 1) // 12
+  month = (month - 1) % 12 + 1
+  return int(datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc).timestamp())
+
+def months_from(timestamp: int, months: int) -> int:
+  "The start of the month `months` months after the one `timestamp` is in."
+  date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+  return month_start(date.year, date.month + months)
+
+def partition_name(start: int) -> str:
+  date = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+  return f"pastes_{date.year:04}_{date.month:02}"
+
+async def get_partitions(conn: asyncpg.Connection) -> list[Partition]:
+  "The partitions attached to Pastes, oldest first. Ones part way through detaching are left out."
+  records = await conn.fetch("""
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'pastes'::regclass AND NOT i.inhdetachpending;
+  """)
+  partitions = []
+  for record in records:
+    start, end = PARTITION_BOUND_REGEX.search(record["bound"]).groups()
+    partitions.append(Partition(
+      name=record["relname"],
+      start=None if start == "MINVALUE" else int(start),
+      end=None if end == "MAXVALUE" else int(end)
+    ))
+  partitions.sort(key=lambda partition: -1 << 63 if partition.start is None else partition.start)
+  return partitions
+
+async def create_partitions(conn: asyncpg.Connection, *, until: int) -> list[str]:
+  """Create monthly partitions after the newest one, until there is one for pastes created at `until`.
+  Returns their names. Each is created empty and then attached, which only takes a SHARE UPDATE EXCLUSIVE
+  lock on Pastes, so reads and writes carry on."""
+  end = max(partition.end for partition in await get_partitions(conn))
+  created = []
+  while end <= until:
+    name = partition_name(end)
+    next_end = months_from(end, 1)
+    async with conn.transaction():
+      await conn.execute("SET LOCAL lock_timeout = '5s';")
+      await conn.execute(f"CREATE TABLE IF NOT EXISTS {name} (LIKE Pastes INCLUDING DEFAULTS);")
+      # Attaching builds the partition's copy of each of Pastes' indexes, which is instant while it's empty.
+      await conn.execute(f"ALTER TABLE Pastes ATTACH PARTITION {name} FOR VALUES FROM ({end}) TO ({next_end});")
+    created.append(name)
+    end = next_end
+  return created
+
+async def detach_partition(conn: asyncpg.Connection, name: str) -> None:
+  """Detach a partition from Pastes, leaving it as a table of its own. Its pastes disappear from the site, but their
+  ids are still taken and their contents still referenced until they are archived. Safe to re-run: a detach that was
+  interrupted is finished, and an already detached table is left alone. Must not be called in a transaction."""
+  pending = await conn.fetchval("SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass($1);", name)
+  if pending is None:
+    return
+  if pending:
+    await conn.execute(f"ALTER TABLE Pastes DETACH PARTITION {name} FINALIZE;")
+  else:
+    await conn.execute(f"ALTER TABLE Pastes DETACH PARTITION {name} CONCURRENTLY;")
+
+async def get_unfinished_archives(conn: asyncpg.Connection) -> list[str]:
+  "Partitions that have been detached, or begun detaching, but haven't been archived."
+  records = await conn.fetch("""
+    SELECT c.relname FROM pg_class c LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+    WHERE c.relkind = 'r' AND c.relname ~ $1 AND pg_table_is_visible(c.oid)
+      AND (i.inhrelid IS NULL OR i.inhdetachpending)
+      AND obj_description(c.oid, 'pg_class') IS DISTINCT FROM $2
+    ORDER BY c.relname;
+  """, PARTITION_NAME_REGEX, ARCHIVED_COMMENT)
+  return [record["relname"] for record in records]
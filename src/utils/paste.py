@@ -5,11 +5,13 @@ import tomllib
 import urllib.parse
 from typing import TYPE_CHECKING
 
+from utils.codec import CODEC_IDENTITY, decompress, decompress_prefix
 from utils.user import PublicUser
 
 if TYPE_CHECKING:
   from typing import Union
 
+  from aiohttp import web
   from asyncpg import Record
   from typing_extensions import Self
 
@@ -21,10 +23,26 @@ if TYPE_CHECKING:
 with open("config.toml") as f:
   PUBLIC_URL = tomllib.loads(f.read())["srv"]["publicurl"]
 
+# Column lists for selecting pastes, from `Pastes p` (and for PASTE_COLUMNS, joined to its content as `PASTE_SOURCE`).
+# Never use SELECT *, which also drags in columns like SearchVector.
+PASTE_SOURCE = "Pastes p JOIN PasteBlobs b ON b.Hash = p.ContentHash"
+# Chunked contents (see migration 0007) are put back together, use PGUtils.get_paste_content to stream them instead.
+# Contents in cold storage are empty here, with ColdPath set, and are read from their file (see utils/coldstore.py).
+PASTE_COLUMNS = "p.id, p.Creator, CASE WHEN b.Chunks = 0 THEN b.Content ELSE (SELECT string_agg(c.Content, ''::bytea ORDER BY c.Seq) FROM PasteBlobChunks c WHERE c.Hash = b.Hash) END AS content, b.Codec, b.ColdPath, p.ContentHash, p.Visibility, p.Title, p.Created, p.Modified, p.Syntax, p.Tags, p.Folder, p.Views, p.Expires"
+PASTE_METADATA_COLUMNS = "p.id, p.Creator, p.ContentHash, p.Visibility, p.Title, p.Created, p.Modified, p.Syntax, p.Tags, p.Folder, p.Size AS size, p.Views, p.Expires"
+# Condition on `Pastes p` leaving out expired pastes, which every read has. The sweeper deletes them soon after.
+PASTE_LIVE = "(p.Expires IS NULL OR p.Expires > extract(epoch FROM now())::BIGINT)"
+# Conditions on `Pastes p` finding pastes by the id, or array of ids, in $1. Pastes is partitioned by Created (see
+# migration 0011), and the Created from PasteIds lets Postgres look in just that partition instead of every one.
+PASTE_BY_ID = "p.id = $1 AND p.Created = (SELECT i.Created FROM PasteIds i WHERE i.id = $1)"
+PASTE_BY_IDS = "p.id = ANY($1::TEXT[]) AND p.Created = ANY(ARRAY(SELECT i.Created FROM PasteIds i WHERE i.id = ANY($1::TEXT[])))"
+
 class Paste:
   id: str
   creator: int
-  data: bytes
+  stored: bytes # The content as stored in the database, encoded with `codec`.
+  codec: int
+  content_hash: Union[bytes,None] # SHA-256 of the content, None until it has been stored.
   visibility: Union[Visibility,int]
   title: str
   created: int
@@ -32,6 +50,8 @@ class Paste:
   syntax: str 
   tags: str
   folder: str
+  views: int # Including views counted by this server that haven't been written yet, once PGUtils.count_view is called.
+  expires: Union[int,None] # When the paste is deleted, or None to keep it.
 
   def __init__(self,*,
     id: str, 
@@ -43,11 +63,18 @@ class Paste:
     modified: int = None, 
     syntax: str = None, 
     tags: str = None,
-    folder: str = None
+    folder: str = None,
+    codec: int = CODEC_IDENTITY,
+    content_hash: bytes = None,
+    views: int = 0,
+    expires: int = None
   ) -> None:
     self.id = id
     self.creator = creator
-    self.data = data
+    self.stored = data
+    self.codec = codec
+    self.content_hash = content_hash
+    self._data = data if codec == CODEC_IDENTITY else None
     self.visibility = visibility
     self.title = title
     self.created = created
@@ -55,6 +82,8 @@ class Paste:
     self.syntax = syntax
     self.tags = tags
     self.folder = folder
+    self.views = views
+    self.expires = expires
   
   @property
   def url(self) -> str:
@@ -62,7 +91,11 @@ class Paste:
 
   @property
   def json(self) -> str:
-    out = {
+    return json.dumps(self.as_dict)
+
+  @property
+  def as_dict(self) -> dict:
+    return {
       "id": self.id,
       "creator": self.creator,
       "visibility":self.visibility,
@@ -73,20 +106,42 @@ class Paste:
       "syntax": self.syntax,
       "tags": self.tags,
       "folder": self.folder,
+      "views": self.views,
+      "expires": self.expires,
     }
-    return json.dumps(out)
 
-  async def get_creator(self,pg: PGUtils) -> User:
-    "Helper method to get the creator of the paste."
+  async def get_creator(self,pg: PGUtils,request: web.Request = None) -> User:
+    "Helper method to get the creator of the paste. Pass the request to reuse users it has already looked up."
     if self.creator is None:
       return PublicUser()
+    elif request is not None:
+      return await pg.get_request_user(request,self.creator)
     else:
       return await pg.get_user(id=self.creator)
 
+  @property
+  def data(self) -> bytes:
+    "The paste content, decompressed the first time it is accessed."
+    if self._data is None:
+      self._data = decompress(self.stored, self.codec)
+    return self._data
+
+  @data.setter
+  def data(self, data: bytes) -> None:
+    self._data = data
+    self.stored = data
+    self.codec = CODEC_IDENTITY
+    self.content_hash = None
+
   @property
   def text_content(self) -> str:
     return self.data.decode()
 
+  @property
+  def size(self) -> int:
+    "Size of the paste content in bytes."
+    return len(self.data)
+
   def edit(self,*,newContent: str = None, newVisibility: Union[Visibility,int] = None, newTitle: str = None, newSyntax: str = None) -> None:
     "Edits the paste *in memory*, not in the database."
     if newContent:
@@ -116,30 +171,61 @@ class Paste:
       modified=record["modified"],
       syntax=record["syntax"],
       tags=record["tags"],
-      folder=record["folder"]
+      folder=record["folder"],
+      codec=record["codec"],
+      content_hash=record["contenthash"],
+      views=record["views"],
+      expires=record["expires"]
     )
     return paste
 
+  @classmethod
+  def from_metadata(cls, metadata: PasteMetadata, data: bytes) -> Self:
+    "Build from a paste's metadata and its (uncompressed) content."
+    return cls(
+      id=metadata.id,
+      creator=metadata.creator,
+      data=data,
+      visibility=metadata.visibility,
+      title=metadata.title,
+      created=metadata.created,
+      modified=metadata.modified,
+      syntax=metadata.syntax,
+      tags=metadata.tags,
+      folder=metadata.folder,
+      content_hash=metadata.content_hash,
+      views=metadata.views,
+      expires=metadata.expires
+    )
+
   def clone(self) -> Self:
     newPaste = Paste(
       id=self.id,
       creator=self.creator,
-      data=self.data,
+      data=self.stored,
       visibility=self.visibility,
       title=self.title,
       created=self.created,
       modified=self.modified,
       syntax=self.syntax,
       tags=self.tags,
-      folder=self.folder
+      folder=self.folder,
+      codec=self.codec,
+      content_hash=self.content_hash,
+      views=self.views,
+      expires=self.expires
     )
+    newPaste._data = self._data
     return newPaste
 
   async def update(self,pg:PGUtils) -> Self:
     paste = (await pg.get_pastes_from_search(id=self.id))[0]
     self.id = paste.id
     self.creator= paste.creator
-    self.data = paste.data
+    self.stored = paste.stored
+    self.codec = paste.codec
+    self.content_hash = paste.content_hash
+    self._data = paste._data
     self.visibility = paste.visibility
     self.title = paste.title
     self.created = paste.created
@@ -147,4 +233,112 @@ class Paste:
     self.syntax = paste.syntax
     self.tags = paste.tags
     self.folder = paste.folder
+    self.views = paste.views
+    self.expires = paste.expires
     return self
+
+class PasteMetadata:
+  "Everything about a paste except its content, for listings. Use `load` to get the full Paste."
+  id: str
+  creator: int
+  visibility: Union[Visibility,int]
+  title: str
+  created: int
+  modified: int
+  syntax: str
+  tags: str
+  folder: str
+  size: int
+  content_hash: bytes
+  views: int
+  expires: Union[int,None]
+  preview: Union[str,None]
+
+  def __init__(self,*,
+    id: str,
+    creator: int,
+    visibility: Union[Visibility,int],
+    title: str,
+    created: int = None,
+    modified: int = None,
+    syntax: str = None,
+    tags: str = None,
+    folder: str = None,
+    size: int = 0,
+    content_hash: bytes = None,
+    views: int = 0,
+    expires: int = None,
+    preview: str = None
+  ) -> None:
+    self.id = id
+    self.creator = creator
+    self.visibility = visibility
+    self.title = title
+    self.created = created
+    self.modified = modified
+    self.syntax = syntax
+    self.tags = tags
+    self.folder = folder
+    self.size = size
+    self.content_hash = content_hash
+    self.views = views
+    self.expires = expires
+    self.preview = preview
+
+  @property
+  def url(self) -> str:
+    return urllib.parse.urljoin(PUBLIC_URL,self.id)
+
+  @property
+  def as_dict(self) -> dict:
+    "Like `Paste.as_dict`, without the content."
+    return {
+      "id": self.id,
+      "creator": self.creator,
+      "visibility":self.visibility,
+      "title":self.title,
+      "created": self.created,
+      "modified": self.modified,
+      "syntax": self.syntax,
+      "tags": self.tags,
+      "folder": self.folder,
+      "views": self.views,
+      "expires": self.expires,
+    }
+
+  async def get_creator(self,pg: PGUtils,request: web.Request = None) -> User:
+    "Helper method to get the creator of the paste. Pass the request to reuse users it has already looked up."
+    if self.creator is None:
+      return PublicUser()
+    elif request is not None:
+      return await pg.get_request_user(request,self.creator)
+    else:
+      return await pg.get_user(id=self.creator)
+
+  async def load(self,pg: PGUtils) -> Union[Paste,None]:
+    "Fetch the full paste, including its content. Returns None if it has been deleted since."
+    pastes = await pg.get_pastes_from_search(id=self.id)
+    return pastes[0] if pastes else None
+
+  @classmethod
+  def from_record(cls, record: Record) -> Self:
+    "Build from a row selected with `PASTE_METADATA_COLUMNS`, and optionally `preview` and `codec` columns holding the start of the stored content."
+    preview = record.get("preview")
+    if preview is not None:
+      preview = decompress_prefix(preview, record["codec"], len(preview))
+    return cls(
+      id=record["id"],
+      creator=record["creator"],
+      visibility=record["visibility"],
+      title=record["title"],
+      created=record["created"],
+      modified=record["modified"],
+      syntax=record["syntax"],
+      tags=record["tags"],
+      folder=record["folder"],
+      size=record["size"],
+      content_hash=record["contenthash"],
+      views=record["views"],
+      expires=record["expires"],
+      preview=preview.decode(errors="ignore") if preview is not None else None
+    )
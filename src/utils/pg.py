@@ -2,27 +2,32 @@
 
 from __future__ import annotations
 
+import asyncio
+import contextlib
 import datetime
+import hashlib
 import tomllib
-import random
+import secrets
 import logging
 import string
-from inspect import isawaitable
 from typing import TYPE_CHECKING
 
-import aiofiles
-from aiofiles import os as aos
-import aioshutil
+import aiohttp
 import asyncpg
 
-from utils.paste import Paste
+from utils.cache import TTLCache
+from utils.coldstore import COLD_AFTER_DAYS, COLD_BATCH_SIZE, COLD_MIN_SIZE, LAST_READ_RESOLUTION, cold_path, full_path, read_chunks, read_file, read_prefix, remove_files, write_file
+from utils.codec import CHUNK_SIZE, CODEC_IDENTITY, COMPRESS_MIN_SIZE, MAX_PASTE_SIZE, StreamEncoder, aencode, decompress_prefix
+from utils.counters import Counter
+from utils.partitions import ARCHIVED_COMMENT, create_partitions, detach_partition, get_partitions, get_unfinished_archives, months_from
+from utils.paste import PASTE_BY_ID, PASTE_BY_IDS, PASTE_COLUMNS, PASTE_LIVE, PASTE_METADATA_COLUMNS, PASTE_SOURCE, Paste, PasteMetadata
 from utils.token import Token
-from utils.user import User, DeletedUser
-from utils.utils import ahash
+from utils.user import User, DeletedUser, PublicUser
+from utils.utils import Visibility, ahash, ahash_content
 from aiohttp import web
 
 if TYPE_CHECKING:
-  from typing import Union, Any, Coroutine
+  from typing import Union, Any, AsyncIterator, Callable, Coroutine, Iterable
 
 LOG = logging.getLogger(__name__)
 
@@ -34,17 +39,213 @@ with open("config.toml") as f:
   USER_TOKEN_LENGTH=config["user"]["token_length"]
   USERNAME_MIN_LENGTH = config["user"]["name_min"]
   USERNAME_MAX_LENGTH = config["user"]["name_max"]
+  TOKEN_CACHE_SIZE = config["token"].get("cache_size", 10000)
+  TOKEN_CACHE_TTL = config["token"].get("cache_ttl", 300)
+  TOKEN_NEGATIVE_CACHE_TTL = config["token"].get("negative_cache_ttl", 5)
+  REPLICA_MAX_LAG = config["pg"].get("replica", {}).get("max_lag", 10)
+  REPLICA_CHECK_TIMEOUT = config["pg"].get("replica", {}).get("check_timeout", 2)
+  DELETION_BATCH_SIZE = config["paste"].get("deletion", {}).get("batch_size", 1000)
+  DELETION_BATCH_DELAY = config["paste"].get("deletion", {}).get("batch_delay", 0.1)
+  EXPIRY_BATCH_SIZE = config["paste"].get("expiry", {}).get("batch_size", 500)
+  EXPIRY_BATCH_DELAY = config["paste"].get("expiry", {}).get("batch_delay", 0.1)
+  PARTITION_MONTHS_AHEAD = config["paste"].get("partitions", {}).get("months_ahead", 3)
+  PARTITION_ARCHIVE_AFTER = config["paste"].get("partitions", {}).get("archive_after", 0)
+  ARCHIVE_BATCH_SIZE = config["paste"].get("partitions", {}).get("archive_batch_size", 1000)
+
+ID_ALPHABET = string.ascii_letters+string.digits
+# Tries at finding an unused random ID before giving up, which in practice never takes more than one.
+ID_ATTEMPTS = 10
+
+# ts_headline options for content search snippets.
+HEADLINE_OPTIONS = "StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=30, MinWords=10"
+# How much of a paste's content is indexed and searched for snippets, matches paste_search_text() in migration 0003.
+SEARCH_TEXT_LIMIT = 262144
+# Rows fetched at a time when walking all of a user's pastes. Each may carry up to a chunk of content.
+EXPORT_PREFETCH = 16
+
+# The hot read statements, prepared on every pool connection as it is opened (see `init_connection`).
+PREPARED_STATEMENTS = {
+  "api_token": "SELECT * FROM APITokens WHERE id = $1;",
+  "user_token": "SELECT * FROM Users WHERE Password = $1 OR SecureToken = $1 OR InsecureToken = $1;",
+  "user": "SELECT * FROM Users WHERE Id = $1 AND Deleted IS NULL;",
+  "users": "SELECT * FROM Users WHERE id = ANY($1::BIGINT[]) AND Deleted IS NULL;",
+  "paste": f"SELECT {PASTE_COLUMNS} FROM {PASTE_SOURCE} WHERE {PASTE_BY_ID} AND {PASTE_LIVE};",
+  "pastes": f"SELECT {PASTE_COLUMNS} FROM {PASTE_SOURCE} WHERE {PASTE_BY_IDS} AND {PASTE_LIVE};",
+  "paste_metadata": f"SELECT {PASTE_METADATA_COLUMNS} FROM Pastes p WHERE {PASTE_BY_ID} AND {PASTE_LIVE};",
+  "pastes_metadata": f"SELECT {PASTE_METADATA_COLUMNS} FROM Pastes p WHERE {PASTE_BY_IDS} AND {PASTE_LIVE};",
+  "blob": "SELECT Codec, Chunks, CASE WHEN Chunks = 0 THEN Content END AS content, ColdPath FROM PasteBlobs WHERE Hash = $1;",
+  "blob_chunk": "SELECT Content FROM PasteBlobChunks WHERE Hash = $1 AND Seq = $2;",
+}
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+  "Pool `init` hook, which prepares PREPARED_STATEMENTS on a new connection. The pool's connection_class must allow it."
+  conn.prepared = {name: await conn.prepare(query) for name, query in PREPARED_STATEMENTS.items()}
+
+@web.middleware
+async def request_state_middleware(request: web.Request, handler: Callable[[web.Request],Coroutine[Any,Any,web.StreamResponse]]) -> web.StreamResponse:
+  """Give each request somewhere to remember the tokens and users it has looked up, so that the handler and
+  everything it renders (sidebar, navbar...) resolve its credentials once between them. Credentials are
+  resolved on first use, so requests that never authenticate, like static files, don't pay for it."""
+  request["tokens"] = {}
+  request["users"] = {}
+  return await handler(request)
+
+class _Rollback(Exception):
+  "Raised inside a transaction to roll it back."
 
 class PGUtils:
-  def __init__(self, pool: asyncpg.Pool = None):
+  def __init__(self, pool: asyncpg.Pool = None, replicas: list[asyncpg.Pool] = None):
     self.pool = pool
+    # Read only replicas of the database, which pure reads are spread across. They start out
+    # unhealthy, and are only used once `check_replicas` has found them up and not lagging.
+    self.replicas = replicas or []
+    self._replica_healthy = [False] * len(self.replicas)
+    self._next_replica = 0
+    # Resolved tokens keyed by the SHA-256 of the token string, tagged with the owner's id.
+    # False is cached for tokens that don't exist.
+    self.token_cache = TTLCache(max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+    # Bumped whenever pastes are created, edited or deleted, see `paste_version`.
+    self.public_paste_version = 0
+    self._paste_versions: dict[Union[int,None],int] = {}
+    # Views by paste id that haven't been written yet, see `count_view`.
+    self.views = Counter()
+    # Hashes of contents read without counting a view, whose LastRead hasn't been written yet, see `count_read`.
+    self.reads: set[bytes] = set()
+
+  @property
+  def stats(self) -> dict[str,Any]:
+    "A snapshot of the connection pools' and the token cache's statistics, for monitoring. Reading it changes nothing."
+    return {
+      "pool": self.pool.stats,
+      "replicas": [{**replica.stats, "healthy": healthy} for replica, healthy in zip(self.replicas, self._replica_healthy)],
+      "token_cache": self.token_cache.stats,
+    }
+
+  def _read_pool(self) -> asyncpg.Pool:
+    "The next healthy replica, round robin, or the primary if there is none."
+    for _ in range(len(self.replicas)):
+      i = self._next_replica
+      self._next_replica = (i + 1) % len(self.replicas)
+      if self._replica_healthy[i]:
+        return self.replicas[i]
+    return self.pool
+
+  @contextlib.asynccontextmanager
+  async def _read(self) -> AsyncIterator[asyncpg.Connection]:
+    """Acquire a connection for pure reads, from a replica if one is healthy. If the replica can't be
+    reached it is marked unhealthy and the primary is used instead. Reads that must see the caller's
+    own writes should use `self.pool` instead."""
+    pool = self._read_pool()
+    try:
+      conn = await pool.acquire()
+    except (OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.PostgresError):
+      if pool is self.pool:
+        raise
+      LOG.exception("Replica connection failed, reading from the primary")
+      self._replica_healthy[self.replicas.index(pool)] = False
+      pool = self.pool
+      conn = await pool.acquire()
+    try:
+      yield conn
+    finally:
+      await pool.release(conn)
+
+  async def check_replicas(self) -> None:
+    "Health check every replica, marking those that are down or lag by more than [pg.replica] max_lag seconds as unhealthy."
+    for i, replica in enumerate(self.replicas):
+      try:
+        async with replica.acquire(timeout=REPLICA_CHECK_TIMEOUT) as conn:
+          lag = await conn.fetchval("""
+            SELECT CASE
+              WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+              ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END;
+          """, timeout=REPLICA_CHECK_TIMEOUT)
+        healthy = lag <= REPLICA_MAX_LAG
+        if not healthy and self._replica_healthy[i]:
+          LOG.warning(f"Replica {i} is {lag:.1f}s behind, reading from the others")
+      except Exception:
+        if self._replica_healthy[i]:
+          LOG.exception(f"Replica {i} failed its health check")
+        healthy = False
+      if healthy and not self._replica_healthy[i]:
+        LOG.info(f"Replica {i} is healthy")
+      self._replica_healthy[i] = healthy
+
+  def _prepared(self, conn: asyncpg.Connection, name: str) -> Union[asyncpg.prepared_stmt.PreparedStatement,None]:
+    return getattr(conn, "prepared", {}).get(name)
+
+  async def _fetchrow(self, conn: asyncpg.Connection, name: str, *args: Any) -> Union[asyncpg.Record,None]:
+    "fetchrow for one of PREPARED_STATEMENTS, using the connection's prepared copy if it has one."
+    statement = self._prepared(conn, name)
+    return await statement.fetchrow(*args) if statement else await conn.fetchrow(PREPARED_STATEMENTS[name], *args)
+
+  async def _fetch(self, conn: asyncpg.Connection, name: str, *args: Any) -> list[asyncpg.Record]:
+    statement = self._prepared(conn, name)
+    return await statement.fetch(*args) if statement else await conn.fetch(PREPARED_STATEMENTS[name], *args)
+
+  async def _fetchval(self, conn: asyncpg.Connection, name: str, *args: Any) -> Any:
+    statement = self._prepared(conn, name)
+    return await statement.fetchval(*args) if statement else await conn.fetchval(PREPARED_STATEMENTS[name], *args)
 
   def _time(self) -> int:
     return int(datetime.datetime.now(datetime.timezone.utc).timestamp())
 
+  def paste_version(self, creator: Union[int,None]) -> int:
+    """A number that changes whenever `creator`'s pastes change, for caches built from them to compare against.
+    `public_paste_version` is the same for public pastes from anyone. Both only see changes made by this process."""
+    return self._paste_versions.get(creator, 0)
+
+  def _pastes_changed(self, creator: Union[int,None], *, public: bool) -> None:
+    "Record that a user's pastes were created, edited or deleted. `public` if any of them is, or was, public."
+    self._paste_versions[creator] = self._paste_versions.get(creator, 0) + 1
+    if public:
+      self.public_paste_version += 1
+
+  def count_view(self, paste: Union[Paste,PasteMetadata]) -> None:
+    """Count a view of a paste. Views are added up in memory and written by `flush_views`, rather than with a query
+    per view. The paste's `views` is brought up to date, including the views this server hasn't written yet."""
+    paste.views += self.views.add(paste.id)
+
+  def count_read(self, content_hash: bytes) -> None:
+    """Note that a blob's content was read where no view is counted, such as downloads, batch gets and exports.
+    `flush_views` writes it to LastRead with the views, keeping the content out of cold storage."""
+    self.reads.add(content_hash)
+
+  async def flush_views(self) -> None:
+    """Write the views counted since the last flush, and when their contents were last read, in one transaction.
+    If that fails they are kept for the next one."""
+    counts = self.views.take()
+    reads, self.reads = self.reads, set()
+    if not counts and not reads:
+      return
+    # In a consistent order, so that flushes from several servers don't deadlock.
+    ids = sorted(counts)
+    now = self._time()
+    try:
+      async with self.pool.acquire() as conn:
+        async with conn.transaction():
+          records = await conn.fetch("""
+            UPDATE Pastes p SET Views = p.Views + v.n
+            FROM unnest($1::TEXT[], $2::BIGINT[]) AS v(id, n) JOIN PasteIds i ON i.id = v.id
+            WHERE p.id = v.id AND p.Created = i.Created
+            RETURNING p.ContentHash;
+          """, ids, [counts[id] for id in ids])
+          # Keeps read contents out of cold storage. Blobs another flush has locked are skipped rather than waited
+          # for, a missed update only matters if they aren't read again for days.
+          await conn.execute("""
+            UPDATE PasteBlobs b SET LastRead = $2
+            FROM (SELECT Hash FROM PasteBlobs WHERE Hash = ANY($1::BYTEA[]) AND LastRead < $3 FOR UPDATE SKIP LOCKED) touched
+            WHERE b.Hash = touched.Hash;
+          """, sorted(reads | {record["contenthash"] for record in records}), now, now - LAST_READ_RESOLUTION)
+    except BaseException:
+      self.views.restore(counts)
+      self.reads |= reads
+      raise
+
   async def handle_auth(self, request: web.Request, *, strict_password: bool = False, no_exist_ok: bool = False, secure: bool = False) -> Union[web.Response,Token,False]:
     if "Authorization" in request.headers:
-      token = await self.verify_token(request.headers["Authorization"])
+      token = await self._verify_request_token(request,request.headers["Authorization"])
       if strict_password and type(token) is Token and token.name in ["INSECUREPASSWORD","SECUREPASSWORD"]:
         if secure and token.name == "SECUREPASSWORD":
           return token
@@ -57,11 +258,11 @@ class PGUtils:
       else:
         return token
     if "securetoken" in request.cookies:
-      token = await self.verify_token(request.cookies["securetoken"])
+      token = await self._verify_request_token(request,request.cookies["securetoken"])
       if strict_password and type(token) is Token and token.secure:
         return token
     if "token" in request.cookies:
-      token = await self.verify_token(request.cookies["token"])
+      token = await self._verify_request_token(request,request.cookies["token"])
       if strict_password and type(token) is Token and token.name in ["INSECUREPASSWORD","SECUREPASSWORD"]:
         if secure and token.name == "SECUREPASSWORD":
           return token
@@ -78,29 +279,77 @@ class PGUtils:
     else:
       return False
 
-  async def get_user(self,*,name: str = None, email: str = None, id: int = None) -> User|None:
-    "Get a user from either username, email, or the ID, and return a User object."
-    async with self.pool.acquire() as conn:
+  async def _verify_request_token(self, request: web.Request, token: str) -> Union[Token,bool]:
+    "verify_token, remembered for the rest of the request (see `request_state_middleware`)."
+    tokens = request.get("tokens")
+    if tokens is None:
+      return await self.verify_token(token)
+    if token not in tokens:
+      tokens[token] = await self.verify_token(token)
+      if tokens[token]:
+        request["users"].setdefault(tokens[token].owner.id, tokens[token].owner)
+    return tokens[token]
+
+  async def get_request_users(self, request: web.Request, ids: Iterable[Union[int,None]]) -> dict[Union[int,None],User]:
+    "get_users, for ids not already looked up by the request, remembering them for the rest of the request."
+    users = request.get("users")
+    if users is None:
+      return await self.get_users(ids)
+    ids = set(ids)
+    missing = [id for id in ids if id not in users]
+    if missing:
+      users.update(await self.get_users(missing))
+    return {id: users[id] for id in ids}
+
+  async def get_request_user(self, request: web.Request, id: int) -> User:
+    "get_user(id=id), remembered for the rest of the request. This includes the owners of tokens it was authenticated with."
+    users = request.get("users")
+    if users is None:
+      return await self.get_user(id=id)
+    if id not in users:
+      users[id] = await self.get_user(id=id)
+    return users[id]
+
+  async def get_user(self,*,name: str = None, email: str = None, id: int = None, primary: bool = False) -> User|None:
+    "Get a user from either username, email, or the ID, and return a User object. Set `primary` to read your own writes."
+    async with (self.pool.acquire() if primary else self._read()) as conn:
       if name:
-        record = await conn.fetchrow("SELECT * FROM Users WHERE Username ILIKE $1", name)
+        record = await conn.fetchrow("SELECT * FROM Users WHERE lower(Username) = lower($1)", name)
       elif email:
-        record = await conn.fetchrow("SELECT * FROM Users WHERE Email ILIKE $1", email)
+        record = await conn.fetchrow("SELECT * FROM Users WHERE lower(Email) = lower($1)", email)
       elif id:
-        record = await conn.fetchrow("SELECT * FROM Users WHERE Id = $1", id)
+        record = await self._fetchrow(conn, "user", id)
       if record:
         return User.from_record(record)
       else:
         return type(id) is int and DeletedUser() or None
 
+  async def get_users(self, ids: Iterable[Union[int,None]]) -> dict[Union[int,None],User]:
+    """Get many users by id in one query, as a dict of id to User.
+    Ids of users that don't exist map to DeletedUser, and None (the creator of an anonymous paste) to PublicUser."""
+    ids = set(ids)
+    users: dict[Union[int,None],User] = {}
+    if None in ids:
+      ids.discard(None)
+      users[None] = PublicUser()
+    if ids:
+      async with self._read() as conn:
+        records = await self._fetch(conn, "users", list(ids))
+      for record in records:
+        users[record["id"]] = User.from_record(record)
+    for id in ids:
+      users.setdefault(id, DeletedUser())
+    return users
+
   async def create_new_user(self,user: User) -> int:
     "Create a new user, and return the ID of the user."
     if not USERNAME_MIN_LENGTH <= len(user.name) <= USERNAME_MAX_LENGTH:
       return False
     async with self.pool.acquire() as conn:
-      exists = await conn.fetchrow("SELECT EXISTS ( SELECT 1 FROM Users WHERE Username ILIKE $1);",user.name)
+      exists = await conn.fetchrow("SELECT EXISTS ( SELECT 1 FROM Users WHERE lower(Username) = lower($1));",user.name)
       if not exists["exists"]:
         await conn.execute("INSERT INTO Users (Username, Password, Email, AvatarType, JoinDate, RememberMe) VALUES ($1, $2, $3, 0, $4, $5);", user.name, user.password, user.email, self._time(), user.remember_me)
-        user = await self.get_user(name=user.name)
+        user = await self.get_user(name=user.name, primary=True)
         return user.id
       else:
         return False
@@ -108,24 +357,27 @@ class PGUtils:
   async def update_user(self,user: User) -> bool:
     "Update attributes of a user."
     async with self.pool.acquire() as conn:
-      original_user = await self.get_user(id = user.id)
+      original_user = await self.get_user(id = user.id, primary=True)
       if original_user.password != user.password:
         await self.generate_new_user_token(original_user, True)
       record = await conn.execute("UPDATE Users SET username=$2, email = $3, password=$4 WHERE id=$1",user.id,user.name,user.email,user.password)
+      self.invalidate_user_tokens(user.id)
+      # Their name is shown on their pastes.
+      self._pastes_changed(user.id, public=True)
       return record == "UPDATE 1" # If we've updated more than one, yikes bro
 
   async def get_pastes_from_creator(self,*,creator: int) -> list[Paste]:
     "Get all of the pastes registered to a user"
-    async with self.pool.acquire() as conn:
-      records = await conn.fetch("SELECT * FROM Pastes WHERE Creator = $1", creator)
+    async with self._read() as conn:
+      records = await conn.fetch(f"SELECT {PASTE_COLUMNS} FROM {PASTE_SOURCE} WHERE p.Creator = $1 AND {PASTE_LIVE}", creator)
       out: list[Paste] = []
       for record in records:
-        out.append(Paste.from_record(record))
+        out.append(await self._paste_from_record(record))
       return out
 
   async def get_pastes_from_search(self,*,creator: Union[int,str,User] = None, title: str = None, id: str = None) -> list[Paste]:
     "Get a paste from either the creator id, or title, or the id, and return a Paste object."
-    async with self.pool.acquire() as conn:
+    async with self._read() as conn:
       if creator:
         if type(creator) is int:
           creator = creator
@@ -134,43 +386,277 @@ class PGUtils:
         elif type(creator) is User:
           creator = creator.id
 
-        records = await conn.fetch("SELECT * FROM Pastes WHERE Creator ", creator)
+        records = await conn.fetch(f"SELECT {PASTE_COLUMNS} FROM {PASTE_SOURCE} WHERE p.Creator = $1 AND {PASTE_LIVE}", creator)
       elif title:
-        records = await conn.fetch("SELECT * FROM Pastes WHERE Email LIKE %$1%", title)
+        records = await conn.fetch(f"SELECT {PASTE_COLUMNS} FROM {PASTE_SOURCE} WHERE p.Title ILIKE '%' || $1 || '%' AND {PASTE_LIVE}", title)
       elif id:
-        records = await conn.fetch("SELECT * FROM Pastes WHERE Id = $1", id)
+        records = await self._fetch(conn, "paste", id)
+        if not records and self.replicas:
+          # It may be new enough that the replica hasn't got it yet.
+          async with self.pool.acquire() as primary:
+            records = await self._fetch(primary, "paste", id)
 
-      out = [Paste.from_record(record) for record in records]
+      out = [await self._paste_from_record(record) for record in records]
       return out
 
-  async def get_pastes_from_lambda(self,lambd: function,*,limit:int=50,offset:int=0) -> list[Paste]:
-    """Use the lambda to return a list of pastes. Lambda's argument is a Paste object. Pastes `creator` attribute is a User object
-    The limit function returns only a max of the limit, and offset is pagination"""
-    # Get all of the pastes
-    async with self.pool.acquire() as conn:
-      records = await conn.fetch("SELECT * FROM Pastes LIMIT $1 OFFSET $2",limit,offset*limit)
-      # Now turn it into a list of pastes
-      pastes = [Paste.from_record(record) for record in records]
-
-      # Now loop over it and check it against the lambda
-      out = []
-      for paste in pastes:
-        if isawaitable(lambd):
-          if await lambd(paste):
-            out.append(paste)
-        else:
-          if lambd(paste):
-            out.append(paste)
-      return out
+  async def get_pastes(self, ids: Iterable[str]) -> dict[str,Paste]:
+    "Get many pastes by id in one query, keyed by id. Pastes that don't exist are left out."
+    ids = list(set(ids))
+    async with self._read() as conn:
+      records = await self._fetch(conn, "pastes", ids)
+    if len(records) < len(ids) and self.replicas:
+      # Some may be new enough that the replica hasn't got them yet.
+      found = {record["id"] for record in records}
+      async with self.pool.acquire() as conn:
+        records += await self._fetch(conn, "pastes", [id for id in ids if id not in found])
+    return {record["id"]: await self._paste_from_record(record) for record in records}
+
+  async def _paste_from_record(self, record: asyncpg.Record) -> Paste:
+    "Paste.from_record for a row selected with PASTE_COLUMNS, reading the content from its file if it is in cold storage."
+    if record["coldpath"]:
+      record = dict(record, content=await read_file(record["coldpath"]))
+    return Paste.from_record(record)
+
+  async def get_paste_metadata(self, id: str) -> Union[PasteMetadata,None]:
+    "Get everything about a paste except its content, or None if it does not exist."
+    async with self._read() as conn:
+      record = await self._fetchrow(conn, "paste_metadata", id)
+    if not record and self.replicas:
+      # It may be new enough that the replica hasn't got it yet.
+      async with self.pool.acquire() as conn:
+        record = await self._fetchrow(conn, "paste_metadata", id)
+    return PasteMetadata.from_record(record) if record else None
+
+  async def get_pastes_metadata(self, ids: Iterable[str]) -> dict[str,PasteMetadata]:
+    "Get everything but the content of many pastes by id in one query, keyed by id. Pastes that don't exist are left out."
+    ids = list(set(ids))
+    async with self._read() as conn:
+      records = await self._fetch(conn, "pastes_metadata", ids)
+    if len(records) < len(ids) and self.replicas:
+      # Some may be new enough that the replica hasn't got them yet.
+      found = {record["id"] for record in records}
+      async with self.pool.acquire() as conn:
+        records += await self._fetch(conn, "pastes_metadata", [id for id in ids if id not in found])
+    return {record["id"]: PasteMetadata.from_record(record) for record in records}
+
+  async def search_pastes(self,*,title: str = None, regex: bool = False, creator: str = None, token: Token = None, limit: int = 50, cursor: tuple[int,str] = None) -> tuple[list[tuple[PasteMetadata,str]],Union[tuple[int,str],None]]:
+    """Search pastes by title and/or creator name, newest first, in a single query.
+    `title` is a case insensitive substring, or a POSIX regular expression if `regex` is set.
+    Only public pastes are returned, plus the token owner's own pastes (see `_visibility_clause`).
+    `cursor` is the (Created, id) of the last paste of the previous page.
+    Returns a list of (PasteMetadata, creator name) tuples, and the cursor for the next page or None if this is the last page.
+    Raises asyncpg.InvalidRegularExpressionError if `title` is not a valid regex."""
+    conditions: list[str] = []
+    args: list[Any] = []
+
+    def arg(value: Any) -> str:
+      args.append(value)
+      return f"${len(args)}"
+
+    if title:
+      if regex:
+        conditions.append(f"p.Title ~* {arg(title)}")
+      else:
+        escaped = title.replace("\\","\\\\").replace("%","\\%").replace("_","\\_")
+        conditions.append(f"p.Title ILIKE {arg(f'%{escaped}%')}")
+    if creator:
+      conditions.append(f"lower(u.Username) = lower({arg(creator)})")
+    conditions.append(self._visibility_clause(token, arg))
+    conditions.append(PASTE_LIVE)
+    if cursor:
+      created = arg(cursor[0])
+      conditions.append(f"p.Created <= {created} AND (p.Created, p.id) < ({created}, {arg(cursor[1])})")
+
+    query = f"""
+      SELECT
+        {PASTE_METADATA_COLUMNS}, u.Username
+      FROM
+        Pastes p
+      LEFT JOIN
+        Users u ON u.id = p.Creator
+      WHERE
+        {" AND ".join(conditions)}
+      ORDER BY
+        p.Created DESC, p.id DESC
+      LIMIT {arg(limit+1)};
+    """
+    async with self._read() as conn:
+      records, next_cursor = self._page(await conn.fetch(query, *args), limit)
+      return [(PasteMetadata.from_record(record), self._creator_name(record)) for record in records], next_cursor
+
+  async def get_pastes_page(self,*,creator: int = None, public_only: bool = False, folder: str = None, limit: int = 50, cursor: tuple[int,str] = None, preview: int = 0, primary: bool = False) -> tuple[list[PasteMetadata],Union[tuple[int,str],None]]:
+    """Get a page of paste metadata, newest first, optionally only those of `creator` and/or only public ones.
+    `folder` limits the page to pastes in that folder, and an empty string to pastes in no folder.
+    `cursor` is the (Created, id) of the last paste of the previous page.
+    `preview` fetches up to that many bytes from the start of each paste's content into `PasteMetadata.preview`.
+    Set `primary` to read your own writes.
+    Returns the pastes, and the cursor for the next page or None if this is the last page."""
+    conditions: list[str] = [PASTE_LIVE]
+    args: list[Any] = []
+
+    def arg(value: Any) -> str:
+      args.append(value)
+      return f"${len(args)}"
+
+    if creator is not None:
+      conditions.append(f"p.Creator = {arg(creator)}")
+    if public_only:
+      conditions.append("p.Visibility = 1")
+    if folder is not None:
+      conditions.append(f"coalesce(p.Folder, '') = {arg(folder)}")
+    if cursor:
+      created = arg(cursor[0])
+      # The plain bound on Created is what lets Postgres skip the newer partitions.
+      conditions.append(f"p.Created <= {created} AND (p.Created, p.id) < ({created}, {arg(cursor[1])})")
+
+    columns = PASTE_METADATA_COLUMNS
+    source = "Pastes p"
+    if preview:
+      columns += f", b.Codec, b.ColdPath, substring(coalesce(c.Content, b.Content) FROM 1 FOR {arg(preview)}) AS preview"
+      source = f"{PASTE_SOURCE} LEFT JOIN PasteBlobChunks c ON c.Hash = b.Hash AND c.Seq = 0"
+
+    query = f"""
+      SELECT {columns} FROM {source}
+      WHERE {" AND ".join(conditions)}
+      ORDER BY p.Created DESC, p.id DESC
+      LIMIT {arg(limit+1)};
+    """
+    async with (self.pool.acquire() if primary else self._read()) as conn:
+      records, next_cursor = self._page(await conn.fetch(query, *args), limit)
+    pastes = [PasteMetadata.from_record(record) for record in records]
+    if preview:
+      for paste,record in zip(pastes, records):
+        if record["coldpath"]:
+          paste.preview = decompress_prefix(await read_prefix(record["coldpath"], preview), record["codec"], preview).decode(errors="ignore")
+    return pastes, next_cursor
+
+  def _page(self, records: list[asyncpg.Record], limit: int) -> tuple[list[asyncpg.Record],Union[tuple[int,str],None]]:
+    "Trim a page fetched with LIMIT limit+1, returning the records and the keyset cursor for the next page."
+    if len(records) <= limit:
+      return records, None
+    records = records[:limit]
+    return records, (records[-1]["created"], records[-1]["id"])
+
+  async def search_paste_contents(self, text: str, *, token: Token = None, limit: int = 50, offset: int = 0) -> list[tuple[PasteMetadata,str,str]]:
+    """Full text search over paste titles and contents, best matches first.
+    `text` uses web search syntax: quoted phrases, `or`, and `-` to exclude words.
+    Returns a list of (PasteMetadata, creator name, snippet) tuples. The snippet is an excerpt of the content with matching words wrapped in <mark></mark>. It is not HTML escaped."""
+    args: list[Any] = [text]
+
+    def arg(value: Any) -> str:
+      args.append(value)
+      return f"${len(args)}"
+
+    query = f"""
+      WITH matches AS (
+        SELECT
+          {PASTE_METADATA_COLUMNS}, ts_rank_cd(p.SearchVector, q) AS rank
+        FROM
+          Pastes p, websearch_to_tsquery('english', $1) q
+        WHERE
+          p.SearchVector @@ q AND {self._visibility_clause(token, arg)} AND {PASTE_LIVE}
+        ORDER BY
+          rank DESC, p.Created DESC
+        LIMIT {arg(limit)} OFFSET {arg(offset)}
+      )
+      SELECT
+        m.*, u.Username,
+        b.Codec, b.ColdPath,
+        CASE WHEN b.Codec = 0 AND b.Chunks = 0 AND b.ColdPath IS NULL THEN
+          ts_headline('english', paste_search_text(b.Content), websearch_to_tsquery('english', $1), '{HEADLINE_OPTIONS}')
+        END AS snippet,
+        CASE WHEN b.Codec <> 0 OR b.Chunks <> 0 OR b.ColdPath IS NOT NULL THEN
+          substring(coalesce(c.Content, b.Content) FROM 1 FOR {SEARCH_TEXT_LIMIT})
+        END AS compressed
+      FROM
+        matches m
+      JOIN
+        PasteBlobs b ON b.Hash = m.ContentHash
+      LEFT JOIN
+        PasteBlobChunks c ON c.Hash = b.Hash AND c.Seq = 0
+      LEFT JOIN
+        Users u ON u.id = m.Creator
+      ORDER BY
+        m.rank DESC, m.Created DESC;
+    """
+    async with self._read() as conn:
+      records = await conn.fetch(query, *args)
+      snippets: dict[str,str] = {record["id"]: record["snippet"] for record in records}
+
+      # Postgres can't read compressed contents or ones in cold storage, and a chunk may end part way through a
+      # character, so decode the start of those here and send it back for ts_headline.
+      compressed = [record for record in records if record["compressed"] is not None]
+      if compressed:
+        prefixes = [
+          await read_prefix(record["coldpath"], SEARCH_TEXT_LIMIT) if record["coldpath"] else record["compressed"]
+          for record in compressed
+        ]
+        loop = asyncio.get_running_loop()
+        texts = await loop.run_in_executor(None, lambda: [
+          decompress_prefix(prefix, record["codec"], SEARCH_TEXT_LIMIT).decode(errors="ignore")
+          for prefix,record in zip(prefixes, compressed)
+        ])
+        headlines = await conn.fetch(f"""
+          SELECT x.id, ts_headline('english', x.content, websearch_to_tsquery('english', $3), '{HEADLINE_OPTIONS}') AS snippet
+          FROM unnest($1::text[], $2::text[]) AS x(id, content);
+        """, [record["id"] for record in compressed], texts, text)
+        snippets.update({record["id"]: record["snippet"] for record in headlines})
+
+      return [(PasteMetadata.from_record(record), self._creator_name(record), snippets[record["id"]]) for record in records]
+
+  def _visibility_clause(self, token: Union[Token,None], arg: Callable[[Any],str]) -> str:
+    """SQL condition for the pastes a token may list, for a Pastes table aliased as `p`.
+    This is everyone's public pastes, the token owner's own public and unlisted pastes,
+    and their private pastes too if the token can view private pastes."""
+    if not token:
+      return "p.Visibility = 1"
+    if token.permissions.view_private:
+      return f"(p.Visibility = 1 OR p.Creator = {arg(token.owner.id)})"
+    return f"(p.Visibility = 1 OR (p.Creator = {arg(token.owner.id)} AND p.Visibility <> 3))"
+
+  def _creator_name(self, record: asyncpg.Record) -> str:
+    "Name of a paste's creator from a Pastes row joined to Users."
+    if record["username"] is not None:
+      return record["username"]
+    return PublicUser().name if record["creator"] is None else DeletedUser().name
 
   async def verify_token(self, token: Union[Token,str]) -> Union[Token,bool]:
     "Verifies a token and returns the Token object, or False if the token does not exist."
     if type(token) is Token:
       return token
+    key = self._token_cache_key(token)
+    generation = self.token_cache.generation
+    cached = self.token_cache.get(key)
+    if cached is not None:
+      return cached
+    result = await self._verify_token(token)
+    if result and type(result.owner) is DeletedUser:
+      # Not cached, it would be tagged with DeletedUser's id, out of reach of `invalidate_user_tokens`.
+      return result
+    if result:
+      self.token_cache.set(key, result, tag=result.owner.id, generation=generation)
+    else:
+      self.token_cache.set(key, False, ttl=TOKEN_NEGATIVE_CACHE_TTL, generation=generation)
+    return result
+
+  def _token_cache_key(self, token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+  def invalidate_token(self, token: Union[Token,str]) -> None:
+    "Drop a token from the token cache, after changing or deleting it."
+    self.token_cache.delete(self._token_cache_key(token.id if type(token) is Token else token))
+
+  def invalidate_user_tokens(self, user: Union[int,User]) -> None:
+    "Drop every cached token owned by a user, after changing anything about the user."
+    self.token_cache.delete_tag(user.id if type(user) is User else user)
+
+  async def _verify_token(self, token: str) -> Union[Token,bool]:
     async with self.pool.acquire() as conn:
-      record = await conn.fetchrow("SELECT * FROM APITokens WHERE id = $1",token)
+      record = await self._fetchrow(conn, "api_token", token)
       if record:
-        user: User = await self.get_user(id=record["creator"])
+        # From the same connection, a lagging replica wouldn't have a user who just signed up.
+        owner = await self._fetchrow(conn, "user", record["creator"])
+        user: User = User.from_record(owner) if owner else DeletedUser()
         token = Token(
           name=record["title"],
           owner=user,
@@ -179,7 +665,7 @@ class PGUtils:
           ident=record["ident"]
         )
         return token
-      record = await conn.fetchrow("SELECT * FROM Users WHERE Password = $1 OR SecureToken = $1 OR InsecureToken = $1;",token)
+      record = await self._fetchrow(conn, "user_token", token)
       if record:
         if record["password"] == token or record["securetoken"] == token:
           user = User.from_record(record)
@@ -203,47 +689,23 @@ class PGUtils:
           return token
     return False
 
-  async def _generate_paste_id(self, *, conn: asyncpg.Connection = None) -> str:
-    "Generate an ID, while making sure it does not exist in the database already."
-    pool: str = string.ascii_letters+string.digits
-    pasteID = "".join(random.choices(pool,k=PASTE_ID_LENGTH))
-    if conn is None:
-      conn = await self.pool.acquire()
-    record = await conn.fetchrow("SELECT EXISTS (SELECT 1 FROM Pastes WHERE Id = $1);",pasteID)
-    if record["exists"]:
-      return await self._generate_paste_id()
-    else:
-      await self.pool.release(conn)
-      return pasteID
-
-  async def _generate_token_id(self, *, conn: asyncpg.Connection = None) -> str:
-    "Generate an ID, while making sure it does not exist in the database already."
-    pool: str = string.ascii_letters+string.digits
-    tokenID = "".join(random.choices(pool,k=TOKEN_ID_LENGTH))
-    if conn is None:
-      conn = await self.pool.acquire()
-    record = await conn.fetchrow("SELECT EXISTS (SELECT 1 FROM APITokens WHERE Id = $1 OR Ident = $1);",tokenID)
-    if record["exists"]:
-      return await self._generate_token_id(conn=conn)
-    else:
-      await self.pool.release(conn)
-      return tokenID
-
-  async def _generate_user_token_id(self, secure: bool, *, conn: asyncpg.Connection = None) -> str:
-    "Generate an ID, while making sure it does not exist in the database already."
-    pool: str = string.ascii_letters+string.digits
-    tokenID = "".join(random.choices(pool,k=TOKEN_ID_LENGTH))
-    if conn is None:
-      conn = await self.pool.acquire()
-    if secure:
-      record = await conn.fetchrow("SELECT EXISTS (SELECT 1 FROM Users WHERE SecureToken = $1);",tokenID)
-    else:
-      record = await conn.fetchrow("SELECT EXISTS (SELECT 1 FROM Users WHERE InsecureToken = $1);",tokenID)
-    if record["exists"]:
-      return await self._generate_user_token_id(conn=conn)
-    else:
-      await self.pool.release(conn)
-      return tokenID
+  def _random_id(self, length: int) -> str:
+    return "".join(secrets.choice(ID_ALPHABET) for _ in range(length))
+
+  async def _set_user_token(self, conn: asyncpg.Connection, user_id: int, column: str) -> str:
+    "Give a user a new random session token in `column` (InsecureToken or SecureToken), returning it."
+    for _ in range(ID_ATTEMPTS):
+      new_token = self._random_id(TOKEN_ID_LENGTH)
+      # Set only if no one else has the token, in the same statement, rather than checking first.
+      if await conn.fetchval(f"""
+        UPDATE Users SET {column} = $2
+        WHERE Id = $1 AND NOT EXISTS (SELECT 1 FROM Users WHERE {column} = $2)
+        RETURNING 1;
+      """, user_id, new_token):
+        return new_token
+      if not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM Users WHERE Id = $1);", user_id):
+        return new_token
+    raise RuntimeError(f"Could not allocate a unique {column}")
 
   async def create_new_paste(self, paste: Paste, token: Union[Token,str]) -> Union[Paste,bool]:
     "Create a new paste, returning the paste object with the ID field set. The ID field will be overwritten with the new one. Token is used for determining who owns the paste, and if this token can create pastes."
@@ -253,102 +715,645 @@ class PGUtils:
     if not token.permissions.create_paste:
       return False,"missing create intent"
     
-    pasteID = await self._generate_paste_id()
     if type(paste.data) is not bytes:
       paste.data = paste.data.encode()
+    content_hash = await ahash_content(paste.data)
+    async with self.pool.acquire() as conn:
+      async with conn.transaction():
+        await self._acquire_blob(conn, content_hash, paste.data)
+        record = await self._insert_paste(conn, paste, token, content_hash, len(paste.data))
+    self._pastes_changed(token.owner.id, public=paste.visibility == Visibility.PUBLIC.value)
+    return Paste.from_metadata(PasteMetadata.from_record(record), paste.data),""
+
+  async def create_new_paste_from_stream(self, paste: Paste, token: Union[Token,str], stream: aiohttp.StreamReader) -> tuple[Union[PasteMetadata,bool],str]:
+    """Create a new paste with the content read from `stream`, such as a request body, instead of `paste.data`.
+    The content is read, hashed and compressed a chunk at a time and stored in chunks, so it is never all held in memory.
+    Returns the new paste's metadata, or False and the reason."""
+    if type(token) is str:
+      token = await self.verify_token(token)
+      if not token: return False,"verify token failed/not passed"
+    if not token.permissions.create_paste:
+      return False,"missing create intent"
+
+    encoder = StreamEncoder(prefix_length=SEARCH_TEXT_LIMIT)
+    try:
+      async for data in stream.iter_chunked(CHUNK_SIZE):
+        if encoder.size + len(data) > MAX_PASTE_SIZE:
+          return False,"paste too large"
+        await encoder.write(data)
+      content_hash = encoder.finish()
+
+      async with self.pool.acquire() as conn:
+        async with conn.transaction():
+          if not await conn.fetchval("UPDATE PasteBlobs SET RefCount = RefCount + 1 WHERE Hash = $1 RETURNING 1;", content_hash):
+            await self._insert_chunked_blob(conn, content_hash, encoder)
+          record = await self._insert_paste(conn, paste, token, content_hash, encoder.size)
+    finally:
+      encoder.close()
+    self._pastes_changed(token.owner.id, public=paste.visibility == Visibility.PUBLIC.value)
+    return PasteMetadata.from_record(record),""
+
+  async def create_new_pastes(self, pastes: list[Paste], token: Union[Token,str]) -> tuple[Union[list[str],bool],str]:
+    "Create many pastes at once, in one transaction, returning their new IDs in the same order, or False and the reason."
+    if type(token) is str:
+      token = await self.verify_token(token)
+      if not token: return False,"verify token failed/not passed"
+    if not token.permissions.create_paste:
+      return False,"missing create intent"
+    if not pastes:
+      return [],""
+
+    async with self.pool.acquire() as conn:
+      async with conn.transaction():
+        ids = await self._copy_pastes(conn, pastes, token.owner.id)
+    self._pastes_changed(token.owner.id, public=any(paste.visibility == Visibility.PUBLIC.value for paste in pastes))
+    return ids,""
+
+  async def import_pastes(self, batches: AsyncIterator[list[Paste]], token: Token) -> list[tuple[str,str]]:
+    """Import pastes into the token owner's account, as they come in from `batches`, all in one transaction.
+    Pastes keep their id and timestamps, unless the id is taken here, in which case they get a new one.
+    Returns (id it was imported with, new id) for every paste. If `batches` raises, nothing is imported."""
+    ids: list[tuple[str,str]] = []
+    public = False
     async with self.pool.acquire() as conn:
+      async with conn.transaction():
+        async for pastes in batches:
+          ids += zip((paste.id for paste in pastes), await self._copy_pastes(conn, pastes, token.owner.id, keep_ids=True))
+          public = public or any(paste.visibility == Visibility.PUBLIC.value for paste in pastes)
+    if ids:
+      self._pastes_changed(token.owner.id, public=public)
+    return ids
+
+  async def _copy_pastes(self, conn: asyncpg.Connection, pastes: list[Paste], creator: int, *, keep_ids: bool = False) -> list[str]:
+    """Insert many pastes for `creator`, returning their IDs in the same order. Must be called in a transaction.
+    The blobs and paste rows are copied into temporary tables and inserted from there, a few statements for the whole batch.
+    With `keep_ids`, each paste keeps its id, created and modified time where it can, instead of being new."""
+    hashes = []
+    contents: dict[bytes,bytes] = {}
+    for paste in pastes:
+      if type(paste.data) is not bytes:
+        paste.data = paste.data.encode()
+      content_hash = await ahash_content(paste.data)
+      hashes.append(content_hash)
+      contents[content_hash] = paste.data
+    refs: dict[bytes,int] = {}
+    for content_hash in hashes:
+      refs[content_hash] = refs.get(content_hash, 0) + 1
+
+    # IDs are picked up front, distinct within the batch. The few that turn out to be taken are replaced below.
+    ids: set[str] = set()
+    first_ids = []
+    for paste in pastes:
+      # Imported ids come from elsewhere, only ones that look like our own are kept.
+      id = paste.id if keep_ids and paste.id.isascii() and paste.id.isalnum() else None
+      while not id or id in ids:
+        id = self._random_id(PASTE_ID_LENGTH)
+      ids.add(id)
+      first_ids.append(id)
+    now = self._time()
+
+    # Blobs that are already stored only need their reference counts bumped, the rest are stored.
+    stored = {record["hash"] for record in await conn.fetch("""
+      UPDATE PasteBlobs b SET RefCount = b.RefCount + refs.n
+      FROM unnest($1::BYTEA[], $2::BIGINT[]) AS refs(h, n)
+      WHERE b.Hash = refs.h
+      RETURNING b.Hash;
+    """, list(refs), list(refs.values()))}
+    new_blobs = []
+    for content_hash,n in refs.items():
+      if content_hash in stored:
+        continue
+      data = contents[content_hash]
+      if len(data) > CHUNK_SIZE:
+        # Stored in chunks, like a streamed upload, rather than as one huge value.
+        encoder = StreamEncoder(prefix_length=SEARCH_TEXT_LIMIT)
+        try:
+          await encoder.write(data)
+          encoder.finish()
+          await self._insert_chunked_blob(conn, content_hash, encoder)
+        finally:
+          encoder.close()
+        if n > 1:
+          await conn.execute("UPDATE PasteBlobs SET RefCount = RefCount + $2 WHERE Hash = $1;", content_hash, n - 1)
+        continue
+      codec, encoded = await aencode(data)
+      search_text = data[:SEARCH_TEXT_LIMIT].decode(errors="ignore").encode()
+      new_blobs.append((content_hash, encoded, codec, len(data), n, search_text))
+    # The staging tables are emptied after use, so they can be used again in the same transaction.
+    if new_blobs:
+      await conn.execute("""
+        CREATE TEMPORARY TABLE IF NOT EXISTS new_blobs (
+          Hash BYTEA, Content BYTEA, Codec SMALLINT, Size BIGINT, RefCount BIGINT, SearchText BYTEA
+        ) ON COMMIT DROP;
+      """)
+      await conn.copy_records_to_table("new_blobs", records=new_blobs)
       await conn.execute("""
-        INSERT INTO 
-          Pastes
-            (id,creator,content,visibility,title,created,modified,syntax,tags,folder) 
-        VALUES
-          ($1, $2, $3, $4, $5, $6, $7, $8, $9,$10);
-        """,
-        pasteID,
-        token.owner.id,
-        paste.data,
-        paste.visibility,
-        paste.title,
-        self._time(),
-        self._time(),
-        paste.syntax,
-        paste.tags,
-        paste.folder
+        INSERT INTO PasteBlobs (Hash, Content, Codec, Size, RefCount, ContentVector)
+        SELECT Hash, Content, Codec, Size, RefCount, paste_search_vector(NULL, SearchText) FROM new_blobs
+        ON CONFLICT (Hash) DO UPDATE SET RefCount = PasteBlobs.RefCount + EXCLUDED.RefCount;
+      """)
+      await conn.execute("TRUNCATE new_blobs;")
+
+    await conn.execute("""
+      CREATE TEMPORARY TABLE IF NOT EXISTS new_pastes (
+        Ord INT, id TEXT, ContentHash BYTEA, Visibility INT, Title TEXT, Created BIGINT, Modified BIGINT,
+        Syntax TEXT, Tags TEXT, Folder TEXT, Size BIGINT, Expires BIGINT
+      ) ON COMMIT DROP;
+    """)
+    await conn.copy_records_to_table("new_pastes", records=[
+      (
+        i, id, content_hash, paste.visibility, paste.title,
+        # Never in the future, there may not be a partition for it yet.
+        min((keep_ids and paste.created) or now, now), (keep_ids and paste.modified) or now,
+        paste.syntax, paste.tags, paste.folder, len(paste.data), paste.expires
       )
-      return (await self.get_pastes_from_search(id=pasteID))[0],""
+      for i,(id,content_hash,paste) in enumerate(zip(first_ids, hashes, pastes))
+    ])
+    new_ids: list[str] = [None] * len(pastes)
+    for _ in range(ID_ATTEMPTS):
+      # Rows that went in are taken out of new_pastes, leaving the ones whose ID was taken.
+      for record in await conn.fetch("""
+        WITH claimed AS (
+          INSERT INTO PasteIds (id, Created) SELECT id, Created FROM new_pastes
+          ON CONFLICT (id) DO NOTHING
+          RETURNING id
+        ), inserted AS (
+          INSERT INTO Pastes AS p
+            (id,creator,contenthash,visibility,title,created,modified,syntax,tags,folder,size,expires,searchvector)
+          SELECT
+            s.id, $1, s.ContentHash, s.Visibility, s.Title, s.Created, s.Modified, s.Syntax, s.Tags, s.Folder, s.Size, s.Expires,
+            paste_title_vector(s.Title) || coalesce(b.ContentVector, '')
+          FROM new_pastes s JOIN claimed ON claimed.id = s.id JOIN PasteBlobs b ON b.Hash = s.ContentHash
+          RETURNING p.id
+        )
+        DELETE FROM new_pastes s USING inserted WHERE s.id = inserted.id
+        RETURNING s.Ord, s.id;
+      """, creator):
+        new_ids[record["ord"]] = record["id"]
+      remaining = [ord for ord,id in enumerate(new_ids) if id is None]
+      if not remaining:
+        return new_ids
+      retry_ids: dict[int,str] = {}
+      for ord in remaining:
+        while (id := self._random_id(PASTE_ID_LENGTH)) in ids:
+          pass
+        ids.add(id)
+        retry_ids[ord] = id
+      await conn.executemany("UPDATE new_pastes SET id = $2 WHERE Ord = $1;", list(retry_ids.items()))
+    raise RuntimeError("Could not allocate paste IDs")
+
+  async def _insert_paste(self, conn: asyncpg.Connection, paste: Paste, token: Token, content_hash: bytes, size: int) -> asyncpg.Record:
+    """Insert the row for a new paste, whose content is already in PasteBlobs, under a new random ID and return its metadata columns.
+    The ID is claimed optimistically in PasteIds, and only retried with another in the rare case that one is taken.
+    Must be called in a transaction."""
+    now = self._time()
+    for _ in range(ID_ATTEMPTS):
+      id = await conn.fetchval(
+        "INSERT INTO PasteIds (id, Created) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING RETURNING id;",
+        self._random_id(PASTE_ID_LENGTH), now
+      )
+      if id is not None:
+        break
+    else:
+      raise RuntimeError("Could not allocate a paste ID")
+    return await conn.fetchrow(f"""
+      INSERT INTO 
+        Pastes AS p
+          (id,creator,contenthash,visibility,title,created,modified,syntax,tags,folder,size,expires,searchvector) 
+      VALUES
+        ($1, $2, $3, $4, $5, $6, $7, $8, $9,$10,$11,$12,
+         paste_title_vector($5) || coalesce((SELECT ContentVector FROM PasteBlobs WHERE Hash = $3), ''))
+      RETURNING {PASTE_METADATA_COLUMNS};
+      """,
+      id,
+      token.owner.id,
+      content_hash,
+      paste.visibility,
+      paste.title,
+      now,
+      now,
+      paste.syntax,
+      paste.tags,
+      paste.folder,
+      size,
+      paste.expires
+    )
+
+  async def _insert_chunked_blob(self, conn: asyncpg.Connection, content_hash: bytes, encoder: StreamEncoder) -> None:
+    "Store the content spooled by a finished StreamEncoder as a new blob. Must be called in a transaction."
+    # Only the start of the content is indexed, and it may end part way through a character.
+    search_text = bytes(encoder.prefix).decode(errors="ignore").encode()
+    if encoder.stored_size <= CHUNK_SIZE:
+      stored = b"".join([chunk async for chunk in encoder.chunks()])
+      chunks = 0
+    else:
+      stored = b""
+      chunks = -(-encoder.stored_size // CHUNK_SIZE)
+    inserted = await conn.fetchval("""
+      INSERT INTO PasteBlobs (Hash, Content, Codec, Size, RefCount, Chunks, ContentVector)
+      VALUES ($1, $2, $3, $4, 1, $5, paste_search_vector(NULL, $6))
+      ON CONFLICT (Hash) DO NOTHING
+      RETURNING 1;
+    """, content_hash, stored, encoder.codec, encoder.size, chunks, search_text)
+    if not inserted:
+      # The same content was uploaded at the same time, and that upload stored it first.
+      await conn.execute("UPDATE PasteBlobs SET RefCount = RefCount + 1 WHERE Hash = $1;", content_hash)
+      return
+    if chunks:
+      seq = 0
+      async for chunk in encoder.chunks():
+        await conn.execute("INSERT INTO PasteBlobChunks (Hash, Seq, Content) VALUES ($1, $2, $3);", content_hash, seq, chunk)
+        seq += 1
 
-  async def edit_paste(self, paste:Paste, token: Union[Token,str]) -> Union[Paste,bool]:
-    "Edit a paste, returns the new paste object."
+  async def get_paste_content(self, content_hash: bytes) -> Union[tuple[int,AsyncIterator[bytes],Union[str,None]],None]:
+    """Get a blob's codec, its stored bytes as an iterator that fetches one chunk at a time, and the path of its file
+    if it is in cold storage (the iterator reads that instead). No connection is held between chunks, so a slow
+    client doesn't tie one up. Returns None if there is no such blob."""
+    async with self._read() as conn:
+      record = await self._fetchrow(conn, "blob", content_hash)
+    if not record and self.replicas:
+      async with self.pool.acquire() as conn:
+        record = await self._fetchrow(conn, "blob", content_hash)
+    if not record:
+      return None
+    if record["coldpath"]:
+      return record["codec"], read_chunks(record["coldpath"]), full_path(record["coldpath"])
+
+    async def chunks() -> AsyncIterator[bytes]:
+      if record["chunks"] == 0:
+        yield record["content"]
+        return
+      for seq in range(record["chunks"]):
+        async with self._read() as conn:
+          chunk = await self._fetchval(conn, "blob_chunk", content_hash, seq)
+        if chunk is None and self.replicas:
+          async with self.pool.acquire() as conn:
+            chunk = await self._fetchval(conn, "blob_chunk", content_hash, seq)
+        if chunk is None:
+          # The last paste using it was deleted part way through.
+          raise LookupError(f"Chunk {seq} of blob {content_hash.hex()} is gone")
+        yield chunk
+    return record["codec"], chunks(), None
+
+  async def edit_paste(self, id: str, token: Union[Token,str], *, title: str = None, content: Union[bytes,str] = None, visibility: int = None, syntax: str = None, tags: str = None, folder: str = None) -> Union[PasteMetadata,bool]:
+    """Edit a paste owned by the token's owner, changing the fields that aren't None. Returns the paste's new metadata,
+    or False if it doesn't exist or isn't theirs. The ownership check and the change are a single UPDATE,
+    plus the blob bookkeeping when the content changes."""
     if type(token) is str:
       token = await self.verify_token(token)
       if not token: return False
     if not token.permissions.edit_paste:
       return False
 
-    nPaste = await self.get_pastes_from_search(id=paste.id)
-    if not nPaste: return False
-    nPaste = nPaste[0]
+    content_hash = None
+    if content is not None:
+      if type(content) is not bytes:
+        content = content.encode()
+      content_hash = await ahash_content(content)
 
-    if token.owner.id != nPaste.creator:
+    query = f"""
+      UPDATE Pastes p SET
+        Title = coalesce($3, p.Title),
+        Visibility = coalesce($4, p.Visibility),
+        Syntax = coalesce($5, p.Syntax),
+        Tags = coalesce($6, p.Tags),
+        Folder = coalesce($7, p.Folder),
+        ContentHash = coalesce($8, p.ContentHash),
+        Size = coalesce($9, p.Size),
+        Modified = $10,
+        SearchVector = paste_title_vector(coalesce($3, p.Title)) || coalesce((SELECT ContentVector FROM PasteBlobs WHERE Hash = coalesce($8, p.ContentHash)), '')
+      FROM
+        (SELECT p.id, p.Created, p.ContentHash, p.Visibility FROM Pastes p WHERE {PASTE_BY_ID} AND p.Creator = $2 AND {PASTE_LIVE} FOR UPDATE) old
+      WHERE
+        p.id = old.id AND p.Created = old.Created
+      RETURNING
+        {PASTE_METADATA_COLUMNS}, old.ContentHash AS old_hash, old.Visibility AS old_visibility,
+        (SELECT ColdPath FROM PasteBlobs WHERE Hash = p.ContentHash) AS coldpath;
+    """
+    args = (id, token.owner.id, title, visibility, syntax, tags, folder, content_hash, len(content) if content is not None else None, self._time())
+    async with self.pool.acquire() as conn:
+      if content is None:
+        record = await conn.fetchrow(query, *args)
+      else:
+        try:
+          async with conn.transaction():
+            # The new content's blob has to exist first, SearchVector is built from it.
+            await self._acquire_blob(conn, content_hash, content)
+            record = await conn.fetchrow(query, *args)
+            if not record:
+              raise _Rollback
+            await self._release_blobs(conn, [record["old_hash"]])
+        except _Rollback:
+          record = None
+    if not record:
       return False
+    if record["coldpath"]:
+      await self._promote_blob(record["contenthash"])
+    self._pastes_changed(token.owner.id, public=Visibility.PUBLIC.value in (record["old_visibility"], record["visibility"]))
+    return PasteMetadata.from_record(record)
+
+  async def _acquire_blob(self, conn: asyncpg.Connection, content_hash: bytes, data: bytes) -> None:
+    """Take a reference to the blob holding `data`, storing it if it isn't stored yet.
+    If it is, this is a single primary key lookup and the content is never sent. Must be called in a transaction."""
+    if await conn.fetchval("UPDATE PasteBlobs SET RefCount = RefCount + 1 WHERE Hash = $1 RETURNING 1;", content_hash):
+      return
+    codec, stored = await aencode(data)
+    # Postgres can't read compressed contents, so the uncompressed content is sent for the search vector too.
+    await conn.execute("""
+      INSERT INTO PasteBlobs (Hash, Content, Codec, Size, RefCount, ContentVector)
+      VALUES ($1, $2, $3, $4, 1, paste_search_vector(NULL, coalesce($5, $2)))
+      ON CONFLICT (Hash) DO UPDATE SET RefCount = PasteBlobs.RefCount + 1;
+    """, content_hash, stored, codec, len(data), data if codec != CODEC_IDENTITY else None)
+
+  async def _release_blobs(self, conn: asyncpg.Connection, hashes: list[bytes]) -> None:
+    "Drop one reference per entry in `hashes`, deleting blobs nobody references any more. Must be called in a transaction."
+    hashes = [content_hash for content_hash in hashes if content_hash is not None]
+    if not hashes:
+      return
+    records = await conn.fetch("""
+      UPDATE PasteBlobs b SET RefCount = b.RefCount - released.n
+      FROM (SELECT h, count(*) AS n FROM unnest($1::BYTEA[]) h GROUP BY h) released
+      WHERE b.Hash = released.h
+      RETURNING b.Hash, b.RefCount;
+    """, hashes)
+    unreferenced = [record["hash"] for record in records if record["refcount"] <= 0]
+    if unreferenced:
+      # Files in cold storage are removed by the cold storage job once this has committed.
+      await conn.execute("""
+        WITH deleted AS (
+          DELETE FROM PasteBlobs WHERE Hash = ANY($1::BYTEA[]) AND RefCount <= 0 RETURNING Hash, ColdPath
+        )
+        INSERT INTO ColdBlobDeletions (Hash, Path) SELECT Hash, ColdPath FROM deleted WHERE ColdPath IS NOT NULL
+        ON CONFLICT (Hash) DO NOTHING;
+      """, unreferenced)
+
+  async def _promote_blob(self, content_hash: bytes) -> None:
+    """Move a blob's stored bytes back from cold storage into the database, in chunks if it is large, and queue its
+    file to be removed."""
     async with self.pool.acquire() as conn:
-      await conn.execute("""UPDATE 
-                              Pastes 
-                            SET 
-                              Content = $1, 
-                              Title = $2, 
-                              Visibility = $3, 
-                              Modified=$5, 
-                              Syntax = $6,
-                              tags = $7,
-                              folder = $8
-                            WHERE 
-                              id = $4""",
-                         paste.data,
-                         paste.title,
-                         paste.visibility,
-                         nPaste.id,
-                         self._time(),
-                         paste.syntax,
-                         paste.tags,
-                         paste.folder
-      )
-      return (await self.get_pastes_from_search(id=nPaste.id))[0]
+      async with conn.transaction():
+        path = await conn.fetchval("SELECT ColdPath FROM PasteBlobs WHERE Hash = $1 AND ColdPath IS NOT NULL FOR UPDATE;", content_hash)
+        if path is None:
+          return
+        # The file is read in chunks of CHUNK_SIZE, so only more than one of them means it needs chunking.
+        seq = 0
+        content = b""
+        async for chunk in read_chunks(path):
+          if seq > 0 or content:
+            await conn.execute("INSERT INTO PasteBlobChunks (Hash, Seq, Content) VALUES ($1, $2, $3);", content_hash, seq, content)
+            seq += 1
+          content = chunk
+        if seq > 0:
+          await conn.execute("INSERT INTO PasteBlobChunks (Hash, Seq, Content) VALUES ($1, $2, $3);", content_hash, seq, content)
+          seq += 1
+          content = b""
+        await conn.execute("""
+          UPDATE PasteBlobs SET Content = $2, Chunks = $3, ColdPath = NULL, LastRead = $4 WHERE Hash = $1;
+        """, content_hash, content, seq, self._time())
+        await conn.execute("INSERT INTO ColdBlobDeletions (Hash, Path) VALUES ($1, $2) ON CONFLICT (Hash) DO NOTHING;", content_hash, path)
+
+  async def run_cold_storage(self) -> int:
+    """Remove the files of blobs that have gone from cold storage, then move out the stored bytes of blobs nobody
+    has read in [paste.cold_storage] after_days days, batch_size at a time until there are none left.
+    Returns how many were moved."""
+    await self._remove_cold_files()
+    total = 0
+    while True:
+      cutoff = self._time() - COLD_AFTER_DAYS * 86400
+      async with self.pool.acquire() as conn:
+        # The files are written first, with no transaction open and nothing locked, and the blobs are only switched
+        # over to them afterwards. Blobs whose file is waiting to be removed are left until it has been, so a new
+        # file isn't removed instead. The size is written into the query, so the planner can tell the partial index
+        # on LastRead applies.
+        records = await conn.fetch(f"""
+          SELECT Hash AS ContentHash, Codec, Chunks, CASE WHEN Chunks = 0 THEN Content END AS content, ColdPath
+          FROM PasteBlobs b
+          WHERE ColdPath IS NULL AND Size >= {COLD_MIN_SIZE} AND LastRead < $1
+            AND NOT EXISTS (SELECT 1 FROM ColdBlobDeletions d WHERE d.Hash = b.Hash)
+          ORDER BY LastRead
+          LIMIT $2;
+        """, cutoff, COLD_BATCH_SIZE)
+        written = []
+        for record in records:
+          path = cold_path(record["contenthash"], record["codec"])
+          try:
+            await write_file(path, self._stored_chunks(conn, record))
+          except LookupError:
+            # Deleted while it was being written, which left no file behind.
+            continue
+          written.append((record["contenthash"], record["codec"], path))
+        # Files are named by content, so one written again by another server, or left by a run that stopped here,
+        # is the same file. Blobs read, deleted or recompressed since don't switch, and their files are queued for
+        # removal, which leaves a file alone if another server switched its blob to it.
+        moved = set()
+        if written:
+          async with conn.transaction():
+            moved = {record["hash"] for record in await conn.fetch("""
+              UPDATE PasteBlobs b SET Content = ''::bytea, Chunks = 0, ColdPath = w.Path
+              FROM unnest($1::BYTEA[], $2::SMALLINT[], $3::TEXT[]) AS w(Hash, Codec, Path)
+              WHERE b.Hash = w.Hash AND b.Codec = w.Codec AND b.ColdPath IS NULL AND b.LastRead < $4
+              RETURNING b.Hash;
+            """, *map(list, zip(*written)), cutoff)}
+            await conn.execute("DELETE FROM PasteBlobChunks WHERE Hash = ANY($1::BYTEA[]);", list(moved))
+            await conn.executemany(
+              "INSERT INTO ColdBlobDeletions (Hash, Path) VALUES ($1, $2) ON CONFLICT (Hash) DO NOTHING;",
+              [(content_hash, path) for content_hash,_,path in written if content_hash not in moved]
+            )
+      total += len(moved)
+      if len(records) < COLD_BATCH_SIZE:
+        if total:
+          LOG.info(f"Moved {total} paste contents to cold storage")
+        return total
+
+  async def _remove_cold_files(self) -> None:
+    "Remove the files of blobs that have been deleted, or moved back into the database, since the last run."
+    while True:
+      async with self.pool.acquire() as conn:
+        async with conn.transaction():
+          records = await conn.fetch("""
+            DELETE FROM ColdBlobDeletions d
+            WHERE Hash IN (SELECT Hash FROM ColdBlobDeletions LIMIT $1 FOR UPDATE SKIP LOCKED)
+            RETURNING d.Path, EXISTS (SELECT 1 FROM PasteBlobs b WHERE b.Hash = d.Hash AND b.ColdPath = d.Path) AS live;
+          """, COLD_BATCH_SIZE)
+          await remove_files([record["path"] for record in records if not record["live"]])
+      if len(records) < COLD_BATCH_SIZE:
+        return
 
-  async def delete_paste(self,paste: Paste, token: Token) -> bool:
-    "Delete a paste, returning a boolean"
+  async def recompress_pastes(self, *, batch_size: int = 100, after: bytes = b"") -> Union[bytes,None]:
+    """Compress one batch of stored paste contents that were written uncompressed, walking PasteBlobs from `after`.
+    Returns the hash to continue from, or None once the whole table has been walked."""
+    async with self.pool.acquire() as conn:
+      records = await conn.fetch("""
+        SELECT Hash, Content FROM PasteBlobs
+        WHERE Hash > $1 AND Codec = 0 AND Chunks = 0 AND ColdPath IS NULL AND Size >= $2
+        ORDER BY Hash LIMIT $3;
+      """, after, COMPRESS_MIN_SIZE, batch_size)
+      if not records:
+        return None
+      updates = []
+      for record in records:
+        codec, stored = await aencode(record["content"])
+        if codec != CODEC_IDENTITY:
+          updates.append((record["hash"], stored, codec))
+      # Blobs are immutable apart from their encoding, so there's nothing to race with here.
+      await conn.executemany("UPDATE PasteBlobs SET Content = $2, Codec = $3 WHERE Hash = $1 AND Codec = 0;", updates)
+      return records[-1]["hash"]
+
+  async def delete_paste(self, paste: Union[str,Paste,PasteMetadata], token: Token) -> bool:
+    "Delete a paste (or the paste with that id) owned by the token's owner. Returns False if it doesn't exist or isn't theirs."
     if type(token) is str:
       token = await self.verify_token(token)
       if not token: return False
     if not token.permissions.delete_paste:
       return False
 
-    nPaste = await self.get_pastes_from_search(id=paste.id)
-    if not nPaste: return False
-    nPaste = nPaste[0]
+    async with self.pool.acquire() as conn:
+      async with conn.transaction():
+        record = await conn.fetchrow(f"""
+          WITH deleted AS (
+            DELETE FROM Pastes p WHERE {PASTE_BY_ID} AND p.Creator = $2 RETURNING p.id, p.ContentHash, p.Visibility
+          ), forgotten AS (
+            DELETE FROM PasteIds i USING deleted WHERE i.id = deleted.id
+          )
+          SELECT ContentHash, Visibility FROM deleted;
+          """,
+          paste if type(paste) is str else paste.id, token.owner.id
+        )
+        if not record:
+          return False
+        await self._release_blobs(conn, [record["contenthash"]])
+    self._pastes_changed(token.owner.id, public=record["visibility"] == Visibility.PUBLIC.value)
+    return True
+
+  async def iter_paste_contents(self, *, creator: int) -> AsyncIterator[tuple[PasteMetadata,int,AsyncIterator[bytes]]]:
+    """Walk all of a user's pastes, oldest first, with a server side cursor, yielding each one's metadata, codec and
+    stored content as an iterator of chunks. A few pastes are fetched at a time, so memory use doesn't grow with
+    the account. One connection is held throughout, and each paste's chunks must be read before asking for the next."""
+    async with self._read() as conn:
+      async with conn.transaction(isolation="repeatable_read", readonly=True):
+        async for record in conn.cursor(f"""
+          SELECT {PASTE_METADATA_COLUMNS}, b.Codec, b.Chunks, CASE WHEN b.Chunks = 0 THEN b.Content END AS content, b.ColdPath
+          FROM {PASTE_SOURCE} WHERE p.Creator = $1 AND {PASTE_LIVE}
+          ORDER BY p.Created, p.id;
+        """, creator, prefetch=EXPORT_PREFETCH):
+          self.count_read(record["contenthash"])
+          yield PasteMetadata.from_record(record), record["codec"], self._stored_chunks(conn, record)
 
-    if token.owner.id != nPaste.creator:
-      return False
+  async def _stored_chunks(self, conn: asyncpg.Connection, record: asyncpg.Record) -> AsyncIterator[bytes]:
+    "The stored content of the blob in `record` (with its Chunks, Content and ColdPath columns), a chunk at a time from `conn`."
+    if record["coldpath"]:
+      async for chunk in read_chunks(record["coldpath"]):
+        yield chunk
+      return
+    if record["chunks"] == 0:
+      yield record["content"]
+      return
+    for seq in range(record["chunks"]):
+      chunk = await self._fetchval(conn, "blob_chunk", record["contenthash"], seq)
+      if chunk is None:
+        # The last paste using it was deleted part way through.
+        raise LookupError(f"Chunk {seq} of blob {record['contenthash'].hex()} is gone")
+      yield chunk
 
+  async def sweep_expired_pastes(self) -> int:
+    """Delete pastes that have expired, [paste.expiry] batch_size at a time, until there are none left. Returns how many.
+    Expired pastes are found through the partial index on Expires, so this never scans the table."""
+    total = 0
+    while True:
+      async with self.pool.acquire() as conn:
+        async with conn.transaction():
+          # A paste expires after it was created, so the bound on Created skips partitions too new to have expired
+          # pastes, and deleting by (id, Created) goes straight to each paste's partition.
+          records = await conn.fetch("""
+            WITH batch AS (
+              SELECT id, Created FROM Pastes
+              WHERE Expires <= $1 AND Created <= $1
+              ORDER BY Expires
+              LIMIT $2 FOR UPDATE SKIP LOCKED
+            ), deleted AS (
+              DELETE FROM Pastes p USING batch WHERE p.id = batch.id AND p.Created = batch.Created
+              RETURNING p.id, p.ContentHash, p.Creator, p.Visibility
+            ), forgotten AS (
+              DELETE FROM PasteIds i USING deleted WHERE i.id = deleted.id
+            )
+            SELECT ContentHash, Creator, Visibility FROM deleted;
+          """, self._time(), EXPIRY_BATCH_SIZE)
+          await self._release_blobs(conn, [record["contenthash"] for record in records])
+      total += len(records)
+      for creator in {record["creator"] for record in records}:
+        self._pastes_changed(creator, public=any(record["visibility"] == Visibility.PUBLIC.value for record in records if record["creator"] == creator))
+      if len(records) < EXPIRY_BATCH_SIZE:
+        if total:
+          LOG.info(f"Deleted {total} expired pastes")
+        return total
+      await asyncio.sleep(EXPIRY_BATCH_DELAY)
+
+  async def maintain_paste_partitions(self) -> None:
+    """Create Pastes' monthly partitions [paste.partitions] months_ahead months ahead of time. With archive_after set,
+    partitions that ended more than that many months ago are archived, as are any left part way through archiving."""
+    now = self._time()
     async with self.pool.acquire() as conn:
-      await conn.execute("DELETE FROM Pastes WHERE id = $1",nPaste.id)
-      return True
-    
-  async def create_datadump(self, user: User) -> str:
-    "Create a datadump in `/tmp/` and return the filepath of the zip."
-    # Get the pastes
-    pastes = await self.get_pastes_from_creator(creator=user.id)
-    # Create a tmp directory
-    try:
-      await aioshutil.rmtree(f"/tmp/paste_server/{user.id}/")
-    except: pass
-    await aos.makedirs(f"/tmp/paste_server/{user.id}/",exist_ok=True)
-    for paste in pastes:
-      async with aiofiles.open(f"/tmp/paste_server/{user.id}/{paste.title} ({paste.id}).txt","w") as f:
-        await f.write(paste.text_content)
-    await aioshutil.make_archive(f"/tmp/paste_server/{user.id}","zip",f"/tmp/paste_server/{user.id}/")
-    return f"/tmp/paste_server/{user.id}.zip"
-  
+      created = await create_partitions(conn, until=months_from(now, PARTITION_MONTHS_AHEAD))
+      if created:
+        LOG.info(f"Created paste partitions {', '.join(created)}")
+      if not PARTITION_ARCHIVE_AFTER:
+        return
+      cutoff = months_from(now, -PARTITION_ARCHIVE_AFTER)
+      names = await get_unfinished_archives(conn)
+      names += [partition.name for partition in await get_partitions(conn) if partition.end is not None and partition.end <= cutoff]
+    for name in names:
+      await self.archive_paste_partition(name)
+
+  async def archive_paste_partition(self, name: str) -> int:
+    """Detach a partition of Pastes and archive it as a unit. Each of its pastes gets a copy of its stored content in
+    new Content and Codec columns, then gives up its id and its reference to the shared blob, a batch at a time.
+    What's left is a table that stands on its own, to be dumped and dropped. Safe to re-run if interrupted.
+    Returns how many pastes were archived."""
+    total = 0
+    after = (-1 << 63, "")
+    async with self.pool.acquire() as conn:
+      await detach_partition(conn, name)
+      await conn.execute(f"ALTER TABLE {name} ADD COLUMN IF NOT EXISTS Content BYTEA, ADD COLUMN IF NOT EXISTS Codec SMALLINT;")
+      while True:
+        async with conn.transaction():
+          records = await conn.fetch(f"""
+            WITH batch AS (
+              SELECT id, Created FROM {name}
+              WHERE (Created, id) > ($2, $3) AND Content IS NULL
+              ORDER BY Created, id
+              LIMIT $1 FOR UPDATE
+            ), archived AS (
+              UPDATE {name} a SET
+                Codec = coalesce((SELECT b.Codec FROM PasteBlobs b WHERE b.Hash = a.ContentHash), 0),
+                Content = coalesce((
+                  SELECT CASE WHEN b.Chunks = 0 THEN b.Content ELSE (SELECT string_agg(c.Content, ''::bytea ORDER BY c.Seq) FROM PasteBlobChunks c WHERE c.Hash = b.Hash) END
+                  FROM PasteBlobs b WHERE b.Hash = a.ContentHash
+                ), ''::bytea)
+              FROM batch WHERE a.id = batch.id AND a.Created = batch.Created
+              RETURNING a.id, a.Created, a.ContentHash, a.Creator, a.Visibility,
+                (SELECT b.ColdPath FROM PasteBlobs b WHERE b.Hash = a.ContentHash) AS coldpath
+            ), forgotten AS (
+              DELETE FROM PasteIds i USING archived WHERE i.id = archived.id
+            )
+            SELECT id, Created, ContentHash, Creator, Visibility, ColdPath FROM archived;
+          """, ARCHIVE_BATCH_SIZE, *after)
+          for record in records:
+            if record["coldpath"]:
+              await conn.execute(
+                f"UPDATE {name} SET Content = $3 WHERE id = $1 AND Created = $2;",
+                record["id"], record["created"], await read_file(record["coldpath"])
+              )
+          await self._release_blobs(conn, [record["contenthash"] for record in records])
+        total += len(records)
+        for creator in {record["creator"] for record in records}:
+          self._pastes_changed(creator, public=any(record["visibility"] == Visibility.PUBLIC.value for record in records if record["creator"] == creator))
+        if len(records) < ARCHIVE_BATCH_SIZE:
+          break
+        after = max((record["created"], record["id"]) for record in records)
+      await conn.execute(f"COMMENT ON TABLE {name} IS '{ARCHIVED_COMMENT}';")
+    LOG.info(f"Archived paste partition {name}, {total} pastes")
+    return total
+
   async def get_token(self, user: User, token_name: str) -> Token:
     user_id = user.id
     async with self.pool.acquire() as conn:
@@ -357,26 +1362,128 @@ class PGUtils:
       return Token.from_record(record,user)
 
   async def delete_user(self, user: User, *, delete_pastes: bool = True) -> bool:
+    """Delete a user account. With `delete_pastes`, the user is tombstoned straight away, so they can't log in and their
+    name is free, and their pastes and then the user are deleted in the background (see `run_deletion_jobs`).
+    Otherwise the user is deleted now, and their pastes are kept under Deleted User."""
     user_id = user.id
     async with self.pool.acquire() as conn:
       try:
-        if delete_pastes:
-          await conn.execute("DELETE FROM Pastes WHERE Creator = $1;",user_id)
-        await conn.execute("DELETE FROM APITokens WHERE Creator = $1;",user_id)
-        await conn.execute("DELETE FROM Users WHERE id = $1;",user_id)
+        async with conn.transaction():
+          await conn.execute("DELETE FROM APITokens WHERE Creator = $1;",user_id)
+          if delete_pastes:
+            await conn.execute("""
+              UPDATE Users SET
+                Username = NULL, Password = NULL, Email = NULL, InsecureToken = NULL, SecureToken = NULL, AvatarURL = NULL,
+                Deleted = $2
+              WHERE id = $1;
+            """, user_id, self._time())
+            await self._queue_deletion(conn, user_id, delete_user=True)
+          else:
+            await conn.execute("DELETE FROM Users WHERE id = $1;",user_id)
       except:
         return False
+      finally:
+        self.invalidate_user_tokens(user_id)
+        self._pastes_changed(user_id, public=True)
     return True
 
+  async def queue_paste_deletion(self, user: Union[int,User], *, folder: str = None) -> asyncpg.Record:
+    "Queue the deletion of all of a user's pastes, or those in `folder`, in the background. Returns the job."
+    if type(user) is User:
+      user = user.id
+    async with self.pool.acquire() as conn:
+      return await self._queue_deletion(conn, user, folder=folder)
+
+  async def _queue_deletion(self, conn: asyncpg.Connection, user_id: int, *, folder: str = None, delete_user: bool = False) -> asyncpg.Record:
+    """Queue a deletion job. It only deletes pastes created up to now, so ones the user makes while it waits are kept,
+    unless it deletes the user, who can't make any more."""
+    now = self._time()
+    return await conn.fetchrow("""
+      INSERT INTO DeletionJobs (Creator, Folder, DeleteUser, Total, Created, CreatedBefore)
+      VALUES ($1, $2, $3, (SELECT count(*) FROM Pastes WHERE Creator = $1 AND ($2::TEXT IS NULL OR Folder = $2) AND Created <= $4), $4, $5)
+      RETURNING *;
+    """, user_id, folder, delete_user, now, None if delete_user else now)
+
+  async def get_deletion_jobs(self, user: Union[int,User]) -> list[asyncpg.Record]:
+    "A user's deletion jobs, newest first, with their progress."
+    if type(user) is User:
+      user = user.id
+    async with self.pool.acquire() as conn:
+      return await conn.fetch("SELECT * FROM DeletionJobs WHERE Creator = $1 ORDER BY id DESC LIMIT 50;", user)
+
+  async def run_deletion_jobs(self) -> None:
+    """Work through the queued deletion jobs, oldest first, until there are none left.
+    Jobs are picked up from the database, so ones interrupted by a restart carry on where they left off."""
+    while True:
+      async with self.pool.acquire() as conn:
+        job = await conn.fetchrow("SELECT * FROM DeletionJobs WHERE Finished IS NULL ORDER BY id LIMIT 1;")
+      if not job:
+        return
+      await self._run_deletion_job(job)
+
+  async def _run_deletion_job(self, job: asyncpg.Record) -> None:
+    """Delete a job's pastes [paste.deletion] batch_size at a time, each batch in its own short transaction that also
+    records the progress, pausing batch_delay seconds between them to spread out the load and the WAL."""
+    what = f"user {job['creator']}" if job["deleteuser"] else f"pastes of user {job['creator']}"
+    if job["folder"] is not None:
+      what += f" in folder {job['folder']!r}"
+    LOG.info(f"Deletion job {job['id']}: deleting {what}, {job['deleted']}/{job['total']} pastes done")
+    deleted = job["deleted"]
+    while True:
+      async with self.pool.acquire() as conn:
+        async with conn.transaction():
+          # Oldest first along the (Creator, Created, id) index, up to the job's bound.
+          records = await conn.fetch("""
+            WITH batch AS (
+              SELECT id, Created FROM Pastes
+              WHERE Creator = $1 AND ($2::TEXT IS NULL OR Folder = $2) AND Created <= coalesce($4::BIGINT, 9223372036854775807)
+              ORDER BY Created, id
+              LIMIT $3 FOR UPDATE
+            ), deleted AS (
+              DELETE FROM Pastes p USING batch WHERE p.id = batch.id AND p.Created = batch.Created
+              RETURNING p.id, p.ContentHash, p.Visibility
+            ), forgotten AS (
+              DELETE FROM PasteIds i USING deleted WHERE i.id = deleted.id
+            )
+            SELECT ContentHash, Visibility FROM deleted;
+          """, job["creator"], job["folder"], DELETION_BATCH_SIZE, job["createdbefore"])
+          if records:
+            await self._release_blobs(conn, [record["contenthash"] for record in records])
+            await conn.execute("UPDATE DeletionJobs SET Deleted = Deleted + $2 WHERE id = $1;", job["id"], len(records))
+          else:
+            if job["deleteuser"]:
+              await conn.execute("DELETE FROM Users WHERE id = $1 AND Deleted IS NOT NULL;", job["creator"])
+            await conn.execute("UPDATE DeletionJobs SET Finished = $2 WHERE id = $1;", job["id"], self._time())
+      if not records:
+        LOG.info(f"Deletion job {job['id']}: finished, {deleted} pastes deleted")
+        return
+      deleted += len(records)
+      self._pastes_changed(job["creator"], public=any(record["visibility"] == Visibility.PUBLIC.value for record in records))
+      LOG.debug(f"Deletion job {job['id']}: {deleted}/{job['total']} pastes deleted")
+      await asyncio.sleep(DELETION_BATCH_DELAY)
+
   async def create_token(self, token: Token) -> Union[Token,False]:
     "This takens a token object with no ID and inserts it into the database, generating an ID as necessary."
     async with self.pool.acquire() as conn:
       try:
-        id = await self._generate_token_id()
-        ident = await self._generate_token_id()
-        await conn.execute("INSERT INTO APITokens (Creator, Title, Perms, Id, Ident) VALUES ($1,$2,$3,$4,$5);",token.owner.id,token.name,token.perms,id,ident)
+        for _ in range(ID_ATTEMPTS):
+          id = self._random_id(TOKEN_ID_LENGTH)
+          ident = self._random_id(TOKEN_ID_LENGTH)
+          # An id or ident must not match any other token's id or ident.
+          inserted = await conn.fetchval("""
+            INSERT INTO APITokens (Creator, Title, Perms, Id, Ident)
+            SELECT $1,$2,$3,$4,$5
+            WHERE NOT EXISTS (SELECT 1 FROM APITokens WHERE Id IN ($4,$5) OR Ident IN ($4,$5))
+            ON CONFLICT (id) DO NOTHING
+            RETURNING id;
+          """,token.owner.id,token.name,token.perms,id,ident)
+          if inserted:
+            break
+        else:
+          raise RuntimeError("Could not allocate a token ID")
         token.id = id
         token.ident = ident
+        self.invalidate_token(id)
         return token
       except:
         LOG.exception("Error in create_token")
@@ -390,6 +1497,7 @@ class PGUtils:
         name if name is not None else token.name,
         perms if perms is not None else token.perms
         )
+        self.invalidate_token(token)
         return await self.verify_token(token.id)
       except:
         LOG.exception("Error in edit_token")
@@ -402,6 +1510,8 @@ class PGUtils:
         return True
       except:
         return False
+      finally:
+        self.invalidate_token(token)
       
   async def get_tokens_from_user(self, user: int|User) -> Coroutine[Any, Any, list[Token]]:
     if type(user) is User:
@@ -418,27 +1528,29 @@ class PGUtils:
     if type(user) is User:
       user = user.id
     async with self.pool.acquire() as conn:
-      new_token: str = await self._generate_user_token_id(False)
-      await conn.execute("UPDATE Users SET InsecureToken = $2 WHERE Id = $1",user,new_token)
+      new_token: str = await self._set_user_token(conn, user, "InsecureToken")
       if regen_secure:
-        new_secure_token: str = await self._generate_user_token_id(True)
-        await conn.execute("UPDATE Users SET SecureToken = $2 WHERE Id = $1",user,new_secure_token)
+        await self._set_user_token(conn, user, "SecureToken")
+      self.invalidate_user_tokens(user)
       return new_token
     
   async def get_user_pastes_count(self, user: Union[int,User], all_pastes: bool) -> int:
     if type(user) is User:
       user = user.id
-    async with self.pool.acquire() as conn:
+    async with self._read() as conn:
       if all_pastes:
-        count = (await conn.fetchrow("SELECT COUNT(*) FROM Pastes WHERE Creator=$1;", user))["count"]
+        count = (await conn.fetchrow(f"SELECT COUNT(*) FROM Pastes p WHERE Creator=$1 AND {PASTE_LIVE};", user))["count"]
       else:
-        count = (await conn.fetchrow("SELECT COUNT(*) FROM Pastes WHERE Creator=$1 AND Visibility=1;", user))["count"]
+        count = (await conn.fetchrow(f"SELECT COUNT(*) FROM Pastes p WHERE Creator=$1 AND Visibility=1 AND {PASTE_LIVE};", user))["count"]
       return count
     
-  async def get_user_folders(self, user: Union[int,User]) -> list[str]:
+  async def get_user_folders(self, user: Union[int,User], *, public_only: bool = False) -> list[str]:
     if type(user) is User:
       user = user.id
-    async with self.pool.acquire() as conn:
-      folders_record = await conn.fetch("SELECT DISTINCT Folder FROM Pastes WHERE Creator=$1;", user)
+    async with self._read() as conn:
+      if public_only:
+        folders_record = await conn.fetch(f"SELECT DISTINCT Folder FROM Pastes p WHERE Creator=$1 AND Visibility=1 AND {PASTE_LIVE};", user)
+      else:
+        folders_record = await conn.fetch(f"SELECT DISTINCT Folder FROM Pastes p WHERE Creator=$1 AND {PASTE_LIVE};", user)
       folders = [record["folder"] for record in folders_record]
       return folders
\ No newline at end of file
@@ -0,0 +1,111 @@
+# The Postgres connection pool, sized and tuned from the [pg.pool] config, and instrumented for monitoring.
+
+from __future__ import annotations
+
+import time
+import tomllib
+from typing import TYPE_CHECKING
+
+import asyncpg
+
+if TYPE_CHECKING:
+  from typing import Any, Callable, Coroutine, Union
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  pg_config = config["pg"]
+  pool_config = pg_config.get("pool", {})
+
+class PasteConnection(asyncpg.Connection):
+  "A pool connection, which keeps the statements prepared by its init hook in `prepared`."
+  prepared: dict[str,asyncpg.prepared_stmt.PreparedStatement]
+
+class InstrumentedPool:
+  """Wraps an asyncpg pool, keeping statistics on how long acquiring a connection takes and how many are waiting.
+  Everything else is passed through to the pool."""
+  acquires: int
+  waiting: int
+  acquire_time: float # Total seconds spent waiting for connections.
+  max_acquire_time: float # Longest wait since `reset_max_acquire_time` was last called.
+
+  def __init__(self, pool: asyncpg.Pool) -> None:
+    self._pool = pool
+    self.acquires = 0
+    self.waiting = 0
+    self.acquire_time = 0.0
+    self.max_acquire_time = 0.0
+
+  def __getattr__(self, name: str) -> Any:
+    return getattr(self._pool, name)
+
+  def acquire(self, *, timeout: float = None) -> _Acquire:
+    return _Acquire(self, timeout)
+
+  async def _acquire(self, timeout: Union[float,None]) -> asyncpg.Connection:
+    start = time.monotonic()
+    self.waiting += 1
+    try:
+      return await self._pool.acquire(timeout=timeout)
+    finally:
+      self.waiting -= 1
+      elapsed = time.monotonic() - start
+      self.acquires += 1
+      self.acquire_time += elapsed
+      self.max_acquire_time = max(self.max_acquire_time, elapsed)
+
+  @property
+  def stats(self) -> dict[str,Any]:
+    "A snapshot of the pool statistics. Reading it changes nothing, so anything may."
+    size = self._pool.get_size()
+    idle = self._pool.get_idle_size()
+    return {
+      "size": size,
+      "in_use": size - idle,
+      "idle": idle,
+      "max_size": self._pool.get_max_size(),
+      "waiting": self.waiting,
+      "acquires": self.acquires,
+      "mean_acquire_ms": round(self.acquire_time / self.acquires * 1000, 3) if self.acquires else 0.0,
+      "max_acquire_ms": round(self.max_acquire_time * 1000, 3),
+    }
+
+  def reset_max_acquire_time(self) -> None:
+    "Start tracking the longest wait again, such as at the start of each stats log interval."
+    self.max_acquire_time = 0.0
+
+class _Acquire:
+  "What InstrumentedPool.acquire returns, usable with `async with` or `await` like asyncpg's own."
+  def __init__(self, pool: InstrumentedPool, timeout: Union[float,None]) -> None:
+    self._pool = pool
+    self._timeout = timeout
+    self._conn = None
+
+  def __await__(self):
+    return self._pool._acquire(self._timeout).__await__()
+
+  async def __aenter__(self) -> asyncpg.Connection:
+    self._conn = await self._pool._acquire(self._timeout)
+    return self._conn
+
+  async def __aexit__(self, *exc) -> None:
+    conn, self._conn = self._conn, None
+    await self._pool.release(conn)
+
+async def create_pool(*, url: str = None, min_size: int = None, init: Callable[[asyncpg.Connection],Coroutine[Any,Any,None]] = None) -> InstrumentedPool:
+  """Create a connection pool from the [pg] and [pg.pool] config. `url` and `min_size` override those, for replicas.
+  `init` is run on every new connection."""
+  command_timeout = pool_config.get("command_timeout", 0)
+  pool = await asyncpg.create_pool(
+    url or pg_config["url"],
+    password=pg_config["password"],
+    timeout=pg_config["timeout"],
+    min_size=pool_config.get("min_size", 10) if min_size is None else min_size,
+    max_size=pool_config.get("max_size", 10),
+    max_inactive_connection_lifetime=pool_config.get("max_inactive_connection_lifetime", 300.0),
+    statement_cache_size=pool_config.get("statement_cache_size", 100),
+    max_cached_statement_lifetime=pool_config.get("max_cached_statement_lifetime", 300),
+    command_timeout=command_timeout or None,
+    connection_class=PasteConnection,
+    init=init,
+  )
+  return InstrumentedPool(pool)
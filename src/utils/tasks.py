@@ -0,0 +1,32 @@
+# Background jobs run alongside the web server.
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from typing import Any, Callable, Coroutine
+
+LOG = logging.getLogger(__name__)
+
+def run_periodically(name: str, func: Callable[[], Coroutine[Any, Any, Any]], interval: float) -> asyncio.Task:
+  """Run `func` every `interval` seconds until the returned task is cancelled.
+  Exceptions are logged and the job carries on at the next interval."""
+  async def runner():
+    while True:
+      try:
+        await func()
+      except asyncio.CancelledError:
+        raise
+      except Exception:
+        LOG.exception(f"Error in background job {name}")
+      await asyncio.sleep(interval)
+  return asyncio.create_task(runner(), name=name)
+
+async def cancel_all(tasks: list[asyncio.Task]) -> None:
+  "Cancel background jobs and wait for them to finish."
+  for task in tasks:
+    task.cancel()
+  await asyncio.gather(*tasks, return_exceptions=True)
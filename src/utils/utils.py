@@ -3,6 +3,8 @@
 from __future__ import annotations
 
 import asyncio
+import base64
+import binascii
 import hashlib
 import importlib.util
 import io
@@ -52,6 +54,13 @@ async def ahash(passwd: str, username: str) -> Coroutine[Any, Any, str]:
   result = await loop.run_in_executor(None, hash, passwd, username)
   return result
 
+async def ahash_content(data: bytes) -> Coroutine[Any, Any, bytes]:
+  "Returns the SHA-256 digest of paste content, which is its key in PasteBlobs."
+  if len(data) < 65536:
+    return hashlib.sha256(data).digest()
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, lambda: hashlib.sha256(data).digest())
+
 async def gravatar(user_email: str) -> Coroutine[Any, Any, str]:
   "Return a gravatar URL for the email"
   loop = asyncio.get_running_loop()
@@ -86,6 +95,36 @@ def get_routes(name:str,*,package=None) -> web.RouteTableDef:
   routes = lib.setup()
   return routes
 
+def encode_cursor(created: int, id: str) -> str:
+  "Encode a (Created, id) position in a paste listing into an opaque cursor string."
+  return base64.urlsafe_b64encode(f"{created}:{id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[int,str]:
+  "Decode a cursor from `encode_cursor`. Raises ValueError if it is malformed."
+  try:
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+  except (UnicodeDecodeError, binascii.Error) as e:
+    raise ValueError("invalid cursor") from e
+  created, sep, id = raw.partition(":")
+  if not sep or not id:
+    raise ValueError("invalid cursor")
+  return int(created), id
+
+def accepts_encoding(request: web.Request, encoding: str) -> bool:
+  "Checks if the client accepts responses with the given Content-Encoding."
+  for item in request.headers.get("Accept-Encoding","").split(","):
+    name, _, params = item.partition(";")
+    if name.strip().lower() not in (encoding, "*"):
+      continue
+    params = params.strip().lower()
+    if params.startswith("q="):
+      try:
+        return float(params[2:]) > 0
+      except ValueError:
+        return False
+    return True
+  return False
+
 def set_bit(v: int, index: int, x: bool) -> int:
   "Sets the index bit of v to the value of x"
   mask = 1 << index